@@ -1,11 +1,23 @@
 import os
+import sys
+import json
+import hmac
+import signal
 import asyncio
 import asyncpg
 import logging
+import math
+import heapq
+import contextlib
+import time
+from collections import OrderedDict, deque
 from typing import Union
-from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup, constants
-from telegram.error import BadRequest, Forbidden
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram import (
+    Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity, constants,
+    InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
+)
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.ext import Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 import re
 
 # --- Settings & Environment Variables (الأصلية) ---
@@ -20,6 +32,77 @@ except KeyError as e:
     logging.critical(f"CRITICAL: Missing environment variable {e}. Bot cannot start.")
     exit(f"Missing environment variable: {e}")
 
+# --- Membership Cache Settings (إعدادات كاش الاشتراك) ---
+MEMBERSHIP_CACHE_TTL = float(os.environ.get('MEMBERSHIP_CACHE_TTL', '600'))
+MEMBERSHIP_CACHE_NEGATIVE_TTL = float(os.environ.get('MEMBERSHIP_CACHE_NEGATIVE_TTL', '30'))
+MEMBERSHIP_CACHE_MAX_SIZE = int(os.environ.get('MEMBERSHIP_CACHE_MAX_SIZE', '50000'))
+
+# --- Cluster Settings (تشغيل عدة نسخ على نفس قاعدة البيانات) ---
+# في وضع العنقود تتم المطابقة داخل Postgres (قفل استشاري + SKIP LOCKED) بدل الطوابير المحلية،
+# وتُبلغ كل نسخة البقية بتغيّر حالة المستخدمين عبر LISTEN/NOTIFY.
+CLUSTER_MODE = os.environ.get('CLUSTER_MODE', '0') == '1'
+INSTANCE_ID = os.environ.get('DYNO') or os.urandom(4).hex()
+
+# --- Run Mode Settings (وضع التشغيل: polling أو webhook) ---
+BOT_MODE = os.environ.get('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # الرابط العام للبوت، مثل https://my-app.herokuapp.com
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('PORT', '8443'))
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', '40'))
+WEBHOOK_SET_ON_START = os.environ.get('WEBHOOK_SET_ON_START', '1') == '1'
+
+# --- Concurrent Update Processing Settings (إعدادات المعالجة المتزامنة) ---
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', '64'))
+UPDATE_MAX_PENDING = int(os.environ.get('UPDATE_MAX_PENDING', '4096'))
+
+# --- Archive Pipeline Settings (إعدادات أرشفة قناة السجل) ---
+ARCHIVE_QUEUE_SIZE = int(os.environ.get('ARCHIVE_QUEUE_SIZE', '10000'))
+ARCHIVE_BATCH_SIZE = min(int(os.environ.get('ARCHIVE_BATCH_SIZE', '100')), 100)  # حد forward_messages
+ARCHIVE_FLUSH_INTERVAL = float(os.environ.get('ARCHIVE_FLUSH_INTERVAL', '3'))
+ARCHIVE_RATE_PER_MINUTE = float(os.environ.get('ARCHIVE_RATE_PER_MINUTE', '20'))
+
+# --- Album Settings (تجميع عناصر الألبوم قبل تمريرها) ---
+ALBUM_WAIT = float(os.environ.get('ALBUM_WAIT', '0.5'))  # مهلة الهدوء بعد آخر عنصر
+ALBUM_MAX_WAIT = float(os.environ.get('ALBUM_MAX_WAIT', '2'))  # الحد الأقصى من أول عنصر
+
+# --- Outbound Scheduler Settings (جدولة كل طلبات Bot API الصادرة) ---
+OUTBOUND_RATE = float(os.environ.get('OUTBOUND_RATE', '30'))  # طلب/ثانية لكل البوت
+OUTBOUND_CHAT_RATE = float(os.environ.get('OUTBOUND_CHAT_RATE', '1'))  # رسالة/ثانية لكل محادثة خاصة
+OUTBOUND_CHAT_BURST = int(os.environ.get('OUTBOUND_CHAT_BURST', '5'))
+OUTBOUND_GROUP_RATE_PER_MINUTE = float(os.environ.get('OUTBOUND_GROUP_RATE_PER_MINUTE', '20'))  # للمجموعات والقنوات
+OUTBOUND_MAX_RETRIES = int(os.environ.get('OUTBOUND_MAX_RETRIES', '2'))
+
+# --- Broadcast Settings (إعدادات البث) ---
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '25'))  # رسالة/ثانية (حد تيليجرام العام ~30)
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '50'))
+BROADCAST_MAX_RETRIES = int(os.environ.get('BROADCAST_MAX_RETRIES', '3'))
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get('BROADCAST_PROGRESS_INTERVAL', '30'))
+BROADCAST_FETCH_SIZE = int(os.environ.get('BROADCAST_FETCH_SIZE', '1000'))
+BROADCAST_LEASE = float(os.environ.get('BROADCAST_LEASE', '60'))  # ثوانٍ؛ حجز مهمة البث لنسخة واحدة في وضع العنقود
+
+# --- Global Ban Filter Settings (إعدادات مرشح الحظر الشامل) ---
+BAN_FILTER_CAPACITY = int(os.environ.get('BAN_FILTER_CAPACITY', '100000'))
+BAN_FILTER_ERROR_RATE = float(os.environ.get('BAN_FILTER_ERROR_RATE', '0.001'))
+BULK_BAN_MAX_IDS = int(os.environ.get('BULK_BAN_MAX_IDS', '100000'))  # حد IDs في أمر /banuser واحد
+BULK_BAN_FILE_MAX_SIZE = int(os.environ.get('BULK_BAN_FILE_MAX_SIZE', str(5 * 1024 * 1024)))  # بايت
+
+# --- User State Cache Settings (إعدادات كاش حالة المستخدم) ---
+USER_STATE_CACHE_MAX_SIZE = int(os.environ.get('USER_STATE_CACHE_MAX_SIZE', '100000'))
+
+# --- Database Pool Settings (إعدادات مجمع اتصالات قاعدة البيانات) ---
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_MAX_QUERIES = int(os.environ.get('DB_POOL_MAX_QUERIES', '50000'))  # يُستبدل الاتصال بعدها
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', '300'))  # ثوانٍ قبل إغلاق اتصال خامل
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', '100'))  # استعلامات محضرة لكل اتصال
+
+# --- Write-Behind Settings (إعدادات الكتابة المؤجلة للمستخدمين والحظر) ---
+USER_WRITE_FLUSH_INTERVAL = float(os.environ.get('USER_WRITE_FLUSH_INTERVAL', '0.2'))  # ثوانٍ بين الدفعات
+USER_WRITE_BATCH_SIZE = int(os.environ.get('USER_WRITE_BATCH_SIZE', '500'))  # دفعة فورية عند بلوغ هذا العدد
+USER_WRITE_MAX_RETRIES = int(os.environ.get('USER_WRITE_MAX_RETRIES', '8'))  # محاولات دفعة فاشلة (بمهلة متضاعفة) قبل إسقاطها
+
 db_pool = None
 
 logging.basicConfig(
@@ -28,265 +111,1359 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# --- (1) Translation Dictionaries and Helpers (تم التعديل هنا) ---
-LANGUAGES = {
-    'en': {
-        'language_name': "English 🇬🇧",
-        'welcome': "Welcome to 🎲 **Random Partner**\nThe anonymous Chat Bot!\n\nPress 'Search' to find a partner.",
-        'already_in_chat': "You are currently in a chat. Use the buttons below.",
-        'already_searching': "You are currently in the waiting queue. Use the buttons below.",
-        'search_btn': "Search 🔎",
-        'next_btn': "Next 🎲",
-        'stop_btn': "Stop ⏹️",
-        'block_btn': "Block User 🚫",
-        'search_already_in_chat': "You are already in a chat! Press 'Stop' or 'Next' first.",
-        'search_already_searching': "You are already searching. Please wait...",
-        'search_wait': "🔎 Searching for a partner... Please wait.",
-        
-        # --- الإضافة المطلوبة (الإنجليزية) ---
-        'partner_found': "✅ Partner found! The chat has started. (You are anonymous).",
-        'safety_alert': "🔥 NEW PARTNER! 🔥\n\n⚠️ **SAFETY ALERT:** If you receive abusive/unwanted content (spam, explicit images, etc.), press **[Block User 🚫]** on the keyboard immediately. This action will permanently ban the abuser from our system.",
-        'safe_chat_wish': "🥰 We wish you a pleasant chat 🥰",
-        # --- نهاية الإضافة ---
-        
-        'end_msg_user': "🔚 You have ended the chat.",
-        'end_msg_partner': "⚠️ Your partner has left the chat.",
-        'end_search_cancel': "Search cancelled.",
-        'end_not_in_chat': "You are not currently in a chat or searching.",
-        'link_blocked': "⛔️ You cannot send links (URLs) in anonymous chat.",
-        'username_blocked': "⛔️ You cannot send user identifiers (usernames) in anonymous chat.",
-        'settings_text': "🌐 **Language Settings**\n\nSelect your preferred language for the bot's interface and for matching partners:",
-        'settings_saved': "✅ Language updated to {lang_name}. Press /start to see the changes.",
-        'admin_denied': "🚫 Access denied. This command is for the administrator only.",
-        'globally_banned': "🚫 Your access to this bot has been suspended permanently.",
-        'use_buttons_msg': "Use the buttons below to control the chat:",
-        'initial_selection_msg': "🌐 **Welcome to the Anonymous Chat Bot!**\n\nPlease select your preferred language to continue the setup:", 
-        'cancel_op_btn': "❌ Cancel", 
-        'join_channel_msg': r"👋 **Welcome to Random Partner 🎲\!**" + "\n\n"
-                            r"To use this bot, you are required to join our official channel\." + "\n\n"
-                            r"Please join the channel using the button below, then press '✅ I have joined'\.",
-        'join_channel_btn': "Join Channel",
-        'joined_btn': "I have joined",
-        'joined_success': r"🎉 **Thank you for joining\!**" + "\n\n"
-                          r"You can now use the bot\. Press /start or use the buttons below\.",
-        'block_confirm_text': "🚫 **CONFIRM BLOCK AND REPORT**\n\nAre you sure you want to block the current partner and send a report to the Telegram Team?\n\n*(This action will end the chat immediately.)*",
-        'block_cancelled': "🚫 Block/Report operation cancelled. You can continue chatting.",
-        'block_success': "🛑 Thank you! The user has been blocked and the chat has ended.\n\nYour report has been successfully sent for review.\n\nPress Next 🎲 to find a new partner.",
-        'next_not_in_chat': "🔎 Searching for a partner... Please wait.",
-        'next_msg_user': "🔎 Searching for a new partner...",
-        'next_already_searching': "You are already searching. Please wait...",
-        'block_not_in_chat': "You are not currently in a chat to block anyone.",
-        'block_while_searching': "You cannot block anyone while searching. Use 'Stop ⏹️' first.",
-        'unreachable_partner': "Your partner seems to have blocked the bot or left Telegram. The chat has ended.",
-        'not_in_chat_msg': "You are not in a chat. Press 'Search' to find a partner.",
-        'partner_prefix': "Random partner🎲 : ",
-    },
-    'ar': {
-        'language_name': "العربية 🇸🇦",
-        'welcome': "مرحباً بك في 🎲 **شريك عشوائي**\nبوت الدردشة المجهول!\n\nاضغط 'بحث' للعثور على شريك.",
-        'already_in_chat': "أنت حالياً في محادثة. استخدم الأزرار أدناه.",
-        'already_searching': "أنت حالياً في قائمة الانتظار. استخدم الأزرار أدناه.",
-        'search_btn': "بحث 🔎",
-        'next_btn': "التالي 🎲",
-        'stop_btn': "إيقاف ⏹️",
-        'block_btn': "حظر مستخدم 🚫",
-        'search_already_in_chat': "أنت بالفعل في محادثة! اضغط 'إيقاف' أو 'التالي' أولاً.",
-        'search_already_searching': "أنت بالفعل تبحث. يرجى الانتظار...",
-        'search_wait': "🔎 البحث عن شريك... يرجى الانتظار.",
-        
-        # --- الإضافة المطلوبة (العربية) ---
-        'partner_found': "✅ تم العثور على شريك! بدأت المحادثة. (أنت مجهول).",
-        'safety_alert': "🔥 شريك جديد! 🔥\n\n⚠️ **للسلامة:** إذا تعرضت لأي محتوى مسيء أو غير مرغوب فيه (سبام، صور مزعجة، إلخ)، اضغط فوراً على زر **[حظر مستخدم 🚫]** في لوحة مفاتيح البوت. هذا الإجراء سيقوم بحظر المسيء **نهائياً** من نظامنا.",
-        'safe_chat_wish': "🥰 نتمنى لك محادثة لطيفة 🥰",
-        # --- نهاية الإضافة ---
-
-        'end_msg_user': "🔚 لقد أنهيت المحادثة.",
-        'end_msg_partner': "⚠️ لقد غادر شريكك المحادثة.",
-        'end_search_cancel': "تم إلغاء البحث.",
-        'end_not_in_chat': "أنت لست في محادثة حالياً ولا تبحث.",
-        'link_blocked': "⛔️ لا يمكنك إرسال روابط (URLs) في الدردشة المجهولة.",
-        'username_blocked': "⛔️ لا يمكنك إرسال معرفات مستخدمين (usernames) في الدردشة المجهولة.",
-        'settings_text': "🌐 **إعدادات اللغة**\n\nاختر لغتك المفضلة لواجهة البوت وللمطابقة مع الشركاء:",
-        'settings_saved': "✅ تم تحديث اللغة إلى {lang_name}. اضغط /start لرؤية التغييرات.",
-        'admin_denied': "🚫 الوصول مرفوض. هذا الأمر مخصص للمدير فقط.",
-        'globally_banned': "🚫 تم إيقاف وصولك إلى هذا البوت بشكل دائم.",
-        'use_buttons_msg': "استخدم الأزرار أدناه للتحكم في الدردشة:",
-        'initial_selection_msg': "🌐 **مرحباً بك في بوت الدردشة العشوائية!**\n\nالرجاء اختيار لغتك المفضلة للمتابعة:", 
-        'cancel_op_btn': "❌ إلغاء", 
-        'join_channel_msg': r"👋 **مرحباً بك في شريك عشوائي 🎲\!**" + "\n\n"
-                            r"لاستخدام هذا البوت، يجب عليك الانضمام إلى قناتنا الرسمية\." + "\n\n"
-                            r"يرجى الانضمام للقناة عبر الزر أدناه، ثم اضغط '✅ لقد انضممت'\.",
-        'join_channel_btn': "انضم للقناة",
-        'joined_btn': "لقد انضممت",
-        'joined_success': r"🎉 **شكراً لانضمامك\!**" + "\n\n"
-                          r"يمكنك الآن استخدام البوت\. اضغط /start أو استخدم الأزرار أدناه\.",
-        'block_confirm_text': "🚫 **تأكيد الحظر والإبلاغ**\n\nهل أنت متأكد أنك تريد حظر الشريك الحالي وإرسال تقرير إلى فريق تليجرام التقني؟\n\n*(سيؤدي هذا الإجراء إلى إنهاء المحادثة فوراً.)*",
-        'block_cancelled': "🚫 تم إلغاء عملية الحظر/الإبلاغ. يمكنك متابعة الدردشة.",
-        'block_success': "🛑 شكراً لك! تم حظر المستخدم وتم إنهاء المحادثة.\n\nتم إرسال تقريرك للمراجعة بنجاح.\n\nاضغط التالي 🎲 للعثور على شريك جديد.",
-        'next_not_in_chat': "🔎 البحث عن شريك... يرجى الانتظار.",
-        'next_msg_user': "🔎 البحث عن شريك جديد...",
-        'next_already_searching': "أنت بالفعل تبحث. يرجى الانتظار...",
-        'block_not_in_chat': "أنت لست حالياً في محادثة لحظر أي شخص.",
-        'block_while_searching': "لا يمكنك الحظر أثناء البحث. استخدم 'إيقاف ⏹️' أولاً.",
-        'unreachable_partner': "يبدو أن شريكك قام بحظر البوت أو غادر تيليجرام. انتهت المحادثة.",
-        'not_in_chat_msg': "أنت لست في محادثة. اضغط 'بحث' للعثور على شريك.",
-        'partner_prefix': "صديق/ة🎲 : ",
-    },
-    'es': {
-        'language_name': "Español 🇪🇸",
-        'welcome': "¡Bienvenido a 🎲 **Compañero Aleatorio**\nEl Bot de Chat Anónimo!\n\nPresiona 'Buscar' para encontrar un compañero.",
-        'already_in_chat': "Actualmente estás en un chat. Usa los botones de abajo.",
-        'already_searching': "Actualmente estás en la cola de espera. Usa los botones de abajo.",
-        'search_btn': "Buscar 🔎",
-        'next_btn': "Siguiente 🎲",
-        'stop_btn': "Parar ⏹️",
-        'block_btn': "Bloquear Usuario 🚫",
-        'search_already_in_chat': "¡Ya estás en un chat! Presiona 'Parar' o 'Siguiente' primero.",
-        'search_already_searching': "Ya estás buscando. Por favor espera...",
-        'search_wait': "🔎 Buscando un compañero... Por favor espera.",
-        
-        # --- الإضافة المطلوبة (الإسبانية) ---
-        'partner_found': "✅ ¡Compañero encontrado! El chat ha comenzado. (Eres anónimo).",
-        'safety_alert': "🔥 ¡NUEVO COMPAÑERO! 🔥\n\n⚠️ **SEGURIDAD:** Si recibes contenido no deseado (spam, imágenes explícitas, etc.), presiona el botón **[Bloquear Usuario 🚫]** inmediatamente. Esta acción baneará permanentemente al abusador de nuestro sistema.",
-        'safe_chat_wish': "🥰 Te deseamos un chat agradable 🥰",
-        # --- نهاية الإضافة ---
-
-        'end_msg_user': "🔚 Has finalizado el chat.",
-        'end_msg_partner': "⚠️ Tu compañero ha abandonado el chat.",
-        'end_search_cancel': "Búsqueda cancelada.",
-        'end_not_in_chat': "Actualmente no estás en un chat ni buscando.",
-        'link_blocked': "⛔️ No puedes enviar enlaces (URLs) en el chat anónimo.",
-        'username_blocked': "⛔️ No puedes enviar identificadores de usuario (usernames) en el chat anónimo.",
-        'settings_text': "🌐 **Configuración de Idioma**\n\nSelecciona tu idioma preferido para la interfaz del bot y para emparejarته con compañeros:",
-        'settings_saved': "✅ Idioma actualizado a {lang_name}. Presiona /start para ver los cambios.",
-        'admin_denied': "🚫 Acceso denegado. Este comando es solo para el administrador.",
-        'globally_banned': "🚫 Tu acceso a este bot ha sido suspendido permanentemente.",
-        'use_buttons_msg': "Usa los botones de abajo para controlar el chat:",
-        'initial_selection_msg': "🌐 **¡Bienvenido al Bot de Chat Anónimo!**\n\nPor favor, selecciona tu idioma preferido para continuar con la configuración:", 
-        'cancel_op_btn': "❌ Anular", 
-        'join_channel_msg': r"👋 **¡Bienvenido a Compañero Aleatorio 🎲\!**" + "\n\n"
-                            r"Para usar este bot, se requiere que te unas a nuestro canal oficial\." + "\n\n"
-                            r"Por favor, únete al canal usando el botón de abajo, luego presiona '✅ Me he unido'\.",
-        'join_channel_btn': "Unirse al Canal",
-        'joined_btn': "Me he unido",
-        'joined_success': r"🎉 **¡Gracias por unirte\!**" + "\n\n"
-                          r"Ahora puedes usar el bot\. Presiona /start o usa los botones de abajo\.",
-        'block_confirm_text': "🚫 **CONFIRMAR BLOQUEO E INFORME**\n\n¿Estás seguro de que quieres bloquear al compañero actual y enviar un informe al Equipo de Telegram?\n\n*(Esta acción finalizará el chat inmediatamente.)*",
-        'block_cancelled': "🚫 Operación de Bloqueo/Informe cancelada. Puedes seguir chateando.",
-        'block_success': "🛑 ¡Gracias! El usuario ha sido bloqueado y el chat ha finalizado.\n\nTu informe ha sido enviado para revisión exitosamente.\n\nPresiona Siguiente 🎲 para encontrar un nuevo compañero.",
-        'next_not_in_chat': "🔎 Buscando un compañero... Por favor espera.",
-        'next_msg_user': "🔎 Buscando un nuevo compañero...",
-        'next_already_searching': "Ya estás buscando. Por favor espera...",
-        'block_not_in_chat': "No estás actualmente en un chat para bloquear a nadie.",
-        'block_while_searching': "No puedes bloquear a nadie mientras buscas. Usa 'Parar ⏹️' primero.",
-        'unreachable_partner': "Parece que tu compañero ha bloqueado al bot o dejó Telegram. El chat ha finalizado.",
-        'not_in_chat_msg': "No estás en un chat. Presiona 'Buscar' para encontrar un compañero.",
-        'partner_prefix': "tu amigo/a 🎲 : ",
-    }
-}
-DEFAULT_LANG = 'en'
-SUPPORTED_LANGUAGES = ['en', 'ar', 'es']
+# --- (1) Translation Catalogs and Helpers (ملفات الترجمة في مجلد locales) ---
+LOCALES_DIR = os.environ.get('LOCALES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'locales'))
+DEFAULT_LANG = os.environ.get('DEFAULT_LANG', 'en')
+# مفاتيح أزرار لوحة المفاتيح الرئيسية (نصوصها بكل اللغات تُوجَّه للأوامر)
+BUTTON_KEYS = ('search_btn', 'next_btn', 'block_btn', 'stop_btn')
+# طول عمود all_users.language (VARCHAR(5)): لغة باسم أطول لا يمكن حفظها لأي مستخدم
+LANGUAGE_CODE_MAX_LENGTH = 5
+
+class TranslationCatalogs:
+    """كتالوجات الترجمة من ملفات `<code>.json`. كل لغة تُقرأ عند أول استخدام وتُدمج فوق اللغة الافتراضية،
+    فيصبح البحث في _() قراءة واحدة من dict. يمكن إعادة التحميل أثناء التشغيل عبر reload()."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.languages = []  # نفس القائمة تبقى مشتركة (SUPPORTED_LANGUAGES) وتُحدّث في مكانها
+        self._catalogs = {}
+        self._button_keys = None
+        self.loads = 0
+        self.reloads = 0
+        self._scan()
+
+    def _scan(self):
+        codes = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.json'):
+                continue
+            code = name[:-len('.json')]
+            if len(code) > LANGUAGE_CODE_MAX_LENGTH:
+                logger.error(f"Ignoring catalog {name}: language code is longer than {LANGUAGE_CODE_MAX_LENGTH} characters.")
+                continue
+            codes.append(code)
+        if DEFAULT_LANG not in codes:
+            raise RuntimeError(f"No catalog for default language '{DEFAULT_LANG}' in {self.directory}")
+        # اللغة الافتراضية أولاً ثم البقية أبجدياً (ترتيب أزرار اختيار اللغة)
+        self.languages[:] = [DEFAULT_LANG] + [code for code in codes if code != DEFAULT_LANG]
+
+    def _read(self, lang_code):
+        with open(os.path.join(self.directory, f"{lang_code}.json"), encoding='utf-8') as catalog_file:
+            catalog = json.load(catalog_file)
+        if not isinstance(catalog, dict):
+            raise ValueError(f"Catalog {lang_code}.json must be a JSON object")
+        self.loads += 1
+        return catalog
+
+    def get(self, lang_code):
+        """الكتالوج المدمج للغة (أو للغة الافتراضية إذا لم تكن مدعومة)."""
+        catalog = self._catalogs.get(lang_code)
+        if catalog is not None:
+            return catalog
+        if lang_code not in self.languages:
+            return self.get(DEFAULT_LANG)
+        if lang_code == DEFAULT_LANG:
+            catalog = self._read(lang_code)
+        else:
+            catalog = {**self.get(DEFAULT_LANG), **self._read(lang_code)}
+        self._catalogs[lang_code] = catalog
+        logger.info(f"Loaded translation catalog '{lang_code}' ({len(catalog)} keys).")
+        return catalog
+
+    @property
+    def button_keys(self):
+        """نص الزر (بكل اللغات) -> مفتاحه في BUTTON_KEYS. يحمّل كل الكتالوجات عند أول استخدام."""
+        if self._button_keys is None:
+            self._button_keys = {self.get(code)[key]: key for code in self.languages for key in BUTTON_KEYS}
+        return self._button_keys
+
+    def reload(self):
+        """يعيد قراءة المجلد. الكتالوجات المحملة تُقرأ فوراً حتى يظهر أي خطأ قبل استبدال الحالية."""
+        previous_languages = list(self.languages)
+        self._scan()
+        catalogs, self._catalogs = self._catalogs, {}
+        try:
+            for lang_code in catalogs:
+                self.get(lang_code)
+        except Exception:
+            self.languages[:] = previous_languages
+            self._catalogs = catalogs
+            raise
+        self._button_keys = None
+        self.reloads += 1
+
+    def stats(self):
+        return f"languages={','.join(self.languages)}, loaded={len(self._catalogs)}, file_reads={self.loads}, reloads={self.reloads}"
+
+catalogs = TranslationCatalogs(LOCALES_DIR)
+SUPPORTED_LANGUAGES = catalogs.languages
 
 # --- (2) Utility Functions (Helpers) ---
 
 async def get_user_language(user_id):
-    """يجلب كود لغة المستخدم من قاعدة البيانات."""
+    """يجلب كود لغة المستخدم (من كاش الحالة أو قاعدة البيانات)."""
     if not db_pool: return DEFAULT_LANG
     try:
-        async with db_pool.acquire() as connection:
-            lang_code = await connection.fetchval("SELECT language FROM all_users WHERE user_id = $1", user_id)
-            return lang_code if lang_code in SUPPORTED_LANGUAGES else DEFAULT_LANG
+        lang_code = (await user_states.get(user_id)).language
+        return lang_code if lang_code in SUPPORTED_LANGUAGES else DEFAULT_LANG
     except Exception as e:
         logger.error(f"Failed to fetch language for {user_id}: {e}")
         return DEFAULT_LANG
 
 def _(key, lang_code):
     """دالة الترجمة. تسترجع الرسالة المناسبة باللغة المطلوبة."""
-    return LANGUAGES.get(lang_code, LANGUAGES[DEFAULT_LANG]).get(key, LANGUAGES[DEFAULT_LANG].get(key, 'MISSING TRANSLATION'))
-
-async def get_keyboard(lang_code):
-    """تنشئ لوحة المفاتيح بناءً على اللغة."""
-    keyboard_buttons = [
-        [
-            _('search_btn', lang_code), 
-            _('next_btn', lang_code)
-        ], 
-        [
-            _('block_btn', lang_code), 
-            _('stop_btn', lang_code)
-        ] 
-    ]
-    return ReplyKeyboardMarkup(keyboard_buttons, resize_keyboard=True)
-
-# --- URL and Username Pattern Definition ---
-URL_PATTERN = re.compile(
-    r'(https?://|www\.|t\.me/|t\.co/|telegram\.me/|telegram\.dog/)'
-    r'[\w\.-]+(\.[\w\.-]+)*([\w\-\._~:/\?#\[\]@!$&\'()*+,;=])*',
-    re.IGNORECASE
-)
+    return catalogs.get(lang_code).get(key, 'MISSING TRANSLATION')
+
+class LanguageTemplates:
+    """لوحات المفاتيح والرسائل الجاهزة للغة واحدة. كائنات تيليجرام هنا غير قابلة للتعديل فتُشارك بين كل الرسائل."""
+    __slots__ = ('keyboard', 'match_message', 'join_markup', 'block_confirm_text', 'block_confirm_label', 'block_cancel_button')
+
+    def __init__(self, lang_code):
+        self.keyboard = ReplyKeyboardMarkup(
+            [
+                [_('search_btn', lang_code), _('next_btn', lang_code)],
+                [_('block_btn', lang_code), _('stop_btn', lang_code)]
+            ],
+            resize_keyboard=True
+        )
+        # رسالة المطابقة: الترحيب + التنبيه الأمني + التمني
+        self.match_message = "\n\n".join((_('partner_found', lang_code), _('safety_alert', lang_code), _('safe_chat_wish', lang_code)))
+        self.join_markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton(_('join_channel_btn', lang_code), url=CHANNEL_INVITE_LINK),
+            InlineKeyboardButton("✅ " + _('joined_btn', lang_code), callback_data=f"check_join_{lang_code}")
+        ]])
+        self.block_confirm_text = _('block_confirm_text', lang_code)
+        self.block_confirm_label = "✅ " + _('block_btn', lang_code)
+        self.block_cancel_button = InlineKeyboardButton(_('cancel_op_btn', lang_code), callback_data=f"cancel_block_{lang_code}")
+
+class TemplateRegistry:
+    """سجل القوالب لكل اللغات. قوالب كل لغة تُبنى مرة واحدة عند أول استخدام وتُمسح عند إعادة تحميل الترجمات."""
+
+    def __init__(self):
+        self.rebuild()
+
+    def rebuild(self):
+        self._by_lang = {}
+        self._language_markups = {}
+
+    def _language_markup(self, callback_prefix):
+        markup = self._language_markups.get(callback_prefix)
+        if markup is None:
+            markup = self._language_markups[callback_prefix] = InlineKeyboardMarkup([
+                [InlineKeyboardButton(_('language_name', code), callback_data=f"{callback_prefix}{code}")]
+                for code in SUPPORTED_LANGUAGES
+            ])
+        return markup
+
+    @property
+    def settings_markup(self):
+        return self._language_markup("set_lang_")
+
+    @property
+    def initial_language_markup(self):
+        return self._language_markup("initial_set_lang_")
+
+    def get(self, lang_code):
+        templates = self._by_lang.get(lang_code)
+        if templates is None:
+            if lang_code not in SUPPORTED_LANGUAGES:
+                return self.get(DEFAULT_LANG)
+            templates = self._by_lang[lang_code] = LanguageTemplates(lang_code)
+        return templates
+
+def get_keyboard(lang_code):
+    """لوحة المفاتيح الرئيسية للغة (جاهزة مسبقاً في سجل القوالب)."""
+    return templates.get(lang_code).keyboard
+
+def reload_translations():
+    """يعيد تحميل الكتالوجات ويمسح القوالب المبنية منها. يرمي الخطأ ويبقي الترجمات الحالية إذا كان ملف تالفاً."""
+    catalogs.reload()
+    templates.rebuild()
+    logger.info(f"Translation catalogs reloaded: {catalogs.stats()}")
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """تُرجع مدة الانتظار المطلوبة من تيليجرام بالثواني (int أو timedelta حسب نسخة المكتبة)."""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+class TokenBucket:
+    """محدد معدل (token bucket): `rate` عملية في الثانية مع سماح بدفعة حتى `capacity`."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """يمنع أي عملية خلال `seconds` ثانية (بعد RetryAfter مثلاً)."""
+        self._refill()
+        self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+class PriorityTokenBucket(TokenBucket):
+    """TokenBucket يخدم المنتظرين حسب الأولوية (الرقم الأصغر أولاً) ثم بترتيب الوصول."""
+
+    def __init__(self, rate, capacity=1):
+        super().__init__(rate, capacity)
+        self._waiters = []
+        self._sequence = 0
+        self._server = None
+
+    async def acquire(self, priority=0):
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._sequence += 1
+        heapq.heappush(self._waiters, (priority, self._sequence, future))
+        if self._server is None or self._server.done():
+            self._server = asyncio.create_task(self._serve())
+        await future
+
+    async def _serve(self):
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():  # المنتظر أُلغي
+                heapq.heappop(self._waiters)
+                continue
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                heapq.heappop(self._waiters)
+                future.set_result(None)
+            else:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# أولويات الطلبات الصادرة (تُمرر عبر rate_limit_args)، الأصغر يُخدم أولاً
+PRIORITY_USER, PRIORITY_ARCHIVE, PRIORITY_BROADCAST = range(3)
+PRIORITY_NAMES = ('user', 'archive', 'broadcast')
+
+class OutboundScheduler(BaseRateLimiter):
+    """كل طلبات Bot API تمر من هنا (ApplicationBuilder.rate_limiter): token bucket عام بأولويات،
+    وحد لكل محادثة خاصة ولكل مجموعة/قناة على طلبات الإرسال، وإعادة المحاولة تلقائياً بعد RetryAfter.
+    RetryAfter لطلب موجه لمحادثة يوقف تلك المحادثة فقط، وبدون محادثة يوقف كل الطلبات."""
+
+    SEND_ENDPOINTS = ('send', 'copy', 'forward')
+
+    def __init__(self, rate, chat_rate, chat_burst, group_rate_per_minute, max_retries, max_chats=10000):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_minute / 60
+        self.group_burst = max(1, int(group_rate_per_minute // 4))
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        # دفعة صغيرة فقط: حد تيليجرام العام يُحسب على أي ثانية وليس كمتوسط
+        self._global = PriorityTokenBucket(rate, capacity=max(1, int(rate // 10)))
+        self._chats = OrderedDict()
+        self.sent = [0] * len(PRIORITY_NAMES)
+        self.waiting = [0] * len(PRIORITY_NAMES)
+        self.total_wait = [0.0] * len(PRIORITY_NAMES)
+        self.max_wait = [0.0] * len(PRIORITY_NAMES)
+        self.rate_limited = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is not None:
+            self._chats.move_to_end(chat_id)
+            return bucket
+        if str(chat_id).startswith(('-', '@')):
+            bucket = TokenBucket(self.group_rate, capacity=self.group_burst)
+        else:
+            bucket = TokenBucket(self.chat_rate, capacity=self.chat_burst)
+        self._chats[chat_id] = bucket
+        if len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if rate_limit_args is not None else PRIORITY_USER
+        chat_id = data.get('chat_id')
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None and endpoint.startswith(self.SEND_ENDPOINTS) else None
+
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            self.waiting[priority] += 1
+            try:
+                if chat_bucket:
+                    await chat_bucket.acquire()
+                await self._global.acquire(priority)
+            finally:
+                self.waiting[priority] -= 1
+            waited = time.monotonic() - started
+            self.total_wait[priority] += waited
+            self.max_wait[priority] = max(self.max_wait[priority], waited)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.rate_limited += 1
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_after_seconds(e)
+                (chat_bucket or self._global).pause(delay)
+                logger.warning(f"{endpoint} to {chat_id} hit flood control, retrying in {delay:.0f}s (attempt {attempt + 1}).")
+                continue
+            self.sent[priority] += 1
+            return result
+
+    def stats(self):
+        return {
+            name: {
+                'sent': self.sent[index],
+                'waiting': self.waiting[index],
+                'avg_wait_ms': round(self.total_wait[index] / max(1, self.sent[index]) * 1000, 1),
+                'max_wait_ms': round(self.max_wait[index] * 1000, 1),
+            }
+            for index, name in enumerate(PRIORITY_NAMES)
+        } | {'rate_limited': self.rate_limited, 'chats': len(self._chats)}
+
+outbound_scheduler = OutboundScheduler(OUTBOUND_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_RATE_PER_MINUTE, OUTBOUND_MAX_RETRIES)
+
+# --- Content Filter (منع الروابط واليوزرات في الدردشة المجهولة) ---
+
+class ContentVerdict:
+    """نتيجة فحص نص: القاعدة المطابقة ('link' أو 'username' أو None) والجزء المطابق ومدة الفحص بالثواني."""
+    __slots__ = ('rule', 'match', 'elapsed')
+
+    def __init__(self, rule, match, elapsed):
+        self.rule = rule
+        self.match = match
+        self.elapsed = elapsed
+
+class ContentFilter:
+    """يفحص النصوص بتعبير واحد مُجمّع لكل لغة حسب قواعد `content_filter` في كتالوج اللغة.
+    كل بديل في التعبير طوله محدود (بدون تكرار متداخل)، فالعمل عند كل موضع ثابت والفحص خطي في طول النص."""
+
+    # اليوزر: @ ليست بعد حرف (حتى لا يُعتبر البريد الإلكتروني يوزراً) ثم اسم تيليجرام صالح
+    USERNAME_PATTERN = r'(?<![\w@])@[a-z][a-z0-9_]{3,31}(?!\w)'
+
+    def __init__(self):
+        self._compiled = {}
+        self.checks = 0
+        self.blocked = {'link': 0, 'username': 0}
+        self.max_elapsed = 0.0
+        self._elapsed = deque(maxlen=1000)
+
+    @classmethod
+    def compile(cls, rules):
+        """يبني التعبير المُجمّع من القواعد. يُرجع None إذا لم توجد قاعدة مفعلة."""
+        links = []
+        if rules.get('link_schemes'):
+            links.append(r'(?<![a-z0-9+.-])(?:%s)://' % '|'.join(map(re.escape, rules['link_schemes'])))
+        if rules.get('link_prefixes'):
+            links.append(r'(?<![\w.-])(?:%s)[\w-]' % '|'.join(map(re.escape, rules['link_prefixes'])))
+        if rules.get('link_hosts'):
+            links.append(r'(?<![\w.-])(?:[\w-]{1,64}\.)?(?:%s)(?![\w.-])' % '|'.join(map(re.escape, rules['link_hosts'])))
+        if rules.get('bare_domain_tlds'):
+            links.append(r'(?<![\w@.-])(?:[a-z0-9-]{1,63}\.){1,4}(?:%s)(?![\w.-])' % '|'.join(map(re.escape, rules['bare_domain_tlds'])))
+        alternatives = []
+        if links:
+            alternatives.append('(?P<link>%s)' % '|'.join(links))
+        if rules.get('block_usernames'):
+            alternatives.append('(?P<username>%s)' % cls.USERNAME_PATTERN)
+        return re.compile('|'.join(alternatives), re.IGNORECASE) if alternatives else None
+
+    def _pattern(self, lang_code):
+        rules = catalogs.get(lang_code).get('content_filter', {})
+        cached = self._compiled.get(lang_code)
+        if cached is None or cached[0] is not rules:  # الكتالوج أعيد تحميله
+            cached = self._compiled[lang_code] = (rules, self.compile(rules))
+        return cached[1]
+
+    def check(self, text, lang_code):
+        pattern = self._pattern(lang_code)
+        started = time.perf_counter()
+        match = pattern.search(text) if pattern else None
+        elapsed = time.perf_counter() - started
+        self.checks += 1
+        self.max_elapsed = max(self.max_elapsed, elapsed)
+        self._elapsed.append(elapsed)
+        if match:
+            self.blocked[match.lastgroup] += 1
+            return ContentVerdict(match.lastgroup, match.group(), elapsed)
+        return ContentVerdict(None, None, elapsed)
+
+    def stats(self):
+        elapsed = sorted(self._elapsed)
+        p50 = elapsed[len(elapsed) // 2] if elapsed else 0.0
+        p99 = elapsed[max(int(len(elapsed) * 0.99) - 1, 0)] if elapsed else 0.0
+        return {
+            'checks': self.checks,
+            'links': self.blocked['link'],
+            'usernames': self.blocked['username'],
+            'p50_us': round(p50 * 1e6, 1),
+            'p99_us': round(p99 * 1e6, 1),
+            'max_us': round(self.max_elapsed * 1e6, 1),
+        }
+
+content_filter = ContentFilter()
 
 # --- Define Confirmation Keyboard ---
-async def get_confirmation_keyboard(reported_id, lang_code):
-    """لوحة تأكيد الحظر بناءً على اللغة."""
-    confirm_text = _('block_confirm_text', lang_code)
-    cancel_text = _('cancel_op_btn', lang_code) 
-    
-    keyboard = [
-        [InlineKeyboardButton("✅ " + _('block_btn', lang_code), callback_data=f"confirm_block_{reported_id}_{lang_code}")],
-        [InlineKeyboardButton(cancel_text, callback_data=f"cancel_block_{lang_code}")]
-    ]
-    return InlineKeyboardMarkup(keyboard), confirm_text
+def get_confirmation_keyboard(reported_id, lang_code):
+    """لوحة تأكيد الحظر بناءً على اللغة. زر التأكيد فقط يتغير (يحمل ID المستخدم)، والباقي من القوالب."""
+    lang_templates = templates.get(lang_code)
+    keyboard = (
+        (InlineKeyboardButton(lang_templates.block_confirm_label, callback_data=f"confirm_block_{reported_id}_{lang_code}"),),
+        (lang_templates.block_cancel_button,)
+    )
+    return InlineKeyboardMarkup(keyboard), lang_templates.block_confirm_text
+
+templates = TemplateRegistry()
 
 # --- (3) Database Helper Functions ---
 
+class UserState:
+    """حالة المستخدم كما هي في قاعدة البيانات: اللغة، الحظر الشامل، والشريك.
+    (حالة الانتظار يملكها محرك المطابقة `matchmaker`)."""
+    __slots__ = ('exists', 'language', 'banned', 'partner_id')
+
+    def __init__(self, exists=False, language=None, banned=False, partner_id=None):
+        self.exists = exists
+        self.language = language
+        self.banned = banned
+        self.partner_id = partner_id
+
+class UserStateCache:
+    """كاش LRU لحالة المستخدمين. يُحمّل الحالة كاملة باستعلام واحد ويُحدَّث مباشرة (write-through) عند كل كتابة."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._states = OrderedDict()
+        self._inflight = {}  # user_id -> Future لتوحيد التحميلات المتزامنة لنفس المستخدم
+        self._stale = set()  # مستخدمون تغيرت حالتهم أثناء تحميلها من قاعدة البيانات
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, user_id):
+        state = self._states.get(user_id)
+        if state is not None:
+            self._states.move_to_end(user_id)
+            self.hits += 1
+            return state
+        self.misses += 1
+        inflight = self._inflight.get(user_id)
+        if inflight is not None:
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise  # أُلغي المنتظر نفسه
+            # أُلغيت المهمة التي كانت تحمّل الحالة: نحمّلها من جديد
+            return await self.get(user_id)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[user_id] = future
+        try:
+            state = await _load_user_state(user_id)
+            # إذا تغيرت الحالة أثناء التحميل لا نخزن نتيجة قد تكون قديمة
+            if user_id not in self._stale:
+                self._store(user_id, state)
+            future.set_result(state)
+            return state
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # تجنب تحذير "exception was never retrieved"
+            raise
+        finally:
+            self._inflight.pop(user_id, None)
+            self._stale.discard(user_id)
+            if not future.done():
+                # CancelledError ليس Exception: نلغي المستقبل المشترك حتى لا يعلق المنتظرون عليه للأبد
+                future.cancel()
+
+    def _store(self, user_id, state):
+        self._states[user_id] = state
+        self._states.move_to_end(user_id)
+        while len(self._states) > self.max_size:
+            self._states.popitem(last=False)
+
+    def update(self, user_id, **fields):
+        """يحدّث الحالة المخزنة بعد كتابة ناجحة في قاعدة البيانات. تُرجع False إذا لم تكن الحالة مخزنة."""
+        if user_id in self._inflight:
+            self._stale.add(user_id)
+        state = self._states.get(user_id)
+        if state is None:
+            return False
+        for name, value in fields.items():
+            setattr(state, name, value)
+        return True
+
+    def put(self, user_id, state):
+        """يخزن حالة معروفة بالكامل (مثلاً بعد مطابقة لم تُكتب بعد في قاعدة البيانات)."""
+        if user_id in self._inflight:
+            self._stale.add(user_id)
+        self._store(user_id, state)
+
+    def invalidate(self, user_id):
+        if user_id in self._inflight:
+            self._stale.add(user_id)
+        self._states.pop(user_id, None)
+
+    def clear(self):
+        """يفرغ الكاش كله (مثلاً بعد استيراد بالجملة تجاوز الكتابة عبره)."""
+        self._stale.update(self._inflight)
+        self._states.clear()
+
+    def peek(self, user_id):
+        """تُرجع الحالة المخزنة دون تحميل من قاعدة البيانات ودون احتساب hit/miss."""
+        return self._states.get(user_id)
+
+    def stats(self):
+        return {'size': len(self._states), 'hits': self.hits, 'misses': self.misses}
+
+user_states = UserStateCache(USER_STATE_CACHE_MAX_SIZE)
+
+USER_STATE_QUERY = """
+    SELECT
+        (SELECT language FROM all_users WHERE user_id = $1) AS language,
+        EXISTS (SELECT 1 FROM all_users WHERE user_id = $1) AS user_exists,
+        EXISTS (SELECT 1 FROM global_bans WHERE user_id = $1) AS banned,
+        (SELECT partner_id FROM active_chats WHERE user_id = $1) AS partner_id
+"""
+IS_WAITING_QUERY = "SELECT 1 FROM waiting_queue WHERE user_id = $1"
+
+# استعلامات المسار الساخن: تُحضّر على كل اتصال جديد (في كاش asyncpg) قبل أول استخدام
+HOT_QUERIES = (USER_STATE_QUERY, IS_WAITING_QUERY)
+
+async def _load_user_state(user_id):
+    """يحمّل حالة المستخدم كاملة في رحلة واحدة إلى قاعدة البيانات."""
+    async with db_pool.acquire() as connection:
+        row = await connection.fetchrow(USER_STATE_QUERY, user_id)
+    pending_language = user_writes.pending_language(user_id)
+    return UserState(
+        exists=row['user_exists'] or pending_language is not None,
+        language=pending_language or row['language'],
+        banned=row['banned'],
+        partner_id=row['partner_id']
+    )
+
+class Matchmaker:
+    """محرك المطابقة في الذاكرة: طابور FIFO لكل لغة وجدول حظر لكل مستخدم.
+    قاعدة البيانات تبقى السجل الدائم، ويُعاد بناء الطوابير منها عند التشغيل."""
+
+    def __init__(self):
+        self._queues = {}        # lang_code -> OrderedDict(user_id -> None) بترتيب الانتظار
+        self._queued_lang = {}   # user_id -> lang_code
+        self._blocks = {}        # blocker_id -> set(blocked_id)
+
+    def is_waiting(self, user_id):
+        return user_id in self._queued_lang
+
+    def enqueue(self, user_id, lang_code, front=False):
+        if user_id in self._queued_lang:
+            return False
+        queue = self._queues.setdefault(lang_code, OrderedDict())
+        queue[user_id] = None
+        if front:
+            # إعادة المستخدم لمقدمة الطابور (مثلاً بعد التراجع عن مطابقة فاشلة)
+            queue.move_to_end(user_id, last=False)
+        self._queued_lang[user_id] = lang_code
+        return True
+
+    def remove(self, user_id):
+        lang_code = self._queued_lang.pop(user_id, None)
+        if lang_code is None:
+            return False
+        self._queues[lang_code].pop(user_id, None)
+        return True
+
+    def set_language(self, user_id, lang_code):
+        """ينقل المستخدم المنتظر إلى طابور لغته الجديدة. تُرجع True إذا تم النقل."""
+        if self._queued_lang.get(user_id) in (None, lang_code):
+            return False
+        self.remove(user_id)
+        self.enqueue(user_id, lang_code)
+        return True
+
+    def add_block(self, blocker_id, blocked_id):
+        self._blocks.setdefault(blocker_id, set()).add(blocked_id)
+
+    def _is_blocked(self, user_a, user_b):
+        return user_b in self._blocks.get(user_a, ()) or user_a in self._blocks.get(user_b, ())
+
+    def pop_partner(self, user_id, lang_code):
+        """يسحب أقدم منتظر بنفس اللغة لا يوجد حظر بينه وبين المستخدم."""
+        queue = self._queues.get(lang_code)
+        if not queue:
+            return None
+        for candidate_id in queue:
+            if candidate_id != user_id and not self._is_blocked(user_id, candidate_id):
+                del queue[candidate_id]
+                del self._queued_lang[candidate_id]
+                return candidate_id
+        return None
+
+    def load(self, waiting_rows, block_rows):
+        self._queues.clear()
+        self._queued_lang.clear()
+        self._blocks.clear()
+        for row in block_rows:
+            self.add_block(row['blocker_id'], row['blocked_id'])
+        for row in waiting_rows:
+            self.enqueue(row['user_id'], row['language'])
+
+    def stats(self):
+        return {lang_code: len(queue) for lang_code, queue in self._queues.items() if queue}
+
+matchmaker = Matchmaker()
+
+class BackgroundDBWriter:
+    """ينفّذ عمليات الكتابة في قاعدة البيانات بالترتيب في الخلفية حتى لا تنتظرها المعالجات."""
+
+    def __init__(self):
+        self._queue = None
+        self._task = None
+        self.failures = 0
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, statements):
+        """يضيف مجموعة استعلامات [(query, args), ...] تُنفّذ معاً في معاملة واحدة. يُرجع Future."""
+        future = asyncio.get_running_loop().create_future()
+        if self._queue is None:
+            future.set_result(None)
+            return future
+        self._queue.put_nowait((statements, future))
+        return future
+
+    def pending(self):
+        return self._queue.qsize() if self._queue else 0
+
+    def flush(self):
+        """Future يكتمل بعد تنفيذ كل الكتابات التي أُرسلت قبله."""
+        return self.submit([])
+
+    async def _run(self):
+        while True:
+            statements, future = await self._queue.get()
+            try:
+                async with db_pool.acquire() as connection:
+                    async with connection.transaction():
+                        for query, args in statements:
+                            await connection.execute(query, *args)
+                if not future.done():
+                    future.set_result(None)
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Background DB write failed: {e}")
+                if not future.done():
+                    future.set_exception(e)
+                    future.exception()  # تجنب تحذير "exception was never retrieved"
+            finally:
+                self._queue.task_done()
+
+    async def stop(self):
+        """ينتظر تنفيذ كل الكتابات المعلقة ثم يوقف العامل."""
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        self._task = None
+
+db_writer = BackgroundDBWriter()
+
+USERS_UPSERT = """
+    INSERT INTO all_users (user_id, language)
+    SELECT * FROM unnest($1::bigint[], $2::varchar[])
+    ON CONFLICT (user_id) DO UPDATE SET language = EXCLUDED.language
+"""
+WAIT_QUEUE_LANGUAGE_UPDATE = """
+    UPDATE waiting_queue w SET language = v.language
+    FROM unnest($1::bigint[], $2::varchar[]) AS v (user_id, language)
+    WHERE w.user_id = v.user_id
+"""
+BLOCKS_INSERT = """
+    INSERT INTO user_blocks (blocker_id, blocked_id)
+    SELECT * FROM unnest($1::bigint[], $2::bigint[])
+    ON CONFLICT (blocker_id, blocked_id) DO NOTHING
+"""
+
+class WriteBehindBuffer:
+    """يجمع كتابات all_users وuser_blocks في الذاكرة ويكتبها بأمر INSERT متعدد الصفوف كل فترة قصيرة
+    (أو فور بلوغ حجم الدفعة). آخر لغة لنفس المستخدم تُلغي ما قبلها. يُفرّغ بالكامل عند الإيقاف.
+    الكتابات المعلقة تظهر في الحالة المحمّلة من قاعدة البيانات عبر pending_language.
+    إذا رفضت قاعدة البيانات الدفعة تُكتب صفاً صفاً ويُسقط الصف المرفوض وحده؛ وإذا تعذر الاتصال
+    تُعاد المحاولة بمهلة متضاعفة حتى max_retries مرة ثم تُسقط الدفعة."""
+
+    def __init__(self, interval, batch_size, max_retries):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self._retries = 0     # محاولات متتالية فاشلة للدفعة المعلقة
+        self._users = {}      # user_id -> language
+        self._blocks = set()  # (blocker_id, blocked_id)
+        self._flushing = {}   # كتابات المستخدمين في الدفعة الجاري تنفيذها
+        self._wakeup = None
+        self._lock = asyncio.Lock()
+        self._task = None
+        self.flushes = 0
+        self.rows = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.dropped = 0
+        self.max_flush = 0.0
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def pending(self):
+        return len(self._users) + len(self._blocks)
+
+    def pending_language(self, user_id):
+        """لغة كُتبت في الذاكرة ولم تصل قاعدة البيانات بعد (أو None)."""
+        language = self._users.get(user_id)
+        return language if language is not None else self._flushing.get(user_id)
+
+    def upsert_user(self, user_id, language):
+        if user_id in self._users:
+            self.coalesced += 1
+        self._users[user_id] = language
+        self._wake_if_full()
+
+    def add_block(self, blocker_id, blocked_id):
+        self._blocks.add((blocker_id, blocked_id))
+        self._wake_if_full()
+
+    def _wake_if_full(self):
+        if self._wakeup is not None and self.pending() >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), min(self.interval * 2 ** self._retries, 30))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """يكتب كل ما هو معلق في معاملة واحدة. الاستدعاءات المتزامنة تنتظر الدفعة الجارية (group commit)."""
+        async with self._lock:
+            if not self.pending() or not db_pool:
+                return
+            users, self._users = self._users, {}
+            blocks, self._blocks = self._blocks, set()
+            self._flushing = users
+            started = time.perf_counter()
+            written = len(users) + len(blocks)
+            try:
+                async with db_pool.acquire() as connection:
+                    try:
+                        await self._write(connection, users, blocks)
+                    except asyncpg.PostgresError as e:
+                        # صف واحد مرفوض (مثلاً لغة أطول من العمود) لا يجب أن يوقف كتابات كل المستخدمين
+                        logger.warning(f"Write-behind batch of {len(users)} users and {len(blocks)} blocks rejected ({e}). Writing row by row.")
+                        written = await self._write_rows(connection, users, blocks)
+            except Exception as e:
+                self.failures += 1
+                self._retry(users, blocks, e)
+                return
+            finally:
+                self._flushing = {}
+            self._retries = 0
+            self.flushes += 1
+            self.rows += written
+            self.max_flush = max(self.max_flush, time.perf_counter() - started)
+
+    async def _write(self, connection, users, blocks):
+        async with connection.transaction():
+            if users:
+                user_ids, languages = list(users), list(users.values())
+                await connection.execute(USERS_UPSERT, user_ids, languages)
+                if CLUSTER_MODE:
+                    await connection.execute(WAIT_QUEUE_LANGUAGE_UPDATE, user_ids, languages)
+                    await notify_user_state(connection, *user_ids)
+            if blocks:
+                await connection.execute(BLOCKS_INSERT, [b[0] for b in blocks], [b[1] for b in blocks])
+
+    async def _write_rows(self, connection, users, blocks):
+        """يكتب كل صف في معاملة مستقلة ويُسقط الصفوف التي ترفضها قاعدة البيانات. يحذف من users وblocks
+        ما انتهى أمره، فإذا انقطع الاتصال في المنتصف يبقى فيهما ما لم يُكتب بعد. يُرجع عدد الصفوف المكتوبة."""
+        written = 0
+        rows = [({user_id: language}, set()) for user_id, language in users.items()] + [({}, {block}) for block in blocks]
+        for row_users, row_blocks in rows:
+            try:
+                await self._write(connection, row_users, row_blocks)
+                written += 1
+            except asyncpg.PostgresError as e:
+                self.dropped += 1
+                logger.error(f"Write-behind dropped {row_users or row_blocks}: {e}")
+            for user_id in row_users:
+                del users[user_id]
+            blocks -= row_blocks
+        return written
+
+    def _retry(self, users, blocks, error):
+        """تعاد الدفعة للمحاولة التالية دون الكتابة فوق تحديثات أحدث وصلت أثناء المحاولة، أو تُسقط بعد max_retries."""
+        self._retries += 1
+        if self._retries > self.max_retries:
+            self.dropped += len(users) + len(blocks)
+            self._retries = 0
+            logger.error(f"Write-behind dropped {len(users)} users and {len(blocks)} blocks after {self.max_retries} retries: {error}")
+            return
+        logger.error(f"Write-behind flush of {len(users)} users and {len(blocks)} blocks failed (attempt {self._retries}): {error}")
+        for user_id, language in users.items():
+            self._users.setdefault(user_id, language)
+        self._blocks |= blocks
+
+    async def stop(self):
+        """يوقف المؤقت ثم يكتب كل ما تبقى."""
+        if self._task is not None:
+            async with self._lock:  # لا نلغي المؤقت في منتصف دفعة سُحبت من الذاكرة
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self.pending():
+            logger.error(f"Write-behind buffer stopped with {self.pending()} unwritten rows.")
+
+    def stats(self):
+        return {
+            'pending': self.pending(),
+            'flushes': self.flushes,
+            'rows': self.rows,
+            'coalesced': self.coalesced,
+            'failures': self.failures,
+            'dropped': self.dropped,
+            'max_flush_ms': round(self.max_flush * 1000, 2),
+        }
+
+user_writes = WriteBehindBuffer(USER_WRITE_FLUSH_INTERVAL, USER_WRITE_BATCH_SIZE, USER_WRITE_MAX_RETRIES)
+
+async def load_matchmaking_state():
+    """يعيد بناء طوابير الانتظار وجدول الحظر في الذاكرة من قاعدة البيانات."""
+    async with db_pool.acquire() as connection:
+        waiting_rows = await connection.fetch(
+            """
+            SELECT w.user_id, au.language
+            FROM waiting_queue w
+            JOIN all_users au ON w.user_id = au.user_id
+            WHERE w.user_id NOT IN (SELECT user_id FROM global_bans)
+            ORDER BY w."timestamp" ASC
+            """
+        )
+        block_rows = await connection.fetch("SELECT blocker_id, blocked_id FROM user_blocks")
+    matchmaker.load(waiting_rows, block_rows)
+    logger.info(f"Matchmaking state rebuilt: {len(waiting_rows)} waiting users, {len(block_rows)} blocks.")
+
+class BanBloomFilter:
+    """مرشح Bloom مضغوط لمعرفات المحظورين. النتيجة السلبية مؤكدة (بدون أي استعلام)،
+    والإيجابية تعني "ربما" ويتم التحقق منها بدقة من حالة المستخدم."""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = max(capacity, 1)
+        self.size = max(64, int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.negatives = 0
+        self.maybes = 0
+
+    def _positions(self, user_id):
+        # double hashing: h1 + i*h2 على معرف المستخدم (64-bit)
+        h1 = (user_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h2 = ((user_id ^ (user_id >> 31)) * 0xBF58476D1CE4E5B9 & 0xFFFFFFFFFFFFFFFF) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, user_id):
+        is_new = False
+        for position in self._positions(user_id):
+            mask = 1 << (position & 7)
+            if not self._bits[position >> 3] & mask:
+                self._bits[position >> 3] |= mask
+                is_new = True
+        if is_new:
+            self.count += 1
+
+    def might_contain(self, user_id):
+        for position in self._positions(user_id):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                self.negatives += 1
+                return False
+        self.maybes += 1
+        return True
+
+    def stats(self):
+        return {'bans': self.count, 'kib': len(self._bits) // 1024, 'negatives': self.negatives, 'maybes': self.maybes}
+
+ban_filter = BanBloomFilter(BAN_FILTER_CAPACITY, BAN_FILTER_ERROR_RATE)
+
+ban_filter_loading = []  # لكل تحميل جارٍ للمرشح: معرفات الحظر التي وصلت أثناء قراءة الجدول
+
+async def load_ban_filter():
+    """يبني مرشح الحظر من جدول global_bans (عند التشغيل وبعد إعادة الاتصال أو الاستيراد بالجملة).
+    الحظر الذي يصل أثناء القراءة يُضاف للمرشح الجديد قبل استبدال القديم، فلا يضيع مع المرشح القديم."""
+    global ban_filter
+    arrived = set()
+    ban_filter_loading.append(arrived)
+    try:
+        async with db_pool.acquire() as connection:
+            banned_ids = [row['user_id'] for row in await connection.fetch("SELECT user_id FROM global_bans")]
+    finally:
+        ban_filter_loading.remove(arrived)
+    # سعة مضاعفة لترك مجال للحظر الجديد دون رفع نسبة الخطأ
+    new_filter = BanBloomFilter(max(BAN_FILTER_CAPACITY, len(banned_ids) * 2), BAN_FILTER_ERROR_RATE)
+    for banned_id in (*banned_ids, *arrived):
+        new_filter.add(banned_id)
+    ban_filter = new_filter
+    logger.info(f"Ban filter loaded with {len(banned_ids)} banned users ({ban_filter.stats()['kib']} KiB).")
+    return banned_ids
+
+def apply_global_ban(user_id):
+    """يحدّث حالة الحظر في الذاكرة فوراً (محلياً أو عند وصول إشعار من نسخة أخرى)."""
+    ban_filter.add(user_id)
+    for arrived in ban_filter_loading:
+        arrived.add(user_id)
+    user_states.update(user_id, banned=True)
+
 async def is_user_globally_banned(user_id):
     """يتحقق مما إذا كان المستخدم محظوراً بشكل شامل."""
     if not db_pool: return False
-    async with db_pool.acquire() as connection:
-        return await connection.fetchval("SELECT 1 FROM global_bans WHERE user_id = $1", user_id) is not None
+    if not ban_filter.might_contain(user_id):
+        return False
+    return (await user_states.get(user_id)).banned
+
+# --- Cross-instance Notifications (LISTEN/NOTIFY) ---
+
+db_listener = None
+db_listener_reconnect = None  # مهمة إعادة الاتصال الجارية (إن وجدت)
+
+def _on_ban_notification(connection, pid, channel, payload):
+    # ID واحد أو عدة IDs مفصولة بفواصل (الحظر بالجملة)
+    try:
+        for raw_id in payload.split(','):
+            apply_global_ban(int(raw_id))
+    except ValueError:
+        logger.warning(f"Ignoring malformed {channel} notification: {payload!r}")
+
+def _on_user_state_notification(connection, pid, channel, payload):
+    """نسخة أخرى غيّرت شريك أو لغة مستخدمين: نحذف حالتهم من الكاش لتُحمّل من جديد."""
+    instance_id, _sep, user_ids = payload.partition(':')
+    if instance_id == INSTANCE_ID:
+        return
+    for raw_id in user_ids.split(','):
+        try:
+            user_states.invalidate(int(raw_id))
+        except ValueError:
+            logger.warning(f"Ignoring malformed {channel} notification: {payload!r}")
+
+def _on_translations_notification(connection, pid, channel, payload):
+    """نسخة أخرى أعادت تحميل الترجمات (بعد /reloadlang): نفعل المثل."""
+    if payload == INSTANCE_ID:
+        return
+    try:
+        reload_translations()
+    except Exception as e:
+        logger.error(f"Failed to reload translation catalogs: {e}")
+
+async def _on_bulk_import_notification(connection, pid, channel, payload):
+    """أداة الاستيراد بالجملة (python tools.py import) كتبت في جدول مباشرة: نعيد تحميل ما نحتفظ به منه في الذاكرة."""
+    try:
+        if payload == 'global_bans':
+            unqueued = []
+            for banned_id in await load_ban_filter():
+                user_states.update(banned_id, banned=True)
+                if matchmaker.remove(banned_id):
+                    unqueued.append(banned_id)
+            if unqueued:
+                db_writer.submit([("DELETE FROM waiting_queue WHERE user_id = ANY($1::bigint[])", (unqueued,))])
+        elif payload == 'user_blocks':
+            if not CLUSTER_MODE:
+                async with db_pool.acquire() as db_connection:
+                    for row in await db_connection.fetch("SELECT blocker_id, blocked_id FROM user_blocks"):
+                        matchmaker.add_block(row['blocker_id'], row['blocked_id'])
+        elif payload == 'all_users':
+            user_states.clear()
+        else:
+            logger.warning(f"Ignoring malformed {channel} notification: {payload!r}")
+            return
+        logger.info(f"Reloaded in-memory state after bulk import into {payload}.")
+    except Exception as e:
+        logger.error(f"Failed to reload state after bulk import into {payload}: {e}")
+
+async def notify_user_state(connection, *user_ids):
+    """يبلغ بقية النسخ (في وضع العنقود) بأن حالة هؤلاء المستخدمين تغيرت. يُرسل عند نجاح المعاملة."""
+    if CLUSTER_MODE:
+        # حمولة NOTIFY محدودة بـ 8000 بايت: الدفعات الكبيرة تُرسل على عدة إشعارات
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            await connection.execute("SELECT pg_notify('user_state', $1)", f"{INSTANCE_ID}:" + ",".join(str(user_id) for user_id in chunk))
+
+# القنوات التي تستمع لها كل نسخة من البوت ومعالج كل منها
+LISTEN_CHANNELS = {
+    'global_bans': _on_ban_notification,
+    'user_state': _on_user_state_notification,
+    'translations': _on_translations_notification,
+    'bulk_import': _on_bulk_import_notification,
+}
+
+async def _connect_db_listener():
+    connection = await asyncpg.connect(DATABASE_URL)
+    for channel, callback in LISTEN_CHANNELS.items():
+        await connection.add_listener(channel, callback)
+    connection.add_termination_listener(_on_db_listener_terminated)
+    return connection
+
+async def start_db_listener():
+    """يفتح اتصالاً مخصصاً للاستماع لإشعارات Postgres من النسخ الأخرى، ويعيد فتحه تلقائياً إذا انقطع."""
+    global db_listener
+    db_listener = await _connect_db_listener()
+
+def _on_db_listener_terminated(connection):
+    global db_listener_reconnect
+    if connection is not db_listener or db_listener_reconnect is not None:
+        return  # إغلاق مقصود (stop_db_listener) أو إعادة اتصال جارية
+    logger.error("Lost the LISTEN connection to the database. Reconnecting...")
+    db_listener_reconnect = asyncio.get_running_loop().create_task(_reconnect_db_listener())
+
+async def _reconnect_db_listener():
+    global db_listener, db_listener_reconnect
+    delay = 1
+    try:
+        while True:
+            try:
+                connection = await _connect_db_listener()
+                break
+            except Exception as e:
+                logger.error(f"Failed to reconnect the LISTEN connection: {e}. Retrying in {delay}s.")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+        db_listener = connection
+        # إشعارات فترة الانقطاع ضاعت: حالة المستخدمين المخزنة (في وضع العنقود) والحظر قد يكونان قديمين
+        if CLUSTER_MODE:
+            user_states.clear()
+        await load_ban_filter()
+        logger.info("LISTEN connection to the database restored.")
+    finally:
+        db_listener_reconnect = None
+
+async def stop_db_listener():
+    global db_listener
+    if db_listener_reconnect is not None:
+        db_listener_reconnect.cancel()
+    if db_listener is not None:
+        connection, db_listener = db_listener, None
+        await connection.close()
+
+# --- Schema Migrations (ترحيلات المخطط المرقمة) ---
+# كل ترحيل يُنفذ مرة واحدة داخل معاملة ويُسجل رقمه في schema_migrations.
+# لا تعدّل ترحيلاً تم نشره؛ أضف ترحيلاً جديداً برقم أكبر.
+MIGRATIONS = [
+    (1, 'initial_schema', [
+        '''
+        CREATE TABLE IF NOT EXISTS all_users (
+            user_id BIGINT PRIMARY KEY,
+            language VARCHAR(5) DEFAULT 'en'
+        );
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS active_chats (
+            user_id BIGINT PRIMARY KEY,
+            partner_id BIGINT NOT NULL UNIQUE
+        );
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS waiting_queue (
+            user_id BIGINT PRIMARY KEY,
+            "timestamp" TIMESTAMPTZ DEFAULT NOW()
+        );
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_blocks (
+            blocker_id BIGINT,
+            blocked_id BIGINT,
+            PRIMARY KEY (blocker_id, blocked_id)
+        );
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS global_bans (
+            user_id BIGINT PRIMARY KEY
+        );
+        ''',
+    ]),
+    (2, 'waiting_queue_timestamptz', [
+        # الجداول القديمة قد تحمل نوعاً غير TIMESTAMPTZ (بسبب TIMESTZ في النسخ السابقة)
+        '''
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'waiting_queue' AND column_name = 'timestamp'
+                  AND data_type = 'timestamp without time zone'
+            ) THEN
+                ALTER TABLE waiting_queue ALTER COLUMN "timestamp" TYPE TIMESTAMPTZ USING "timestamp" AT TIME ZONE 'UTC';
+            END IF;
+        END $$;
+        ''',
+        'ALTER TABLE waiting_queue ALTER COLUMN "timestamp" SET DEFAULT NOW();',
+        'UPDATE waiting_queue SET "timestamp" = NOW() WHERE "timestamp" IS NULL;',
+        'ALTER TABLE waiting_queue ALTER COLUMN "timestamp" SET NOT NULL;',
+    ]),
+    (3, 'broadcast_jobs', [
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id BIGSERIAL PRIMARY KEY,
+            from_chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            cleaned_message TEXT,
+            is_media BOOLEAN NOT NULL DEFAULT FALSE,
+            status VARCHAR(16) NOT NULL DEFAULT 'running',
+            cursor_user_id BIGINT NOT NULL DEFAULT 0,
+            success_count INTEGER NOT NULL DEFAULT 0,
+            fail_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            finished_at TIMESTAMPTZ
+        );
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id BIGINT NOT NULL REFERENCES broadcast_jobs (job_id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            status VARCHAR(16) NOT NULL,
+            delivered_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (job_id, user_id)
+        );
+        ''',
+    ]),
+    (4, 'matchmaking_indexes', [
+        # اللغة تُنسخ إلى waiting_queue حتى يغطي فهرس واحد (language, timestamp) استعلام المطابقة
+        'ALTER TABLE waiting_queue ADD COLUMN IF NOT EXISTS language VARCHAR(5);',
+        '''
+        UPDATE waiting_queue w SET language = au.language
+        FROM all_users au
+        WHERE au.user_id = w.user_id AND w.language IS NULL;
+        ''',
+        'CREATE INDEX IF NOT EXISTS waiting_queue_language_timestamp_idx ON waiting_queue (language, "timestamp") INCLUDE (user_id);',
+        'CREATE INDEX IF NOT EXISTS waiting_queue_timestamp_idx ON waiting_queue ("timestamp");',
+        'CREATE INDEX IF NOT EXISTS all_users_language_idx ON all_users (language);',
+        'CREATE INDEX IF NOT EXISTS user_blocks_blocked_id_idx ON user_blocks (blocked_id, blocker_id);',
+        "CREATE INDEX IF NOT EXISTS broadcast_jobs_active_idx ON broadcast_jobs (job_id) WHERE status IN ('running', 'paused');",
+    ]),
+    (5, 'chat_functions', [
+        # كل ضغطة (إنهاء / التالي / حظر) تصبح استدعاء دالة واحداً = رحلة واحدة لقاعدة البيانات.
+        # p_instance يُمرر في وضع العنقود فقط ليُرسل إشعار user_state لبقية النسخ.
+        '''
+        CREATE OR REPLACE FUNCTION end_chat(p_user_id BIGINT, p_instance TEXT DEFAULT NULL)
+        RETURNS BIGINT LANGUAGE plpgsql AS $$
+        DECLARE
+            v_partner BIGINT;
+        BEGIN
+            SELECT partner_id INTO v_partner FROM active_chats WHERE user_id = p_user_id;
+            IF v_partner IS NULL THEN
+                RETURN NULL;
+            END IF;
+            -- الطرفان قد ينهيان المحادثة معاً: قفل على الزوج ثم حذف الصفين بأمر واحد
+            PERFORM pg_advisory_xact_lock(hashtext('chat:' || LEAST(p_user_id, v_partner)));
+            DELETE FROM active_chats
+            WHERE (user_id = p_user_id AND partner_id = v_partner) OR (user_id = v_partner AND partner_id = p_user_id);
+            IF NOT FOUND THEN
+                RETURN NULL;  -- الطرف الآخر أنهاها أولاً
+            END IF;
+            IF p_instance IS NOT NULL THEN
+                PERFORM pg_notify('user_state', p_instance || ':' || p_user_id || ',' || v_partner);
+            END IF;
+            RETURN v_partner;
+        END;
+        $$;
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION match_or_enqueue(p_user_id BIGINT, p_language VARCHAR, p_instance TEXT DEFAULT NULL)
+        RETURNS BIGINT LANGUAGE plpgsql AS $$
+        DECLARE
+            v_partner BIGINT;
+        BEGIN
+            PERFORM pg_advisory_xact_lock(hashtext('match:' || p_language));
+            -- نسخة أخرى طابقت المستخدم للتو (وأعلنت المطابقة): لا نطابقه مرة ثانية ولا نعيده للطابور
+            IF EXISTS (SELECT 1 FROM active_chats WHERE user_id = p_user_id) THEN
+                RETURN NULL;
+            END IF;
+            SELECT w.user_id INTO v_partner
+            FROM waiting_queue w
+            WHERE w.language = p_language
+              AND w.user_id != p_user_id
+              AND NOT EXISTS (SELECT 1 FROM user_blocks b WHERE b.blocker_id = p_user_id AND b.blocked_id = w.user_id)
+              AND NOT EXISTS (SELECT 1 FROM user_blocks b WHERE b.blocker_id = w.user_id AND b.blocked_id = p_user_id)
+              AND NOT EXISTS (SELECT 1 FROM global_bans g WHERE g.user_id = w.user_id)
+            ORDER BY w."timestamp" ASC
+            LIMIT 1
+            FOR UPDATE OF w SKIP LOCKED;
+            IF v_partner IS NULL THEN
+                INSERT INTO waiting_queue (user_id, language) VALUES (p_user_id, p_language)
+                ON CONFLICT (user_id) DO UPDATE SET language = EXCLUDED.language;
+                RETURN NULL;
+            END IF;
+            DELETE FROM waiting_queue WHERE user_id IN (p_user_id, v_partner);
+            INSERT INTO active_chats (user_id, partner_id) VALUES (p_user_id, v_partner), (v_partner, p_user_id);
+            IF p_instance IS NOT NULL THEN
+                PERFORM pg_notify('user_state', p_instance || ':' || p_user_id || ',' || v_partner);
+            END IF;
+            RETURN v_partner;
+        END;
+        $$;
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION next_chat(p_user_id BIGINT, p_language VARCHAR, p_instance TEXT DEFAULT NULL)
+        RETURNS TABLE (old_partner_id BIGINT, new_partner_id BIGINT, already_waiting BOOLEAN) LANGUAGE plpgsql AS $$
+        BEGIN
+            old_partner_id := end_chat(p_user_id, p_instance);
+            already_waiting := old_partner_id IS NULL AND EXISTS (SELECT 1 FROM waiting_queue WHERE user_id = p_user_id);
+            IF NOT already_waiting THEN
+                new_partner_id := match_or_enqueue(p_user_id, p_language, p_instance);
+            END IF;
+            RETURN NEXT;
+        END;
+        $$;
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION block_and_end_chat(p_blocker_id BIGINT, p_blocked_id BIGINT, p_instance TEXT DEFAULT NULL)
+        RETURNS BIGINT LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO user_blocks (blocker_id, blocked_id) VALUES (p_blocker_id, p_blocked_id)
+            ON CONFLICT (blocker_id, blocked_id) DO NOTHING;
+            RETURN end_chat(p_blocker_id, p_instance);
+        END;
+        $$;
+        ''',
+    ]),
+    (6, 'broadcast_job_leases', [
+        # النسخة التي ترسل المهمة حالياً، وحتى متى يبقى حجزها صالحاً إذا توقفت عن تجديده
+        'ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS owner_instance TEXT;',
+        'ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;',
+    ]),
+]
+
+async def run_migrations(connection):
+    """يطبق الترحيلات غير المطبقة بالترتيب. قفل استشاري يمنع نسختين من الترحيل في نفس الوقت."""
+    await connection.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    ''')
+    await connection.execute("SELECT pg_advisory_lock(hashtext('schema_migrations'))")
+    try:
+        applied = {row['version'] for row in await connection.fetch("SELECT version FROM schema_migrations")}
+        for version, name, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            async with connection.transaction():
+                for statement in statements:
+                    await connection.execute(statement)
+                await connection.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+            logger.info(f"Applied schema migration {version:03d}_{name}.")
+    finally:
+        await connection.execute("SELECT pg_advisory_unlock(hashtext('schema_migrations'))")
+
+class InstrumentedPool:
+    """يغلف asyncpg.Pool ويقيس زمن انتظار الحصول على اتصال (acquire) وعدد المنتظرين."""
+
+    def __init__(self, pool):
+        self._pool = pool
+        self.acquires = 0
+        self.waiting = 0
+        self.max_wait = 0.0
+        self._waits = deque(maxlen=1000)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, timeout=None):
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            connection = await self._pool.acquire(timeout=timeout)
+        finally:
+            self.waiting -= 1
+        waited = time.perf_counter() - started
+        self.acquires += 1
+        self.max_wait = max(self.max_wait, waited)
+        self._waits.append(waited)
+        try:
+            yield connection
+        finally:
+            await self._pool.release(connection)
+
+    async def close(self):
+        await self._pool.close()
+
+    def stats(self):
+        waits = sorted(self._waits)
+        p50 = waits[len(waits) // 2] if waits else 0.0
+        p99 = waits[max(int(len(waits) * 0.99) - 1, 0)] if waits else 0.0
+        return {
+            'size': self._pool.get_size(),
+            'idle': self._pool.get_idle_size(),
+            'max_size': self._pool.get_max_size(),
+            'waiting': self.waiting,
+            'acquires': self.acquires,
+            'p50_ms': round(p50 * 1000, 2),
+            'p99_ms': round(p99 * 1000, 2),
+            'max_ms': round(self.max_wait * 1000, 2),
+        }
+
+async def _prepare_hot_queries(connection):
+    """يُستدعى لكل اتصال جديد في المجمع: تنفيذ كل استعلام ساخن مرة يضعه محضراً في كاش الاتصال."""
+    try:
+        for query in HOT_QUERIES:
+            await connection.fetch(query, 0)
+    except asyncpg.UndefinedTableError:
+        pass  # قبل تطبيق الترحيلات لأول مرة
+
+async def create_db_pool(**overrides):
+    """ينشئ مجمع الاتصالات حسب إعدادات DB_POOL_* مع تحضير استعلامات المسار الساخن."""
+    settings = dict(
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_queries=DB_POOL_MAX_QUERIES,
+        max_inactive_connection_lifetime=DB_POOL_MAX_IDLE,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        init=_prepare_hot_queries if DB_STATEMENT_CACHE_SIZE else None,
+    )
+    settings.update(overrides)
+    return InstrumentedPool(await asyncpg.create_pool(DATABASE_URL, **settings))
 
 async def init_database():
-    """يتصل بقاعدة البيانات وينشئ الجداول."""
+    """يتصل بقاعدة البيانات ويطبق ترحيلات المخطط."""
     global db_pool
     if not DATABASE_URL:
         logger.critical("CRITICAL: DATABASE_URL not found. Bot cannot start.")
         return False
     try:
-        db_pool = await asyncpg.create_pool(DATABASE_URL)
-        async with db_pool.acquire() as connection:
-            
-            await connection.execute('''
-                CREATE TABLE IF NOT EXISTS all_users (
-                    user_id BIGINT PRIMARY KEY,
-                    language VARCHAR(5) DEFAULT 'en' 
-                );
-            ''')
-            
-            await connection.execute('''
-                CREATE TABLE IF NOT EXISTS active_chats (
-                    user_id BIGINT PRIMARY KEY,
-                    partner_id BIGINT NOT NULL UNIQUE
-                );
-            ''')
-            await connection.execute('''
-                CREATE TABLE IF NOT EXISTS waiting_queue (
-                    user_id BIGINT PRIMARY KEY,
-                    timestamp TIMESTZ DEFAULT (NOW() AT TIME ZONE 'UTC')
-                );
-            ''')
-            await connection.execute('''
-                CREATE TABLE IF NOT EXISTS user_blocks (
-                    blocker_id BIGINT,
-                    blocked_id BIGINT,
-                    PRIMARY KEY (blocker_id, blocked_id)
-                );
-            ''')
-            await connection.execute('''
-                CREATE TABLE IF NOT EXISTS global_bans (
-                    user_id BIGINT PRIMARY KEY
-                );
-            ''')
-        logger.info("Database connected and tables verified.")
+        pool = await create_db_pool()
+        try:
+            async with pool.acquire() as connection:
+                await run_migrations(connection)
+        except BaseException:
+            await pool.close()
+            raise
+        # db_pool يُضبط بعد نجاح الترحيلات فقط: /healthz وبقية البوت يعتبرون قاعدة البيانات جاهزة عند وجوده
+        db_pool = pool
+        logger.info("Database connected and schema is up to date.")
         return True
     except Exception as e:
         logger.critical(f"CRITICAL: Failed to connect to database: {e}")
@@ -297,75 +1474,321 @@ async def post_database_init(application: Application) -> None:
     if not await init_database():
         logger.critical("Failed to initialize database. Shutting down.")
         await application.stop()
+        return
+    if not CLUSTER_MODE:
+        await load_matchmaking_state()
+    await load_ban_filter()
+    await start_db_listener()
+    db_writer.start()
+    user_writes.start()
+    if LOG_CHANNEL_ID:
+        archive_pipeline.start(application.bot)
+    await resume_broadcast_jobs(application.bot)
+
+async def post_bot_stop(application: Application) -> None:
+    """يتم استدعاؤها بعد إيقاف معالجة التحديثات وقبل إغلاق البوت: تنهي كل ما يرسل عبر البوت ما دام قادراً على الإرسال."""
+    await stop_broadcast_jobs()
+    # الألبومات المعلقة قبل الأرشيف: تمريرها يضيف عناصر لطابور الأرشفة
+    await album_buffer.stop()
+    await archive_pipeline.stop()
+
+async def post_bot_shutdown(application: Application) -> None:
+    """يتم استدعاؤها عند الإيقاف بعد إغلاق البوت: تضمن كتابة كل العمليات المعلقة في قاعدة البيانات."""
+    await user_writes.stop()
+    await db_writer.stop()
+    await stop_db_listener()
+    if db_pool:
+        await db_pool.close()
 
 async def check_if_user_exists(user_id):
     """يتحقق مما إذا كان المستخدم موجوداً في جدول all_users."""
     if not db_pool: return False
-    async with db_pool.acquire() as connection:
-        return await connection.fetchval("SELECT 1 FROM all_users WHERE user_id = $1", user_id) is not None
+    return (await user_states.get(user_id)).exists
 
 async def add_user_to_all_list(user_id, lang_code=None):
     """يضيف المستخدم إلى قائمة البث ويسجل اللغة المحددة."""
     if not db_pool: return
     lang_code_to_use = lang_code if lang_code else DEFAULT_LANG
-    try:
-        async with db_pool.acquire() as connection:
-            await connection.execute(
-                "INSERT INTO all_users (user_id, language) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET language = EXCLUDED.language",
-                user_id, lang_code_to_use
-            )
-    except Exception as e:
-        logger.error(f"Failed to add/update user {user_id} in broadcast list: {e}")
-
-async def get_all_users():
-    """يجلب جميع المستخدمين المسجلين في قائمة البث."""
-    if not db_pool: return []
+    user_states.update(user_id, exists=True, language=lang_code_to_use)
+    user_writes.upsert_user(user_id, lang_code_to_use)
+    if CLUSTER_MODE:
+        # النسخ الأخرى تقرأ من قاعدة البيانات مباشرة: ننتظر الدفعة (تجمع كل التسجيلات المتزامنة)
+        await user_writes.flush()
+    elif matchmaker.set_language(user_id, lang_code_to_use):
+        db_writer.submit([("UPDATE waiting_queue SET language = $2 WHERE user_id = $1", (user_id, lang_code_to_use))])
+
+async def count_all_users():
+    """يحسب عدد المستخدمين المسجلين في قائمة البث."""
+    if not db_pool: return 0
     async with db_pool.acquire() as connection:
-        return await connection.fetchval("SELECT ARRAY_AGG(user_id) FROM all_users") or []
+        return await connection.fetchval("SELECT COUNT(*) FROM all_users")
+
+ALL_USERS_PAGE_QUERY = """
+    SELECT au.user_id
+    FROM all_users au
+    WHERE au.user_id > $1
+      AND ($3::bigint IS NULL OR NOT EXISTS (
+          SELECT 1 FROM broadcast_deliveries d WHERE d.job_id = $3 AND d.user_id = au.user_id
+      ))
+    ORDER BY au.user_id
+    LIMIT $2
+"""
+
+async def iter_all_users(after_user_id=0, job_id=None, chunk_size=None):
+    """يمرر المستخدمين المسجلين بترتيب user_id على دفعات (keyset pagination) دون تحميلهم كلهم في الذاكرة.
+    كل دفعة تستخدم اتصالاً قصيراً يُعاد للـ pool قبل تمرير نتائجها. إذا أُعطي job_id يتم تخطي من سُجل لهم تسليم في تلك المهمة."""
+    if not db_pool: return
+    chunk_size = chunk_size or BROADCAST_FETCH_SIZE
+    last_user_id = after_user_id
+    while True:
+        async with db_pool.acquire() as connection:
+            rows = await connection.fetch(ALL_USERS_PAGE_QUERY, last_user_id, chunk_size, job_id)
+        if not rows:
+            return
+        for row in rows:
+            yield row['user_id']
+        if len(rows) < chunk_size:
+            return
+        last_user_id = rows[-1]['user_id']
 
 async def get_partner_from_db(user_id):
     if not db_pool: return None
-    async with db_pool.acquire() as connection:
-        return await connection.fetchval("SELECT partner_id FROM active_chats WHERE user_id = $1", user_id)
+    return (await user_states.get(user_id)).partner_id
 
 async def is_user_waiting_db(user_id):
     if not db_pool: return False
-    async with db_pool.acquire() as connection:
-        return await connection.fetchval("SELECT 1 FROM waiting_queue WHERE user_id = $1", user_id) is not None
+    if CLUSTER_MODE:
+        async with db_pool.acquire() as connection:
+            return await connection.fetchval(IS_WAITING_QUERY, user_id) is not None
+    return matchmaker.is_waiting(user_id)
+
+END_CHAT_DELETE = "DELETE FROM active_chats WHERE user_id = ANY($1::bigint[])"
 
 async def end_chat_in_db(user_id):
     if not db_pool: return None
-    async with db_pool.acquire() as connection:
-        async with connection.transaction():
-            partner_id = await connection.fetchval("DELETE FROM active_chats WHERE user_id = $1 RETURNING partner_id", user_id)
-            if partner_id:
-                await connection.execute("DELETE FROM active_chats WHERE user_id = $1", partner_id)
-            return partner_id
+    if CLUSTER_MODE:
+        async with db_pool.acquire() as connection:
+            partner_id = await connection.fetchval("SELECT end_chat($1, $2)", user_id, INSTANCE_ID)
+        user_states.update(user_id, partner_id=None)
+        if partner_id:
+            user_states.update(partner_id, partner_id=None)
+        return partner_id
+    partner_id = (await user_states.get(user_id)).partner_id
+    if not partner_id:
+        return None
+    user_states.update(user_id, partner_id=None)
+    user_states.update(partner_id, partner_id=None)
+    # تمر عبر نفس طابور الكتابة حتى لا تسبق كتابة مطابقة ما زالت معلقة
+    await db_writer.submit([(END_CHAT_DELETE, ([user_id, partner_id],))])
+    return partner_id
 
 async def remove_from_wait_queue_db(user_id):
     if not db_pool: return
-    async with db_pool.acquire() as connection:
-        await connection.execute("DELETE FROM waiting_queue WHERE user_id = $1", user_id)
+    if CLUSTER_MODE:
+        async with db_pool.acquire() as connection:
+            await connection.execute("DELETE FROM waiting_queue WHERE user_id = $1", user_id)
+        return
+    if matchmaker.remove(user_id):
+        db_writer.submit([("DELETE FROM waiting_queue WHERE user_id = $1", (user_id,))])
 
-async def add_user_block(blocker_id, blocked_id):
-    """يسجل حظراً متبادلاً."""
-    if not db_pool: return
+WAIT_QUEUE_INSERT = "INSERT INTO waiting_queue (user_id, language) VALUES ($1, $2) ON CONFLICT (user_id) DO UPDATE SET language = EXCLUDED.language"
+
+async def add_to_wait_queue_db(user_id, lang_code, front=False, before=()):
+    """يضيف المستخدم إلى طابور لغته (في الذاكرة مع كتابة في الخلفية، أو مباشرة في وضع العنقود).
+    before: كتابات محلية تسبقها في نفس المعاملة (إنهاء المحادثة في زر التالي) وتُنتظر معها."""
+    if CLUSTER_MODE:
+        async with db_pool.acquire() as connection:
+            await connection.execute(WAIT_QUEUE_INSERT, user_id, lang_code)
+        return
+    statements = list(before)
+    if matchmaker.enqueue(user_id, lang_code, front=front):
+        statements.append((WAIT_QUEUE_INSERT, (user_id, lang_code)))
+    if statements:
+        write = db_writer.submit(statements)
+        if before:
+            await write
+
+def pair_users_in_db(user_id, partner_id, lang_code, before=()):
+    """يسجّل المطابقة في الذاكرة فوراً ويكتبها في قاعدة البيانات بمعاملة قصيرة واحدة (بعد كتابات before إن وُجدت).
+    يُرجع Future للكتابة."""
+    user_states.update(user_id, partner_id=partner_id)
+    if not user_states.update(partner_id, partner_id=user_id):
+        # الشريك كان في الطابور (مسجل، غير محظور، وبنفس اللغة)
+        user_states.put(partner_id, UserState(exists=True, language=lang_code, partner_id=user_id))
+    return db_writer.submit([
+        *before,
+        ("DELETE FROM waiting_queue WHERE user_id = ANY($1::bigint[])", ([user_id, partner_id],)),
+        ("INSERT INTO active_chats (user_id, partner_id) VALUES ($1, $2), ($2, $1)", (user_id, partner_id)),
+    ])
+
+async def _match_or_enqueue_in_db(user_id, lang_code):
+    """المطابقة في وضع العنقود: استدعاء واحد لدالة match_or_enqueue في قاعدة البيانات،
+    مسلسلة لكل لغة بقفل استشاري بين كل النسخ (SKIP LOCKED يتخطى صفوفاً تحجزها نسخة أخرى)."""
     async with db_pool.acquire() as connection:
-        await connection.execute(
-            "INSERT INTO user_blocks (blocker_id, blocked_id) VALUES ($1, $2) ON CONFLICT (blocker_id, blocked_id) DO NOTHING",
-            blocker_id, blocked_id
-        )
+        partner_id = await connection.fetchval("SELECT match_or_enqueue($1, $2, $3)", user_id, lang_code, INSTANCE_ID)
+    if partner_id:
+        user_states.update(user_id, partner_id=partner_id)
+        user_states.update(partner_id, partner_id=user_id)
+    return partner_id
+
+async def match_or_enqueue(user_id, lang_code, before=()):
+    """المرحلة الأولى من المطابقة: يجد شريكاً ويثبت المطابقة في قاعدة البيانات، أو يضيف المستخدم للطابور.
+    before (الوضع المحلي فقط): كتابات تُنفذ في نفس المعاملة قبل المطابقة. يُرجع ID الشريك أو None."""
+    if CLUSTER_MODE:
+        return await _match_or_enqueue_in_db(user_id, lang_code)
+    partner_id = matchmaker.pop_partner(user_id, lang_code)
+    if not partner_id:
+        await add_to_wait_queue_db(user_id, lang_code, before=before)
+        return None
+    try:
+        await pair_users_in_db(user_id, partner_id, lang_code, before=before)
+    except Exception:
+        user_states.update(user_id, partner_id=None)
+        user_states.update(partner_id, partner_id=None)
+        await add_to_wait_queue_db(partner_id, lang_code, front=True)
+        raise
+    return partner_id
+
+async def next_chat_in_db(user_id, lang_code):
+    """زر "التالي": ينهي المحادثة الحالية ثم يطابق أو يضيف للطابور.
+    يُرجع (الشريك السابق، الشريك الجديد، هل كان منتظراً أصلاً). في وضع العنقود رحلة واحدة (next_chat)."""
+    if CLUSTER_MODE:
+        async with db_pool.acquire() as connection:
+            row = await connection.fetchrow("SELECT * FROM next_chat($1, $2, $3)", user_id, lang_code, INSTANCE_ID)
+        old_partner_id, new_partner_id = row['old_partner_id'], row['new_partner_id']
+        if old_partner_id:
+            user_states.update(old_partner_id, partner_id=None)
+        user_states.update(user_id, partner_id=new_partner_id)
+        if new_partner_id:
+            user_states.update(new_partner_id, partner_id=user_id)
+        return old_partner_id, new_partner_id, row['already_waiting']
+    old_partner_id = (await user_states.get(user_id)).partner_id
+    if not old_partner_id and await is_user_waiting_db(user_id):
+        return None, None, True
+    # إنهاء المحادثة يُكتب مع المطابقة الجديدة (أو دخول الطابور) في دفعة واحدة = رحلة واحدة لقاعدة البيانات
+    end_statements = []
+    if old_partner_id:
+        user_states.update(user_id, partner_id=None)
+        user_states.update(old_partner_id, partner_id=None)
+        end_statements.append((END_CHAT_DELETE, ([user_id, old_partner_id],)))
+    return old_partner_id, await match_or_enqueue(user_id, lang_code, before=end_statements), False
+
+async def block_and_end_chat(blocker_id, blocked_id):
+    """يسجل الحظر وينهي محادثة المبلِّغ معاً. يُرجع ID الشريك الذي انتهت المحادثة معه أو None."""
+    if not db_pool: return None
+    matchmaker.add_block(blocker_id, blocked_id)
+    if CLUSTER_MODE:
+        async with db_pool.acquire() as connection:
+            partner_id = await connection.fetchval("SELECT block_and_end_chat($1, $2, $3)", blocker_id, blocked_id, INSTANCE_ID)
+        user_states.update(blocker_id, partner_id=None)
+        if partner_id:
+            user_states.update(partner_id, partner_id=None)
+        return partner_id
+    # المطابقة المحلية تقرأ الحظر من الذاكرة، فسجله الدائم يُكتب مع دفعة الكتابة المؤجلة
+    user_writes.add_block(blocker_id, blocked_id)
+    return await end_chat_in_db(blocker_id)
+
+async def ban_users_in_db(user_ids):
+    """يحظر مجموعة مستخدمين في معاملة واحدة: يضيفهم لـ global_bans، ينهي كل محادثاتهم معاً،
+    ويحذفهم من الطابور. يُرجع (IDs المحظورين الجدد، صفوف المحادثات المنتهية، عدد من أزيلوا من الطابور)."""
+    if not CLUSTER_MODE:
+        # مطابقات ما زالت في طابور الكتابة يجب أن تصل أولاً حتى تُنهى مع البقية
+        await db_writer.flush()
+    async with db_pool.acquire() as connection:
+        async with connection.transaction():
+            new_bans = [row['user_id'] for row in await connection.fetch(
+                "INSERT INTO global_bans (user_id) SELECT DISTINCT unnest($1::bigint[]) ON CONFLICT (user_id) DO NOTHING RETURNING user_id",
+                user_ids
+            )]
+            # نفس قفل الزوج الذي تأخذه end_chat، بترتيب ثابت لتجنب الـ deadlock مع إنهاء متزامن
+            await connection.execute(
+                """
+                SELECT pg_advisory_xact_lock(hashtext('chat:' || pair_key))
+                FROM (
+                    SELECT DISTINCT LEAST(user_id, partner_id) AS pair_key
+                    FROM active_chats
+                    WHERE user_id = ANY($1::bigint[]) OR partner_id = ANY($1::bigint[])
+                    ORDER BY pair_key
+                ) pairs
+                """,
+                user_ids
+            )
+            ended = await connection.fetch(
+                "DELETE FROM active_chats WHERE user_id = ANY($1::bigint[]) OR partner_id = ANY($1::bigint[]) RETURNING user_id, partner_id",
+                user_ids
+            )
+            unqueued = await connection.fetch("DELETE FROM waiting_queue WHERE user_id = ANY($1::bigint[]) RETURNING user_id", user_ids)
+            # إبلاغ بقية النسخ (يُرسل عند نجاح المعاملة)
+            for start in range(0, len(new_bans), 500):
+                await connection.execute("SELECT pg_notify('global_bans', $1::text)", ",".join(str(banned_id) for banned_id in new_bans[start:start + 500]))
+            if ended:
+                await notify_user_state(connection, *(row['user_id'] for row in ended))
+    for banned_id in user_ids:
+        apply_global_ban(banned_id)
+        matchmaker.remove(banned_id)
+    for row in ended:
+        user_states.update(row['user_id'], partner_id=None)
+    return new_bans, ended, len(unqueued)
 
 # --- (4) Subscription and Language Handlers ---
 
+class MembershipCache:
+    """كاش LRU محدود الحجم لنتائج الاشتراك في القناة، مع مدة صلاحية منفصلة للنتائج الإيجابية والسلبية."""
+
+    def __init__(self, ttl, negative_ttl, max_size):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # user_id -> (is_member, expires_at)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """تُرجع النتيجة المخزنة أو None إذا لم تكن موجودة أو انتهت صلاحيتها."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        is_member, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[user_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return is_member
+
+    def set(self, user_id, is_member):
+        ttl = self.ttl if is_member else self.negative_ttl
+        if ttl <= 0:
+            return
+        self._entries[user_id] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+membership_cache = MembershipCache(MEMBERSHIP_CACHE_TTL, MEMBERSHIP_CACHE_NEGATIVE_TTL, MEMBERSHIP_CACHE_MAX_SIZE)
+
 async def is_user_subscribed(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """تتحقق مما إذا كان المستخدم عضواً في القناة."""
+    """تتحقق مما إذا كان المستخدم عضواً في القناة (مع الاستفادة من الكاش)."""
+    cached = membership_cache.get(user_id)
+    if cached is not None:
+        return cached
     try:
         member = await context.bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        return member.status in ['member', 'administrator', 'creator']
+        is_member = member.status in ['member', 'administrator', 'creator']
+        membership_cache.set(user_id, is_member)
+        return is_member
     except BadRequest as e:
         if "user not found" in e.message:
             logger.warning(f"User {user_id} not found in channel {CHANNEL_ID}, likely not joined.")
+            membership_cache.set(user_id, False)
         else:
             logger.error(f"Error checking channel membership for {user_id} in {CHANNEL_ID}: {e}")
         return False
@@ -377,16 +1800,7 @@ async def send_join_channel_message(update_or_query: Union[Update, Update.callba
     """ترسل رسالة الاشتراك الإجباري."""
     
     join_text = _('join_channel_msg', lang_code)
-    join_btn_text = _('join_channel_btn', lang_code)
-    joined_btn_text = _('joined_btn', lang_code)
-    
-    keyboard = [
-        [
-            InlineKeyboardButton(join_btn_text, url=CHANNEL_INVITE_LINK),
-            InlineKeyboardButton("✅ " + joined_btn_text, callback_data=f"check_join_{lang_code}")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = templates.get(lang_code).join_markup
     
     if isinstance(update_or_query, Update): 
         sender = update_or_query.message.reply_text
@@ -412,6 +1826,9 @@ async def handle_join_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await query.answer()
     
+    # المستخدم يؤكد أنه انضم للتو: نتجاهل أي نتيجة سلبية مخزنة
+    membership_cache.invalidate(user_id)
+    
     if await is_user_subscribed(user_id, context):
         await query.edit_message_text(
             _('joined_success', lang_code),
@@ -419,7 +1836,7 @@ async def handle_join_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode=constants.ParseMode.MARKDOWN_V2,
             protect_content=True
         )
-        await query.message.reply_text(_('use_buttons_msg', lang_code), reply_markup=await get_keyboard(lang_code), protect_content=True)
+        await query.message.reply_text(_('use_buttons_msg', lang_code), reply_markup=get_keyboard(lang_code), protect_content=True)
     else:
         joined_btn_text = _('joined_btn', lang_code)
         await query.answer("⚠️ " + joined_btn_text, show_alert=True)
@@ -427,16 +1844,9 @@ async def handle_join_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_initial_language_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """يعرض واجهة اختيار اللغة الأولية للمستخدمين الجدد."""
     
-    language_buttons = []
-    for code in SUPPORTED_LANGUAGES:
-        name = LANGUAGES[code]['language_name']
-        language_buttons.append([InlineKeyboardButton(name, callback_data=f"initial_set_lang_{code}")])
-        
-    reply_markup = InlineKeyboardMarkup(language_buttons)
-    
     await update.message.reply_text(
         _('initial_selection_msg', DEFAULT_LANG),
-        reply_markup=reply_markup,
+        reply_markup=templates.initial_language_markup,
         parse_mode=constants.ParseMode.MARKDOWN,
         protect_content=True
     )
@@ -445,16 +1855,19 @@ async def handle_language_selection(update: Update, context: ContextTypes.DEFAUL
     query = update.callback_query
     user_id = query.from_user.id
     data = query.data
-    
+    new_lang_code = data.rsplit('_', 1)[-1]
+
+    # الكود يأتي من العميل: لا نقبل إلا لغة لها كتالوج (ولا يُكتب غيرها في all_users)
+    if new_lang_code not in SUPPORTED_LANGUAGES:
+        await query.answer("Invalid language selection.")
+        return
     await query.answer()
 
     # --- Initial Setup Logic (Flow: Select Language -> Force Join) ---
     if data.startswith("initial_set_lang_"):
-        new_lang_code = data.split('_')[3]
-        
         await add_user_to_all_list(user_id, new_lang_code) 
             
-        lang_name = LANGUAGES[new_lang_code]['language_name']
+        lang_name = _('language_name', new_lang_code)
         
         await query.edit_message_text(
             _('settings_saved', new_lang_code).format(lang_name=lang_name), 
@@ -469,33 +1882,20 @@ async def handle_language_selection(update: Update, context: ContextTypes.DEFAUL
 
     # --- Existing user language selection logic (regular settings) ---
     if data.startswith("set_lang_"):
-        new_lang_code = data.split('_')[2]
-        
-        if new_lang_code not in SUPPORTED_LANGUAGES:
-            await query.answer("Invalid language selection.")
-            return
-        
         try:
             await add_user_to_all_list(user_id, new_lang_code) 
                 
-            lang_name = LANGUAGES[new_lang_code]['language_name']
-            
-            if new_lang_code == 'ar':
-                 settings_guidance = "\n\n🌐 يمكنك تغيير اللغة في أي وقت بإرسال /settings."
-            elif new_lang_code == 'es':
-                 settings_guidance = "\n\n🌐 Puedes cambiar el idioma en cualquier momento enviando /settings."
-            else:
-                 settings_guidance = "\n\n🌐 You can change the language anytime by typing /settings."
+            lang_name = _('language_name', new_lang_code)
             
             await query.edit_message_text(
-                _('settings_saved', new_lang_code).format(lang_name=lang_name) + settings_guidance,
+                _('settings_saved', new_lang_code).format(lang_name=lang_name) + "\n\n" + _('settings_guidance', new_lang_code),
                 reply_markup=None,
                 parse_mode=constants.ParseMode.MARKDOWN
             )
             
             await query.message.reply_text(
                  _('use_buttons_msg', new_lang_code),
-                 reply_markup=await get_keyboard(new_lang_code), 
+                 reply_markup=get_keyboard(new_lang_code), 
                  protect_content=True
             )
             
@@ -536,36 +1936,616 @@ async def sendid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"❌ An unexpected error occurred: {e}", protect_content=True)
 
+def parse_ban_targets(text):
+    """يستخرج IDs المستخدمين من نص (مفصولة بمسافات أو أسطر أو فواصل) ويتجاهل الأوامر.
+    يُرجع (IDs بدون تكرار وبنفس الترتيب، عدد العناصر غير الصالحة)."""
+    user_ids, invalid = {}, 0
+    for token in re.split(r'[\s,;]+', text or ''):
+        if not token or token.startswith('/'):
+            continue
+        try:
+            user_ids[int(token)] = None
+        except ValueError:
+            invalid += 1
+    return list(user_ids), invalid
+
 async def banuser_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/banuser <IDs...> أو ملف نصي بـ IDs (مرفق مع /banuser في الكابشن أو رد على الملف بـ /banuser)."""
     user_id = update.message.from_user.id
     
     if user_id != ADMIN_ID:
         await update.message.reply_text(_('admin_denied', DEFAULT_LANG), protect_content=True)
         return
 
-    if len(context.args) != 1:
-        await update.message.reply_text("Usage: /banuser <User_ID_to_Ban>", protect_content=True)
+    message = update.message
+    reply = message.reply_to_message
+    document = message.document or (reply.document if reply else None)
+    banned_ids, invalid = parse_ban_targets(message.caption if message.caption else message.text)
+
+    try:
+        if document:
+            if document.file_size and document.file_size > BULK_BAN_FILE_MAX_SIZE:
+                await message.reply_text(f"❌ File too large (max {BULK_BAN_FILE_MAX_SIZE // 1024} KiB).", protect_content=True)
+                return
+            ban_file = await context.bot.get_file(document.file_id)
+            file_ids, file_invalid = parse_ban_targets((await ban_file.download_as_bytearray()).decode('utf-8', errors='replace'))
+            banned_ids = list(dict.fromkeys(banned_ids + file_ids))
+            invalid += file_invalid
+
+        if not banned_ids:
+            await message.reply_text(
+                "Usage: /banuser <User_ID> [User_ID ...]\nOr send a .txt file of IDs with /banuser as the caption (or reply to it with /banuser).",
+                protect_content=True
+            )
+            return
+        if len(banned_ids) > BULK_BAN_MAX_IDS:
+            await message.reply_text(f"❌ Too many IDs ({len(banned_ids)}); the limit is {BULK_BAN_MAX_IDS} per command.", protect_content=True)
+            return
+
+        new_bans, ended, unqueued = await ban_users_in_db(banned_ids)
+
+        # إبلاغ الشركاء غير المحظورين بانتهاء المحادثة، بالتوازي (OutboundScheduler يضبط المعدل)
+        banned_set = set(banned_ids)
+        partners = sorted({row['user_id'] for row in ended} - banned_set)
+
+        async def notify_partner(partner_id):
+            partner_lang = await get_user_language(partner_id)
+            await context.bot.send_message(chat_id=partner_id, text=_('end_msg_partner', partner_lang), reply_markup=get_keyboard(partner_lang), protect_content=True)
+
+        results = await asyncio.gather(*(notify_partner(partner_id) for partner_id in partners), return_exceptions=True)
+        failed = sum(1 for result in results if isinstance(result, Exception))
+        if failed:
+            logger.warning(f"Could not notify {failed} of {len(partners)} partners about chats ended by a ban.")
+        logger.info(f"Admin banned {len(new_bans)} new users ({len(banned_ids)} requested), ended {len(ended) // 2} chats.")
+
+        await message.reply_text(
+            f"✅ Banned {len(new_bans)} user(s) from using the chat features"
+            f" ({len(banned_ids) - len(new_bans)} already banned, {invalid} invalid entries skipped).\n"
+            f"Chats ended: {len(ended) // 2}, removed from queue: {unqueued}.\n"
+            f"Partners notified: {len(partners) - failed}/{len(partners)}.",
+            protect_content=True
+        )
+        
+    except Exception as e:
+        logger.error(f"Error banning users: {e}")
+        await message.reply_text(f"❌ An error occurred during the ban process: {e}", protect_content=True)
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """يعرض إحصائيات الأداء الداخلية للأدمن."""
+    user_id = update.message.from_user.id
+    
+    if user_id != ADMIN_ID:
+        await update.message.reply_text(_('admin_denied', DEFAULT_LANG), protect_content=True)
+        return
+    
+    membership = membership_cache.stats()
+    states = user_states.stats()
+    writes = user_writes.stats()
+    queues = matchmaker.stats()
+    updates = update_processor.stats()
+    archive = archive_pipeline.stats()
+    content = content_filter.stats()
+    relayed = relay_engine.stats()
+    albums = album_buffer.stats()
+    outbound = outbound_scheduler.stats()
+    pool = db_pool.stats() if db_pool else None
+    pool_line = (
+        f"DB pool: size={pool['size']}/{pool['max_size']}, idle={pool['idle']}, waiting={pool['waiting']}, acquires={pool['acquires']}, "
+        f"acquire p50={pool['p50_ms']}ms p99={pool['p99_ms']}ms max={pool['max_ms']}ms\n"
+    ) if pool else ""
+    bans = ban_filter.stats()
+    await update.message.reply_text(
+        f"📊 Bot Stats\n\n"
+        f"Membership cache: size={membership['size']}, hits={membership['hits']}, misses={membership['misses']}\n"
+        f"User state cache: size={states['size']}, hits={states['hits']}, misses={states['misses']}\n"
+        f"Ban filter: bans={bans['bans']}, size={bans['kib']}KiB, negatives={bans['negatives']}, maybes={bans['maybes']}\n"
+        f"Waiting queues: {queues or 'empty'}\n"
+        f"Background DB writes: pending={db_writer.pending()}, failed={db_writer.failures}\n"
+        f"Write-behind users/blocks: pending={writes['pending']}, flushes={writes['flushes']}, rows={writes['rows']}, "
+        f"coalesced={writes['coalesced']}, failed={writes['failures']}, dropped={writes['dropped']}, max flush={writes['max_flush_ms']}ms\n"
+        f"{pool_line}"
+        f"Updates: queued={context.application.update_queue.qsize()}, waiting={updates['waiting']}, processed={updates['processed']}, "
+        f"latency p50={updates['p50_ms']}ms p99={updates['p99_ms']}ms max={updates['max_ms']}ms\n"
+        f"Archive: queued={archive['queued']}, archived={archive['archived']}, dropped={archive['dropped']}, "
+        f"failed={archive['failed']}, rate_limited={archive['rate_limited']}\n"
+        f"Content filter: checks={content['checks']}, links={content['links']}, usernames={content['usernames']}, "
+        f"p50={content['p50_us']}µs p99={content['p99_us']}µs max={content['max_us']}µs\n"
+        f"Relay: " + (", ".join(f"{message_type}={item['count']} (p50={item['p50_ms']}ms max={item['max_ms']}ms)" for message_type, item in relayed.items()) or "none") + "\n"
+        f"Albums: relayed={albums['albums']}, items={albums['items']}, pending={albums['pending']}\n"
+        f"Outbound: " + ", ".join(
+            f"{name} sent={outbound[name]['sent']} waiting={outbound[name]['waiting']} "
+            f"wait avg={outbound[name]['avg_wait_ms']}ms max={outbound[name]['max_wait_ms']}ms"
+            for name in PRIORITY_NAMES
+        ) + f", retry_after={outbound['rate_limited']}, chats={outbound['chats']}\n"
+        f"Translations: {catalogs.stats()}",
+        protect_content=True
+    )
+
+async def reloadlang_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """يعيد تحميل ملفات الترجمة بدون إعادة تشغيل، ويبلغ بقية النسخ بذلك."""
+    user_id = update.message.from_user.id
+    
+    if user_id != ADMIN_ID:
+        await update.message.reply_text(_('admin_denied', DEFAULT_LANG), protect_content=True)
         return
     
     try:
-        banned_id = int(context.args[0])
-        
+        reload_translations()
+    except Exception as e:
+        logger.error(f"Failed to reload translation catalogs: {e}")
+        await update.message.reply_text(f"❌ Reload failed, keeping current translations: {e}", protect_content=True)
+        return
+    
+    if db_pool:
         async with db_pool.acquire() as connection:
-            await connection.execute(
-                "INSERT INTO global_bans (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING",
-                banned_id
+            await connection.execute("SELECT pg_notify('translations', $1)", INSTANCE_ID)
+    await update.message.reply_text(f"✅ Translations reloaded: {catalogs.stats()}", protect_content=True)
+
+# البادئة الثابتة للبرودكاست
+BROADCAST_PREFIX = "\"🎲 The Techno source 'TTS\" 🎲\n🎲 Announcement 🎲 📣📢\" :\n\n"
+TEXT_LIMIT = 4096
+CAPTION_LIMIT = 1024
+
+def telegram_length(text):
+    """طول النص كما يحسبه تيليجرام (وحدات UTF-16: الإيموجي غالباً وحدتان)."""
+    return len(text.encode('utf-16-le')) // 2
+
+class BroadcastPayload:
+    """محتوى البث: نص أو وسائط تُنسخ من رسالة الأدمن. البادئة تُدمج في نفس الرسالة متى أمكن."""
+
+    def __init__(self, from_chat_id, message_id, cleaned_message, is_media):
+        self.from_chat_id = from_chat_id
+        self.message_id = message_id
+        self.cleaned_message = cleaned_message or ""
+        self.is_media = is_media
+
+    async def _send_prefix(self, bot, chat_id, bucket, sent_parts):
+        # عند إعادة المحاولة (RetryAfter على الجزء الثاني) لا تُرسل البادئة مرة أخرى
+        if 'prefix' not in sent_parts:
+            await bucket.acquire()
+            await bot.send_message(chat_id=chat_id, text=BROADCAST_PREFIX, parse_mode=None, protect_content=False, rate_limit_args=PRIORITY_BROADCAST)
+            sent_parts.add('prefix')
+
+    async def send(self, bot, chat_id, bucket, sent_parts=None):
+        """يرسل البث لمستخدم واحد. طلب واحد في الحالة العادية، وطلبان إذا تجاوز النص المدمج الحد.
+        sent_parts يحفظ الأجزاء التي وصلت بين محاولات نفس المستلم."""
+        sent_parts = set() if sent_parts is None else sent_parts
+        if self.is_media:
+            caption = BROADCAST_PREFIX + self.cleaned_message
+            if telegram_length(caption) > CAPTION_LIMIT:
+                await self._send_prefix(bot, chat_id, bucket, sent_parts)
+                caption = self.cleaned_message
+            await bucket.acquire()
+            await bot.copy_message(
+                chat_id=chat_id,
+                from_chat_id=self.from_chat_id,
+                message_id=self.message_id,
+                caption=caption,
+                parse_mode=None, # إرسال الكابشن كنص عادي (لضمان وصول الروابط كنص)
+                protect_content=False,
+                rate_limit_args=PRIORITY_BROADCAST
             )
-        
-        await end_chat_in_db(banned_id)
-        await remove_from_wait_queue_db(banned_id)
-        
-        await update.message.reply_text(f"✅ User ID {banned_id} has been permanently blocked from using the chat features.", protect_content=True)
-        
-    except ValueError:
-        await update.message.reply_text("❌ Invalid ID format. Must be a number.", protect_content=True)
+        else:
+            text = BROADCAST_PREFIX + self.cleaned_message
+            if telegram_length(text) > TEXT_LIMIT:
+                await self._send_prefix(bot, chat_id, bucket, sent_parts)
+                text = self.cleaned_message
+            await bucket.acquire()
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode=None, protect_content=False, rate_limit_args=PRIORITY_BROADCAST)
+
+class BroadcastStats:
+    def __init__(self, total=None, success=0, failed=0):
+        self.total = total
+        self.success = success
+        self.failed = failed
+        self.blocked = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self._resumed_at = success + failed  # ما تم قبل الاستئناف لا يدخل في حساب المعدل
+
+    @property
+    def done(self):
+        return self.success + self.failed
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return (self.done - self._resumed_at) / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        total = f"/{self.total}" if self.total is not None else ""
+        return (
+            f"Processed: {self.done}{total} | Sent: {self.success} | Failed: {self.failed} "
+            f"(blocked: {self.blocked}) | Retries: {self.retries} | Rate: {self.rate():.1f} msg/s"
+        )
+
+async def run_broadcast(bot, recipients, payload, stats, on_progress=None, on_result=None, stop_event=None):
+    """محرك البث: عمال متوازيون يرسلون بمعدل token bucket قريب من حد تيليجرام العام،
+    مع إعادة المحاولة بعد RetryAfter لكل محادثة على حدة وتقارير تقدم دورية.
+    عند ضبط stop_event يتوقف إدخال مستلمين جدد وتكتمل الرسائل الجارية فقط."""
+    bucket = TokenBucket(BROADCAST_RATE, capacity=BROADCAST_RATE)
+    pending = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 2)
+
+    async def feed():
+        if hasattr(recipients, '__aiter__'):
+            async for chat_id in recipients:
+                if stop_event and stop_event.is_set():
+                    break
+                await pending.put(chat_id)
+        else:
+            for chat_id in recipients:
+                if stop_event and stop_event.is_set():
+                    break
+                await pending.put(chat_id)
+        for _ in range(BROADCAST_CONCURRENCY):
+            await pending.put(None)
+
+    def finish(chat_id, status):
+        if status == 'sent':
+            stats.success += 1
+        else:
+            stats.failed += 1
+            if status == 'blocked':
+                stats.blocked += 1
+        if on_result:
+            on_result(chat_id, status)
+
+    async def deliver(chat_id):
+        sent_parts = set()
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            try:
+                await payload.send(bot, chat_id, bucket, sent_parts)
+                finish(chat_id, 'sent')
+                return
+            except RetryAfter as e:
+                # الانتظار يخص هذه المحادثة فقط، بقية العمال يستمرون
+                stats.retries += 1
+                if attempt == BROADCAST_MAX_RETRIES:
+                    break
+                await asyncio.sleep(retry_after_seconds(e))
+            except Forbidden:
+                finish(chat_id, 'blocked')
+                return
+            except Exception as e:
+                finish(chat_id, 'failed')
+                logger.error(f"Failed to send broadcast to {chat_id}: {e}")
+                return
+        finish(chat_id, 'failed')
+        logger.warning(f"Giving up broadcast to {chat_id} after {BROADCAST_MAX_RETRIES} retries.")
+
+    async def worker():
+        while True:
+            chat_id = await pending.get()
+            if chat_id is None:
+                return
+            await deliver(chat_id)
+
+    async def report():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            try:
+                await on_progress(stats)
+            except Exception as e:
+                logger.warning(f"Failed to report broadcast progress: {e}")
+
+    reporter = asyncio.create_task(report()) if on_progress else None
+    try:
+        await asyncio.gather(feed(), *(worker() for _ in range(BROADCAST_CONCURRENCY)))
+    finally:
+        if reporter:
+            reporter.cancel()
+    return stats
+
+# --- Persistent Broadcast Jobs (مهام البث الدائمة والقابلة للاستئناف) ---
+
+broadcast_jobs_running = {}  # job_id -> (stop_event, task)
+
+class BroadcastLedger:
+    """يسجل نتيجة التسليم لكل مستلم في broadcast_deliveries على دفعات، ويحرّك مؤشر الاستئناف.
+    المؤشر (cursor) هو أكبر user_id تم تسجيل نتيجته ونتائج كل من قبله."""
+
+    def __init__(self, job_id, cursor):
+        self.job_id = job_id
+        self.cursor = cursor
+        self._order = deque()   # المستلمون بترتيب الإدخال للمحرك
+        self._done = set()
+        self._buffer = []
+        self._lock = asyncio.Lock()
+
+    async def track(self, recipients):
+        """يمرر المستلمين للمحرك مع تسجيل ترتيبهم."""
+        if hasattr(recipients, '__aiter__'):
+            async for chat_id in recipients:
+                self._order.append(chat_id)
+                yield chat_id
+        else:
+            for chat_id in recipients:
+                self._order.append(chat_id)
+                yield chat_id
+
+    def record(self, chat_id, status):
+        self._done.add(chat_id)
+        self._buffer.append((chat_id, status))
+
+    async def flush(self):
+        async with self._lock:
+            if not self._buffer:
+                return
+            buffer, self._buffer = self._buffer, []
+            advanced = []
+            while self._order and self._order[0] in self._done:
+                advanced.append(self._order.popleft())
+                self._done.discard(advanced[-1])
+            cursor = advanced[-1] if advanced else self.cursor
+            sent = sum(1 for _, status in buffer if status == 'sent')
+            try:
+                await self._write(buffer, cursor, sent)
+            except BaseException:
+                # الكتابة فشلت (أو أُلغيت): تعاد النتائج والمؤشر كما كانا لتُكتب في الدفعة التالية
+                self._buffer[:0] = buffer
+                self._order.extendleft(reversed(advanced))
+                self._done.update(advanced)
+                raise
+            self.cursor = cursor
+
+    async def _write(self, buffer, cursor, sent):
+        async with db_pool.acquire() as connection:
+            async with connection.transaction():
+                await connection.execute(
+                    """
+                    INSERT INTO broadcast_deliveries (job_id, user_id, status)
+                    SELECT $1, u.user_id, u.status FROM UNNEST($2::bigint[], $3::text[]) AS u (user_id, status)
+                    ON CONFLICT (job_id, user_id) DO NOTHING
+                    """,
+                    self.job_id, [chat_id for chat_id, _ in buffer], [status for _, status in buffer]
+                )
+                await connection.execute(
+                    """
+                    UPDATE broadcast_jobs
+                    SET cursor_user_id = GREATEST(cursor_user_id, $2), success_count = success_count + $3, fail_count = fail_count + $4
+                    WHERE job_id = $1
+                    """,
+                    self.job_id, cursor, sent, len(buffer) - sent
+                )
+
+async def create_broadcast_job(payload):
+    async with db_pool.acquire() as connection:
+        return await connection.fetchval(
+            "INSERT INTO broadcast_jobs (from_chat_id, message_id, cleaned_message, is_media) VALUES ($1, $2, $3, $4) RETURNING job_id",
+            payload.from_chat_id, payload.message_id, payload.cleaned_message, payload.is_media
+        )
+
+async def count_broadcast_recipients(job_id, cursor):
+    """يحسب المستلمين الذين لم يُسجل لهم تسليم بعد في هذه المهمة."""
+    async with db_pool.acquire() as connection:
+        return await connection.fetchval(
+            """
+            SELECT COUNT(*)
+            FROM all_users au
+            WHERE au.user_id > $2
+              AND NOT EXISTS (SELECT 1 FROM broadcast_deliveries d WHERE d.job_id = $1 AND d.user_id = au.user_id)
+            """, job_id, cursor
+        )
+
+async def claim_broadcast_job(job_id):
+    """يحجز مهمة بث (بحالة running) لهذه النسخة. في وضع العنقود لا تُحجز مهمة تملكها نسخة أخرى بحجز ساري؛
+    النسخة الوحيدة في الوضع المحلي تحجز دائماً (حتى بعد انهيار لم يحرر الحجز). يُرجع True عند النجاح."""
+    async with db_pool.acquire() as connection:
+        return await connection.fetchval(
+            """
+            UPDATE broadcast_jobs SET owner_instance = $2, lease_expires_at = NOW() + make_interval(secs => $3)
+            WHERE job_id = $1 AND status = 'running'
+              AND (NOT $4 OR owner_instance IS NULL OR owner_instance = $2 OR lease_expires_at < NOW())
+            RETURNING job_id
+            """, job_id, INSTANCE_ID, BROADCAST_LEASE, CLUSTER_MODE
+        ) is not None
+
+async def renew_broadcast_lease(job_id):
+    """يجدد الحجز أثناء الإرسال. يُرجع False إذا لم تعد المهمة لنا أو لم تعد running (أُوقفت من نسخة أخرى)."""
+    async with db_pool.acquire() as connection:
+        return await connection.fetchval(
+            """
+            UPDATE broadcast_jobs SET lease_expires_at = NOW() + make_interval(secs => $3)
+            WHERE job_id = $1 AND owner_instance = $2 AND status = 'running'
+            RETURNING job_id
+            """, job_id, INSTANCE_ID, BROADCAST_LEASE
+        ) is not None
+
+async def release_broadcast_job(job_id):
+    async with db_pool.acquire() as connection:
+        await connection.execute(
+            "UPDATE broadcast_jobs SET owner_instance = NULL, lease_expires_at = NULL WHERE job_id = $1 AND owner_instance = $2",
+            job_id, INSTANCE_ID
+        )
+
+def start_broadcast_job(bot, job_id, status_message=None):
+    stop_event = asyncio.Event()
+    task = asyncio.create_task(run_broadcast_job(bot, job_id, stop_event, status_message))
+    broadcast_jobs_running[job_id] = (stop_event, task)
+    return task
+
+async def run_broadcast_job(bot, job_id, stop_event, status_message=None):
+    """ينفذ (أو يستأنف) مهمة بث محفوظة حتى تكتمل أو يتم إيقافها مؤقتاً/إلغاؤها."""
+    claimed = False
+    try:
+        claimed = await claim_broadcast_job(job_id)
+        if not claimed:
+            logger.info(f"Broadcast job #{job_id} is not running or is owned by another instance; not starting it here.")
+            return
+        async with db_pool.acquire() as connection:
+            job = await connection.fetchrow("SELECT * FROM broadcast_jobs WHERE job_id = $1", job_id)
+        payload = BroadcastPayload(job['from_chat_id'], job['message_id'], job['cleaned_message'], job['is_media'])
+        remaining = await count_broadcast_recipients(job_id, job['cursor_user_id'])
+        recipients = iter_all_users(after_user_id=job['cursor_user_id'], job_id=job_id)
+        stats = BroadcastStats(
+            total=job['success_count'] + job['fail_count'] + remaining,
+            success=job['success_count'],
+            failed=job['fail_count']
+        )
+        ledger = BroadcastLedger(job_id, job['cursor_user_id'])
+
+        if status_message is None:
+            status_message = await bot.send_message(chat_id=ADMIN_ID, text=f"Resuming broadcast job #{job_id} ({remaining} users left)...")
+
+        async def on_progress(current):
+            await status_message.edit_text(f"📣 Broadcast job #{job_id} in progress...\n{current.summary()}")
+
+        async def flush_periodically():
+            while True:
+                await asyncio.sleep(2)
+                try:
+                    await ledger.flush()
+                    if not await renew_broadcast_lease(job_id):
+                        logger.warning(f"Broadcast job #{job_id} was paused, cancelled or taken over elsewhere. Stopping.")
+                        stop_event.set()
+                except Exception as e:
+                    logger.error(f"Failed to flush delivery ledger of broadcast job #{job_id}: {e}")
+
+        flusher = asyncio.create_task(flush_periodically())
+        try:
+            await run_broadcast(bot, ledger.track(recipients), payload, stats, on_progress, on_result=ledger.record, stop_event=stop_event)
+        finally:
+            flusher.cancel()
+            await asyncio.gather(flusher, return_exceptions=True)
+            await ledger.flush()
+
+        if stop_event.is_set():
+            logger.info(f"Broadcast job #{job_id} stopped. {stats.summary()}")
+            return
+
+        async with db_pool.acquire() as connection:
+            await connection.execute("UPDATE broadcast_jobs SET status = 'completed', finished_at = NOW() WHERE job_id = $1", job_id)
+        await bot.send_message(
+            chat_id=ADMIN_ID,
+            text=f"✅ **Broadcast job #{job_id} complete!**\n"
+                 f"Sent successfully to: {stats.success} users.\n"
+                 f"Failed (Bot blocked/Error): {stats.failed} users.\n"
+                 f"{stats.summary()}"
+        )
     except Exception as e:
-        logger.error(f"Error banning user: {e}")
-        await update.message.reply_text(f"❌ An error occurred during the ban process: {e}", protect_content=True)
+        logger.error(f"Broadcast job #{job_id} crashed: {e}")
+    finally:
+        if broadcast_jobs_running.get(job_id, (None, None))[1] is asyncio.current_task():
+            broadcast_jobs_running.pop(job_id, None)
+        if claimed:
+            try:
+                await release_broadcast_job(job_id)
+            except Exception as e:
+                logger.error(f"Failed to release broadcast job #{job_id}: {e}")
+
+broadcast_jobs_adopter = None  # في وضع العنقود: يتبنى دورياً مهاماً تركتها نسخة توقفت
+
+async def adopt_broadcast_jobs(bot):
+    """يبدأ مهام البث الجارية التي لا تملكها نسخة حية (بعد إعادة التشغيل أو توقف نسختها)."""
+    async with db_pool.acquire() as connection:
+        job_ids = [row['job_id'] for row in await connection.fetch(
+            """
+            SELECT job_id FROM broadcast_jobs
+            WHERE status = 'running' AND (NOT $2 OR owner_instance IS NULL OR owner_instance = $1 OR lease_expires_at < NOW())
+            ORDER BY job_id
+            """, INSTANCE_ID, CLUSTER_MODE
+        )]
+    for job_id in job_ids:
+        if job_id not in broadcast_jobs_running:
+            logger.info(f"Resuming broadcast job #{job_id}.")
+            start_broadcast_job(bot, job_id)
+
+async def resume_broadcast_jobs(bot):
+    """يستأنف مهام البث التي قُطعت بسبب إعادة التشغيل، ويتبنى في وضع العنقود مهام النسخ المتوقفة دورياً."""
+    global broadcast_jobs_adopter
+    await adopt_broadcast_jobs(bot)
+    if CLUSTER_MODE and broadcast_jobs_adopter is None:
+        async def adopt_periodically():
+            while True:
+                await asyncio.sleep(BROADCAST_LEASE / 3)
+                try:
+                    await adopt_broadcast_jobs(bot)
+                except Exception as e:
+                    logger.error(f"Failed to check for orphaned broadcast jobs: {e}")
+        broadcast_jobs_adopter = asyncio.create_task(adopt_periodically())
+
+async def stop_broadcast_jobs(timeout=15):
+    """عند الإيقاف: توقف المهام الجارية (تبقى بحالة running لتُستأنف لاحقاً) بعد حفظ سجل التسليم."""
+    global broadcast_jobs_adopter
+    if broadcast_jobs_adopter is not None:
+        broadcast_jobs_adopter.cancel()
+        broadcast_jobs_adopter = None
+    for stop_event, _ in broadcast_jobs_running.values():
+        stop_event.set()
+    tasks = [task for _, task in broadcast_jobs_running.values()]
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    if pending:
+        # بعد المهلة تُلغى المهام حتى لا تستخدم قاعدة البيانات بعد إغلاق الـ pool (تُستأنف من آخر مؤشر محفوظ)
+        logger.warning(f"{len(pending)} broadcast jobs did not stop within {timeout}s. Cancelling them.")
+        for task in pending:
+            task.cancel()
+        _, pending = await asyncio.wait(pending, timeout=5)
+        if pending:
+            logger.error(f"{len(pending)} broadcast jobs are still running after cancellation.")
+
+async def broadcastjob_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إدارة مهام البث: /broadcastjob list | pause <id> | resume <id> | cancel <id>"""
+    user_id = update.message.from_user.id
+    
+    if user_id != ADMIN_ID:
+        await update.message.reply_text(_('admin_denied', DEFAULT_LANG), protect_content=True)
+        return
+
+    usage = "Usage: /broadcastjob list | pause <job_id> | resume <job_id> | cancel <job_id>"
+    if not context.args or context.args[0] not in ('list', 'pause', 'resume', 'cancel'):
+        await update.message.reply_text(usage, protect_content=True)
+        return
+    
+    action = context.args[0]
+    
+    if action == 'list':
+        async with db_pool.acquire() as connection:
+            jobs = await connection.fetch(
+                "SELECT job_id, status, success_count, fail_count, created_at FROM broadcast_jobs ORDER BY job_id DESC LIMIT 10"
+            )
+        if not jobs:
+            await update.message.reply_text("No broadcast jobs yet.", protect_content=True)
+            return
+        lines = [
+            f"#{job['job_id']} [{job['status']}] sent={job['success_count']} failed={job['fail_count']} ({job['created_at']:%Y-%m-%d %H:%M})"
+            for job in jobs
+        ]
+        await update.message.reply_text("📣 Broadcast jobs:\n" + "\n".join(lines), protect_content=True)
+        return
+
+    try:
+        job_id = int(context.args[1])
+    except (IndexError, ValueError):
+        await update.message.reply_text(usage, protect_content=True)
+        return
+
+    async with db_pool.acquire() as connection:
+        if action == 'pause':
+            changed = await connection.fetchval("UPDATE broadcast_jobs SET status = 'paused' WHERE job_id = $1 AND status = 'running' RETURNING job_id", job_id)
+        elif action == 'resume':
+            changed = await connection.fetchval("UPDATE broadcast_jobs SET status = 'running' WHERE job_id = $1 AND status IN ('running', 'paused') RETURNING job_id", job_id)
+        else:
+            changed = await connection.fetchval(
+                "UPDATE broadcast_jobs SET status = 'cancelled', finished_at = NOW() WHERE job_id = $1 AND status IN ('running', 'paused') RETURNING job_id", job_id
+            )
+
+    if not changed:
+        await update.message.reply_text(f"❌ Broadcast job #{job_id} cannot be {action}d from its current state.", protect_content=True)
+        return
+
+    running = broadcast_jobs_running.get(job_id)
+    if action in ('pause', 'cancel') and running:
+        running[0].set()
+    elif action == 'resume':
+        if running and running[0].is_set():
+            # مهمة أُوقفت للتو وما زالت تحفظ سجلها: ننتظر خروجها ثم نبدأ من جديد
+            await asyncio.gather(running[1], return_exceptions=True)
+            running = broadcast_jobs_running.get(job_id)
+        if not running:
+            start_broadcast_job(context.bot, job_id)
+    
+    await update.message.reply_text(f"✅ Broadcast job #{job_id}: {action}d.", protect_content=True)
 
 # --- [دالة البث المعدلة (الأكثر أهمية) - تستخدم copy_message] ---
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -577,9 +2557,6 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await message.reply_text(_('admin_denied', DEFAULT_LANG), protect_content=True)
         return
 
-    # البادئة الثابتة للبرودكاست
-    BROADCAST_PREFIX = "\"🎲 The Techno source 'TTS\" 🎲\n🎲 Announcement 🎲 📣📢\" :\n\n"
-    
     cleaned_message = None # هذا سيحمل الكابشن النظيف (بدون الأمر)
     
     # --- منطق استخراج الرسالة (مُحسن ليعمل مع الكابشن والنص) ---
@@ -612,69 +2589,18 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    all_users = await get_all_users()
+    users_count = await count_all_users()
     
-    if not all_users:
+    if not users_count:
         await message.reply_text("No users found in the database to broadcast to.", protect_content=False)
         return
 
-    success_count = 0
-    fail_count = 0
-    
-    await message.reply_text(f"Starting broadcast to {len(all_users)} users...", protect_content=False)
-    
-    # نستخدم None (نص عادي) لتجنب أي أخطاء في تنسيق البادئة
-    parse_mode_to_use = None
+    payload = BroadcastPayload(user_id, message.message_id, cleaned_message, is_media_broadcast)
+    job_id = await create_broadcast_job(payload)
+    status_message = await message.reply_text(f"Starting broadcast job #{job_id} to {users_count} users...", protect_content=False)
     
-    for target_user_id in all_users:
-        try:
-            # --- [منطق البث] ---
-            
-            # 1. إرسال البادئة كرسالة نصية منفصلة
-            await context.bot.send_message(
-                chat_id=target_user_id,
-                text=BROADCAST_PREFIX,
-                parse_mode=parse_mode_to_use, # نص عادي
-                protect_content=False # إزالة الحماية
-            )
-            
-            if is_media_broadcast:
-                # 2. نسخ الوسائط (الصورة/الفيديو) مع الكابشن النظيف
-                await context.bot.copy_message(
-                    chat_id=target_user_id,
-                    from_chat_id=user_id, # ID الأدمن
-                    message_id=message.message_id,
-                    caption=cleaned_message, # الكابشن النظيف (بدون /broadcast)
-                    parse_mode=None, # إرسال الكابشن كنص عادي (لضمان وصول الروابط كنص)
-                    protect_content=False # إزالة الحماية عن الوسائط
-                )
-
-            elif cleaned_message:
-                # 2. إرسال النص (إذا لم تكن رسالة وسائط)
-                await context.bot.send_message(
-                    chat_id=target_user_id, 
-                    text=cleaned_message, # نرسل رسالة الأدمن النصية بدون البادئة
-                    parse_mode=None, # نص عادي
-                    protect_content=False 
-                ) 
-            
-            success_count += 1
-        except Forbidden:
-            fail_count += 1
-            logger.warning(f"User {target_user_id} blocked the bot. Skipping.")
-        except Exception as e:
-            fail_count += 1
-            logger.error(f"Failed to send broadcast to {target_user_id}: {e}")
-            
-        # إضافة تأخير بسيط (0.5 ثانية) لتجنب حدود المعدل (Rate Limits)
-        await asyncio.sleep(0.5) 
-            
-    await message.reply_text(
-        f"✅ **Broadcast complete!**\n"
-        f"Sent successfully to: {success_count} users.\n"
-        f"Failed (Bot blocked/Error): {fail_count} users.",
-        protect_content=False
-    )
+    # البث يعمل في الخلفية حتى لا يحجز معالج التحديثات طوال مدته، ويُستأنف تلقائياً بعد إعادة التشغيل
+    start_broadcast_job(context.bot, job_id, status_message)
 
 # --- (6) Main Bot Handlers (User Commands) ---
 
@@ -683,16 +2609,9 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     lang_code = await get_user_language(user_id)
     
-    language_buttons = []
-    for code in SUPPORTED_LANGUAGES:
-        name = LANGUAGES[code]['language_name']
-        language_buttons.append([InlineKeyboardButton(name, callback_data=f"set_lang_{code}")])
-        
-    reply_markup = InlineKeyboardMarkup(language_buttons)
-    
     await update.message.reply_text(
         _('settings_text', lang_code),
-        reply_markup=reply_markup,
+        reply_markup=templates.settings_markup,
         parse_mode=constants.ParseMode.MARKDOWN,
         protect_content=True
     )
@@ -711,7 +2630,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
         
     lang_code = await get_user_language(user_id)
-    keyboard = await get_keyboard(lang_code)
+    keyboard = get_keyboard(lang_code)
 
     if not await is_user_subscribed(user_id, context):
         await send_join_channel_message(update, context, lang_code)
@@ -728,6 +2647,32 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             protect_content=True
         )
 
+async def announce_match(context: ContextTypes.DEFAULT_TYPE, user_id, partner_id, lang_code, keyboard):
+    """المرحلة الثانية من المطابقة (بعد تثبيتها عبر match_or_enqueue): إشعار الطرفين بالتوازي.
+    إذا فشل الإشعاران معاً يتم التراجع عن المطابقة وإعادة الشريك لمقدمة الطابور."""
+    logger.info(f"Match found! {user_id} <-> {partner_id}. Lang: {lang_code}")
+    
+    partner_templates = templates.get(await get_user_language(partner_id))
+    
+    # --- المرحلة 2: الإشعارات بالتوازي بعد التثبيت ---
+    results = await asyncio.gather(
+        context.bot.send_message(chat_id=user_id, text=templates.get(lang_code).match_message, reply_markup=keyboard, protect_content=True),
+        context.bot.send_message(chat_id=partner_id, text=partner_templates.match_message, reply_markup=partner_templates.keyboard, protect_content=True),
+        return_exceptions=True
+    )
+    user_error, partner_error = [r if isinstance(r, Exception) else None for r in results]
+    
+    if user_error and partner_error:
+        logger.warning(f"Both match notifications failed ({user_id}: {user_error}; {partner_id}: {partner_error}). Rolling back match.")
+        await end_chat_in_db(user_id)
+        await add_to_wait_queue_db(partner_id, lang_code, front=True)
+        return False
+    if user_error:
+        logger.warning(f"Could not notify {user_id} about match with {partner_id}: {user_error}")
+    if partner_error:
+        logger.warning(f"Could not notify {partner_id} about match with {user_id}: {partner_error}")
+    return True
+
 async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     
@@ -736,7 +2681,7 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     lang_code = await get_user_language(user_id)
-    keyboard = await get_keyboard(lang_code)
+    keyboard = get_keyboard(lang_code)
 
     if not await is_user_subscribed(user_id, context):
         await send_join_channel_message(update, context, lang_code)
@@ -748,57 +2693,14 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(_('search_already_searching', lang_code), protect_content=True)
         return
     
-    async with db_pool.acquire() as connection:
-        async with connection.transaction():
-            current_user_lang = await get_user_language(user_id) 
-            
-            partner_id = await connection.fetchval(
-                """
-                DELETE FROM waiting_queue
-                WHERE user_id = (
-                    SELECT w.user_id 
-                    FROM waiting_queue w
-                    JOIN all_users au ON w.user_id = au.user_id 
-                    WHERE w.user_id != $1 
-                      AND au.language = $2 
-                      AND w.user_id NOT IN (SELECT blocked_id FROM user_blocks WHERE blocker_id = $1)
-                      AND $1 NOT IN (SELECT blocked_id FROM user_blocks WHERE blocker_id = w.user_id)
-                      AND w.user_id NOT IN (SELECT user_id FROM global_bans)
-                    ORDER BY w.timestamp ASC LIMIT 1
-                )
-                RETURNING user_id
-                """, user_id, current_user_lang
-            )
-            
-            if partner_id:
-                # --- دمج رسالة الترحيب والسلامة ---
-                safety_alert_text = _('safety_alert', lang_code)
-                safe_chat_wish_text = _('safe_chat_wish', lang_code)
-                
-                # رسالة العثور على شريك الأصلية
-                original_partner_found = _('partner_found', lang_code)
-                
-                # بناء الرسالة النهائية: الترحيب الأصلي + سطر جديد + التنبيه الأمني + سطر جديد + التمني
-                final_message_user = original_partner_found + "\n\n" + safety_alert_text + "\n\n" + safe_chat_wish_text
-                
-                partner_lang = await get_user_language(partner_id)
-                safety_alert_text_partner = _('safety_alert', partner_lang)
-                safe_chat_wish_text_partner = _('safe_chat_wish', partner_lang)
-                original_partner_found_partner = _('partner_found', partner_lang)
-                
-                final_message_partner = original_partner_found_partner + "\n\n" + safety_alert_text_partner + "\n\n" + safe_chat_wish_text_partner
-                # --- نهاية الدمج ---
-
-
-                await connection.execute("INSERT INTO active_chats (user_id, partner_id) VALUES ($1, $2), ($2, $1)", user_id, partner_id)
-                logger.info(f"Match found! {user_id} <-> {partner_id}. Lang: {current_user_lang}")
-                
-                await context.bot.send_message(chat_id=user_id, text=final_message_user, reply_markup=keyboard, protect_content=True)
-                await context.bot.send_message(chat_id=partner_id, text=final_message_partner, reply_markup=await get_keyboard(partner_lang), protect_content=True)
-            else:
-                await connection.execute("INSERT INTO waiting_queue (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING", user_id)
-                await update.message.reply_text(_('search_wait', lang_code), protect_content=True)
-                logger.info(f"User {user_id} added to DB queue. Lang: {current_user_lang}")
+    current_user_lang = lang_code
+    partner_id = await match_or_enqueue(user_id, current_user_lang)
+    
+    if partner_id:
+        await announce_match(context, user_id, partner_id, current_user_lang, keyboard)
+    else:
+        await update.message.reply_text(_('search_wait', lang_code), protect_content=True)
+        logger.info(f"User {user_id} added to queue. Lang: {current_user_lang}")
 
 async def end_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
@@ -808,7 +2710,7 @@ async def end_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     lang_code = await get_user_language(user_id)
-    keyboard = await get_keyboard(lang_code)
+    keyboard = get_keyboard(lang_code)
 
     if not await is_user_subscribed(user_id, context):
         await send_join_channel_message(update, context, lang_code)
@@ -821,7 +2723,7 @@ async def end_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=user_id, text=_('end_msg_user', lang_code), reply_markup=keyboard, protect_content=True)
         try:
             partner_lang = await get_user_language(partner_id)
-            await context.bot.send_message(chat_id=partner_id, text=_('end_msg_partner', partner_lang), reply_markup=await get_keyboard(partner_lang), protect_content=True)
+            await context.bot.send_message(chat_id=partner_id, text=_('end_msg_partner', partner_lang), reply_markup=get_keyboard(partner_lang), protect_content=True)
         except (Forbidden, BadRequest) as e:
              logger.warning(f"Could not notify partner {partner_id} about chat end: {e}")
     elif await is_user_waiting_db(user_id):
@@ -839,72 +2741,33 @@ async def next_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     lang_code = await get_user_language(user_id)
-    keyboard = await get_keyboard(lang_code)
+    keyboard = get_keyboard(lang_code)
 
     if not await is_user_subscribed(user_id, context):
         await send_join_channel_message(update, context, lang_code)
         return
         
-    partner_id = await end_chat_in_db(user_id)
+    partner_id, partner_id_new, already_waiting = await next_chat_in_db(user_id, lang_code)
     
     if partner_id:
         logger.info(f"Chat ended by {user_id} (via /next). Partner was {partner_id}.")
         await context.bot.send_message(chat_id=user_id, text=_('next_msg_user', lang_code), protect_content=True)
         try:
             partner_lang = await get_user_language(partner_id)
-            await context.bot.send_message(chat_id=partner_id, text=_('end_msg_partner', partner_lang), reply_markup=await get_keyboard(partner_lang), protect_content=True)
+            await context.bot.send_message(chat_id=partner_id, text=_('end_msg_partner', partner_lang), reply_markup=get_keyboard(partner_lang), protect_content=True)
         except (Forbidden, BadRequest) as e:
             logger.warning(f"Could not notify partner {partner_id} about chat end: {e}")
-    elif await is_user_waiting_db(user_id):
+    elif already_waiting:
         await update.message.reply_text(_('next_already_searching', lang_code), protect_content=True)
         return
 
-    async with db_pool.acquire() as connection:
-        async with connection.transaction():
-            current_user_lang = await get_user_language(user_id)
-            
-            partner_id_new = await connection.fetchval(
-                """
-                DELETE FROM waiting_queue
-                WHERE user_id = (
-                    SELECT w.user_id 
-                    FROM waiting_queue w
-                    JOIN all_users au ON w.user_id = au.user_id 
-                    WHERE w.user_id != $1 
-                      AND au.language = $2 
-                      AND w.user_id NOT IN (SELECT blocked_id FROM user_blocks WHERE blocker_id = $1)
-                      AND $1 NOT IN (SELECT blocked_id FROM user_blocks WHERE blocker_id = w.user_id)
-                      AND w.user_id NOT IN (SELECT user_id FROM global_bans)
-                    ORDER BY w.timestamp ASC LIMIT 1
-                )
-                RETURNING user_id
-                """, user_id, current_user_lang
-            )
-            
-            if partner_id_new:
-                # --- دمج رسالة الترحيب والسلامة ---
-                safety_alert_text = _('safety_alert', lang_code)
-                safe_chat_wish_text = _('safe_chat_wish', lang_code)
-                original_partner_found = _('partner_found', lang_code)
-                final_message_user = original_partner_found + "\n\n" + safety_alert_text + "\n\n" + safe_chat_wish_text
-                
-                partner_lang = await get_user_language(partner_id_new)
-                safety_alert_text_partner = _('safety_alert', partner_lang)
-                safe_chat_wish_text_partner = _('safe_chat_wish', partner_lang)
-                original_partner_found_partner = _('partner_found', partner_lang)
-                
-                final_message_partner = original_partner_found_partner + "\n\n" + safety_alert_text_partner + "\n\n" + safe_chat_wish_text_partner
-                # --- نهاية الدمج ---
-
-                await connection.execute("INSERT INTO active_chats (user_id, partner_id) VALUES ($1, $2), ($2, $1)", user_id, partner_id_new)
-                logger.info(f"Match found! {user_id} <-> {partner_id_new}. Lang: {current_user_lang}")
-                
-                await context.bot.send_message(chat_id=user_id, text=final_message_user, reply_markup=keyboard, protect_content=True)
-                await context.bot.send_message(chat_id=partner_id_new, text=final_message_partner, reply_markup=await get_keyboard(partner_lang), protect_content=True)
-            else:
-                await connection.execute("INSERT INTO waiting_queue (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING", user_id)
-                await update.message.reply_text(_('search_wait', lang_code), protect_content=True)
-                logger.info(f"User {user_id} added/remains in DB queue (via /next). Lang: {current_user_lang}")
+    current_user_lang = lang_code
+    
+    if partner_id_new:
+        await announce_match(context, user_id, partner_id_new, current_user_lang, keyboard)
+    else:
+        await update.message.reply_text(_('search_wait', lang_code), protect_content=True)
+        logger.info(f"User {user_id} added/remains in queue (via /next). Lang: {current_user_lang}")
 
 # --- (7) Reporting and Block Handlers ---
 
@@ -916,7 +2779,7 @@ async def block_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     lang_code = await get_user_language(user_id)
-    keyboard = await get_keyboard(lang_code)
+    keyboard = get_keyboard(lang_code)
 
     if not await is_user_subscribed(user_id, context):
         await send_join_channel_message(update, context, lang_code)
@@ -931,7 +2794,7 @@ async def block_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await update.message.reply_text(_('block_not_in_chat', lang_code), reply_markup=keyboard, protect_content=True)
         return
     
-    confirmation_markup, confirm_text = await get_confirmation_keyboard(reported_id, lang_code)
+    confirmation_markup, confirm_text = get_confirmation_keyboard(reported_id, lang_code)
     
     await update.message.reply_text(
         confirm_text,
@@ -949,7 +2812,7 @@ async def handle_block_confirmation(update: Update, context: ContextTypes.DEFAUL
     lang_code = parts[-1] if len(parts) > 2 else DEFAULT_LANG
     
     await query.answer()
-    keyboard = await get_keyboard(lang_code)
+    keyboard = get_keyboard(lang_code)
     
     if data.startswith("cancel_block_"):
         await query.edit_message_text(_('block_cancelled', lang_code))
@@ -958,7 +2821,7 @@ async def handle_block_confirmation(update: Update, context: ContextTypes.DEFAUL
     if data.startswith("confirm_block_"):
         reported_id = int(parts[2])
         
-        await add_user_block(user_id, reported_id) 
+        partner_id = await block_and_end_chat(user_id, reported_id)
         
         if LOG_CHANNEL_ID:
             try:
@@ -973,8 +2836,6 @@ async def handle_block_confirmation(update: Update, context: ContextTypes.DEFAUL
             except Exception as e:
                 logger.error(f"Failed to process report for {reported_id}: {e}")
 
-        partner_id = await end_chat_in_db(user_id)
-        
         await query.edit_message_text(
             _('block_success', lang_code),
             reply_markup=None, 
@@ -986,34 +2847,107 @@ async def handle_block_confirmation(update: Update, context: ContextTypes.DEFAUL
             logger.info(f"Chat ended by {user_id} (via Block & Report). Partner was {reported_id}.")
             try:
                 partner_lang = await get_user_language(reported_id)
-                await context.bot.send_message(chat_id=reported_id, text=_('end_msg_partner', partner_lang), reply_markup=await get_keyboard(partner_lang), protect_content=True)
+                await context.bot.send_message(chat_id=reported_id, text=_('end_msg_partner', partner_lang), reply_markup=get_keyboard(partner_lang), protect_content=True)
             except (Forbidden, BadRequest) as e:
                 logger.warning(f"Could not notify partner {reported_id} about chat end: {e}")
 
-# --- (8) Relay Message Handler ---
-# --- [ [ [ [ هذا هو القسم الذي تم تعديله ] ] ] ] ---
-async def relay_and_log_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    sender_id = update.message.from_user.id
-    message = update.message
-    
-    # --- [1. الأرشفة الشاملة (بصيغة التقرير المُحسَّن)] ---
-    if LOG_CHANNEL_ID and sender_id != ADMIN_ID:
-        
-        # تحديد حالة الاتصال واسترجاع ID الشريك (إذا وجد)
-        partner_id = await get_partner_from_db(sender_id)
-        
+# --- (8) Archive Pipeline (LOG_CHANNEL_ID) ---
+
+class ArchivePipeline:
+    """أرشفة الرسائل في قناة السجل في الخلفية: طابور محدود، دفعات عبر forward_messages،
+    واحترام حدود معدل القناة. عند امتلاء الطابور تُسقط الرسائل وتُحتسب بدل إبطاء المستخدمين."""
+
+    def __init__(self, queue_size, batch_size, flush_interval, rate_per_minute):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._bucket = TokenBucket(rate_per_minute / 60, capacity=max(1, int(rate_per_minute // 4)))
+        self._queue = None
+        self._task = None
+        self._bot = None
+        self.enqueued = 0
+        self.archived = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+    def start(self, bot):
+        self._bot = bot
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, sender_id, message_ids, partner_id):
+        """يضيف رسالة (أو رسائل ألبوم واحد) للأرشفة دون انتظار. تُرجع False إذا أُسقطت بسبب امتلاء الطابور."""
+        if self._queue is None:
+            return False
+        try:
+            self._queue.put_nowait((sender_id, message_ids, partner_id))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Archive queue full ({self.queue_size}). Dropped {self.dropped} messages so far.")
+            return False
+        self.enqueued += 1
+        return True
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stopping = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def _call(self, method, **kwargs):
+        kwargs['rate_limit_args'] = PRIORITY_ARCHIVE
+        await self._bucket.acquire()
+        try:
+            return await method(**kwargs)
+        except RetryAfter as e:
+            self.rate_limited += 1
+            await asyncio.sleep(retry_after_seconds(e))
+            return await method(**kwargs)
+
+    async def _flush(self, batch):
+        # تجميع الرسائل حسب (المرسل، الشريك) حتى تُعاد كلها بطلب واحد وتقرير واحد
+        groups = {}
+        for sender_id, message_ids, partner_id in batch:
+            groups.setdefault((sender_id, partner_id), []).extend(message_ids)
+
+        for (sender_id, partner_id), all_message_ids in groups.items():
+            all_message_ids.sort()
+            for start in range(0, len(all_message_ids), self.batch_size):
+                await self._archive(sender_id, partner_id, all_message_ids[start:start + self.batch_size])
+
+    async def _archive(self, sender_id, partner_id, message_ids):
         try:
-            # 1. إعادة توجيه الرسالة الأصلية أولاً (لتسهيل التبليغ المباشر)
-            forwarded_message = await context.bot.forward_message(
+            forwarded = await self._call(
+                self._bot.forward_messages,
                 chat_id=LOG_CHANNEL_ID,
                 from_chat_id=sender_id,
-                message_id=message.message_id,
+                message_ids=message_ids,
                 disable_notification=True
             )
-            
-            # [ [ [ [ تم تبسيط التقرير ليعرض الأيديات فقط (حسب طلبك) ] ] ] ]
-            log_report = "" 
-            
+            if not forwarded:
+                self.failed += len(message_ids)
+                return
+
             if partner_id:
                 # محادثة نشطة:
                 log_report = (
@@ -1023,29 +2957,247 @@ async def relay_and_log_message(update: Update, context: ContextTypes.DEFAULT_TY
                 )
             else:
                 # رسالة منفردة:
-                # (هذا الجزء كان يعمل لديك، وسيعمل بنفس الشكل المبسط)
                 log_report = (
                     f"الحالة: رسالة منفردة (لا يوجد شريك)\n"
                     f"المرسل (ID): {sender_id}"
                 )
+            if len(message_ids) > 1:
+                log_report += f"\nعدد الرسائل: {len(message_ids)}"
 
-            # 2. إرسال تقرير التوثيق مرتبطاً بالرسالة المُعاد توجيهها
-            await context.bot.send_message(
+            # تقرير التوثيق مرتبط بأول رسالة مُعاد توجيهها في المجموعة
+            await self._call(
+                self._bot.send_message,
                 chat_id=LOG_CHANNEL_ID,
                 text=log_report,
-                parse_mode=None, # <-- تم تعطيل HTML لضمان الإرسال
+                parse_mode=None,
                 disable_notification=True,
-                reply_to_message_id=forwarded_message.message_id # ربط التقرير بالرسالة الأصلية
+                reply_to_message_id=forwarded[0].message_id
             )
-            
+            self.archived += len(message_ids)
         except Exception as e:
-            logger.error(f"Failed to process archive or retrieve partner info for {sender_id}: {e}")
+            self.failed += len(message_ids)
+            logger.error(f"Failed to archive {len(message_ids)} messages from {sender_id}: {e}")
+
+    async def stop(self, timeout=10):
+        """يرسل ما تبقى في الطابور ثم يوقف العامل (بمهلة أقصاها timeout ثانية)."""
+        if self._task is None:
+            return
+        try:
+            self._queue.put_nowait(None)
+            await asyncio.wait_for(self._task, timeout)
+        except (asyncio.QueueFull, asyncio.TimeoutError):
+            self._task.cancel()
+            logger.warning(f"Archive pipeline stopped with {self._queue.qsize()} messages not archived.")
+        self._task = None
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize() if self._queue else 0,
+            'enqueued': self.enqueued,
+            'archived': self.archived,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'rate_limited': self.rate_limited,
+        }
+
+archive_pipeline = ArchivePipeline(ARCHIVE_QUEUE_SIZE, ARCHIVE_BATCH_SIZE, ARCHIVE_FLUSH_INTERVAL, ARCHIVE_RATE_PER_MINUTE)
+
+# --- (9) Relay Message Handler ---
+# --- [ [ [ [ هذا هو القسم الذي تم تعديله ] ] ] ] ---
+class RelayEngine:
+    """يمرر رسائل المحادثة للشريك: النص بـ send_message مع البادئة، وكل الأنواع الأخرى بـ copy_message
+    (مع إعادة كتابة الكابشن بالبادئة للأنواع التي تقبله). يسجل زمن التمرير لكل نوع."""
+
+    # الترتيب مهم: رسالة الـ animation تحمل document أيضاً، والـ venue تحمل location
+    CAPTION_TYPES = ('photo', 'video', 'animation', 'document', 'audio', 'voice')
+    PLAIN_TYPES = ('video_note', 'sticker', 'venue', 'location', 'poll', 'dice', 'checklist')
+    # كيانات تحمل رابطاً أو هوية غير ظاهرة في النص (فلا يراها content_filter): تُحذف قبل التمرير
+    HIDDEN_TARGET_ENTITIES = (MessageEntity.TEXT_LINK, MessageEntity.TEXT_MENTION, MessageEntity.URL)
+    ALBUM_MEDIA = {'photo': InputMediaPhoto, 'video': InputMediaVideo, 'document': InputMediaDocument, 'audio': InputMediaAudio}
+
+    def __init__(self):
+        self.counts = {}
+        self.max_latency = {}
+        self._latencies = {}
+
+    @classmethod
+    def message_type(cls, message):
+        """نوع المحتوى القابل للتمرير، أو None لرسائل الخدمة وما لا يمكن نسخه."""
+        if message.text:
+            return 'text'
+        for message_type in cls.CAPTION_TYPES + cls.PLAIN_TYPES:
+            if getattr(message, message_type, None):
+                return message_type
+        return None
+
+    @classmethod
+    def entities(cls, prefix, entities):
+        """كيانات التنسيق الآمنة فقط، مزاحة بطول البادئة."""
+        return MessageEntity.shift_entities(prefix, [entity for entity in entities or () if entity.type not in cls.HIDDEN_TARGET_ENTITIES])
+
+    async def relay(self, bot, message, partner_id, prefix, protect=True):
+        """يمرر الرسالة بطلب API واحد. يُرجع نوعها أو None إذا لم تكن قابلة للتمرير."""
+        message_type = self.message_type(message)
+        if message_type is None:
+            return None
+        started = time.perf_counter()
+        if message_type == 'text':
+            await bot.send_message(
+                chat_id=partner_id, text=prefix + message.text,
+                entities=self.entities(prefix, message.entities), protect_content=protect
+            )
+        elif message_type in self.CAPTION_TYPES:
+            await bot.copy_message(
+                chat_id=partner_id, from_chat_id=message.chat_id, message_id=message.message_id,
+                caption=prefix + (message.caption or ""),
+                caption_entities=self.entities(prefix, message.caption_entities), protect_content=protect
+            )
+        else:
+            await bot.copy_message(chat_id=partner_id, from_chat_id=message.chat_id, message_id=message.message_id, protect_content=protect)
+        self.record(message_type, time.perf_counter() - started)
+        return message_type
+
+    async def relay_album(self, bot, messages, partner_id, prefix, protect=True):
+        """يمرر عناصر ألبوم واحد بطلب sendMediaGroup واحد. البادئة تُضاف لكابشن العنصر الأول فقط."""
+        media = []
+        for index, message in enumerate(messages):
+            message_type = self.message_type(message)
+            if message_type not in self.ALBUM_MEDIA:
+                # عنصر لا يقبله sendMediaGroup: تمرير العناصر واحداً واحداً
+                for item in messages:
+                    await self.relay(bot, item, partner_id, prefix, protect)
+                return
+            attachment = message.photo[-1] if message_type == 'photo' else getattr(message, message_type)
+            caption, caption_entities = message.caption, self.entities("", message.caption_entities)
+            if index == 0:
+                caption, caption_entities = prefix + (caption or ""), self.entities(prefix, message.caption_entities)
+            extra = {'has_spoiler': message.has_media_spoiler} if message_type in ('photo', 'video') else {}
+            media.append(self.ALBUM_MEDIA[message_type](attachment.file_id, caption=caption, caption_entities=caption_entities, **extra))
+        started = time.perf_counter()
+        await bot.send_media_group(chat_id=partner_id, media=media, protect_content=protect)
+        self.record('album', time.perf_counter() - started)
+
+    def record(self, message_type, latency):
+        self.counts[message_type] = self.counts.get(message_type, 0) + 1
+        self.max_latency[message_type] = max(self.max_latency.get(message_type, 0.0), latency)
+        self._latencies.setdefault(message_type, deque(maxlen=200)).append(latency)
+
+    def stats(self):
+        """{type: {'count', 'p50_ms', 'max_ms'}} للأنواع التي مُررت."""
+        result = {}
+        for message_type, count in self.counts.items():
+            latencies = sorted(self._latencies[message_type])
+            result[message_type] = {
+                'count': count,
+                'p50_ms': round(latencies[len(latencies) // 2] * 1000, 1),
+                'max_ms': round(self.max_latency[message_type] * 1000, 1),
+            }
+        return result
+
+relay_engine = RelayEngine()
+
+class AlbumBuffer:
+    """يجمع عناصر الألبوم الواحد (نفس media_group_id) التي تصل كتحديثات منفصلة، ثم يعالجها كوحدة
+    بعد `wait` ثانية من آخر عنصر (وبحد أقصى `max_wait` من أوله). ألبومات نفس المرسل تُعالج بالترتيب."""
+
+    def __init__(self, wait, max_wait, handler):
+        self.wait = wait
+        self.max_wait = max_wait
+        self.handler = handler  # async handler(update, context, messages, partner_id)
+        self._pending = {}   # sender_id -> {media_group_id: album}
+        self._inflight = {}  # sender_id -> المهمة التي تعالج ألبوماته حالياً
+        self.albums = 0
+        self.items = 0
+
+    def add(self, update, context, partner_id):
+        """partner_id هو شريك المرسل عند وصول العنصر: الألبوم يُمرر لشريك أول عنصر فيه حتى لو تغير الشريك
+        (التالي / إنهاء) قبل انتهاء المهلة."""
+        message = update.message
+        sender_id = message.from_user.id
+        albums = self._pending.setdefault(sender_id, {})
+        album = albums.get(message.media_group_id)
+        now = time.monotonic()
+        if album is None:
+            album = albums[message.media_group_id] = {
+                'update': update, 'context': context, 'partner_id': partner_id, 'messages': [], 'started': now, 'timer': None,
+            }
+        else:
+            album['timer'].cancel()
+        album['messages'].append(message)
+        self.items += 1
+        delay = max(0.0, min(self.wait, album['started'] + self.max_wait - now))
+        album['timer'] = asyncio.get_running_loop().call_later(delay, self._due, sender_id, message.media_group_id)
+
+    def _due(self, sender_id, media_group_id):
+        albums = self._pending.get(sender_id, {})
+        album = albums.pop(media_group_id, None)
+        if not albums:
+            self._pending.pop(sender_id, None)
+        if album:
+            self._start(sender_id, [album])
+
+    def _start(self, sender_id, albums):
+        task = asyncio.create_task(self._run(sender_id, self._inflight.get(sender_id), albums))
+        self._inflight[sender_id] = task
+        task.add_done_callback(lambda done: self._inflight.pop(sender_id, None) if self._inflight.get(sender_id) is done else None)
+
+    async def _run(self, sender_id, previous, albums):
+        if previous:
+            await asyncio.gather(previous, return_exceptions=True)
+        for album in albums:
+            self.albums += 1
+            try:
+                await self.handler(album['update'], album['context'], sorted(album['messages'], key=lambda item: item.message_id), album['partner_id'])
+            except Exception as e:
+                logger.error(f"Failed to relay album from {sender_id}: {e}")
+
+    async def flush_sender(self, sender_id):
+        """يعالج فوراً أي ألبوم معلق للمرسل وينتظر انتهاءه (قبل تمرير رسالة لاحقة منه)."""
+        albums = self._pending.pop(sender_id, None)
+        if albums:
+            for album in albums.values():
+                album['timer'].cancel()
+            self._start(sender_id, list(albums.values()))
+        task = self._inflight.get(sender_id)
+        if task:
+            await task
+
+    async def stop(self):
+        for sender_id in list(self._pending):
+            await self.flush_sender(sender_id)
+        if self._inflight:
+            await asyncio.gather(*self._inflight.values(), return_exceptions=True)
+
+    def stats(self):
+        return {'albums': self.albums, 'items': self.items, 'pending': sum(len(albums) for albums in self._pending.values())}
+
+async def relay_and_log_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    
+    # عناصر الألبوم تصل كتحديثات منفصلة: تُجمع وتُمرر وتُؤرشف كوحدة واحدة
+    if message.media_group_id:
+        album_buffer.add(update, context, await get_partner_from_db(message.from_user.id))
+        return
+    
+    # أي ألبوم معلق لنفس المرسل يُمرر أولاً حتى لا يختل ترتيب الرسائل
+    await album_buffer.flush_sender(message.from_user.id)
+    await relay_messages(update, context, [message], await get_partner_from_db(message.from_user.id))
+
+async def relay_messages(update: Update, context: ContextTypes.DEFAULT_TYPE, messages, partner_id):
+    """يؤرشف ويمرر رسالة واحدة أو عناصر ألبوم واحد إلى partner_id (شريك المرسل لحظة وصول الرسالة).
+    الردود على المرسل تكون على أول رسالة."""
+    sender_id = update.message.from_user.id
+    message = update.message
+    
+    # --- [1. الأرشفة الشاملة (في الخلفية عبر archive_pipeline)] ---
+    if LOG_CHANNEL_ID and sender_id != ADMIN_ID:
+        archive_pipeline.submit(sender_id, [item.message_id for item in messages], partner_id)
             
-    # --- [2. منع الأدمن من الدخول في هذا المستجيب إذا كان الأمر برودكاست] ---
+    # --- [2. منع الأدمن من الدخول في هذا المستجيب إذا كان الأمر برودكاست أو ملف حظر] ---
     if sender_id == ADMIN_ID:
         raw_text = message.caption if message.caption else message.text
-        if raw_text and raw_text.startswith("/broadcast"):
-            return # توقف، سيتم معالجتها بواسطة broadcast_command
+        if raw_text and raw_text.startswith(("/broadcast", "/banuser")):
+            return # توقف، سيتم معالجتها بواسطة broadcast_command / banuser_command
 
     # --- (3. منطق التحكم والدردشة) ---
     if await is_user_globally_banned(sender_id):
@@ -1058,23 +3210,20 @@ async def relay_and_log_message(update: Update, context: ContextTypes.DEFAULT_TY
         await send_join_channel_message(update, context, lang_code)
         return
     
-    partner_id = await get_partner_from_db(sender_id)
-    
     # الرد إذا لم يكن في محادثة:
     if not partner_id:
-        await message.reply_text(_('not_in_chat_msg', lang_code), reply_markup=await get_keyboard(lang_code), protect_content=True)
+        await message.reply_text(_('not_in_chat_msg', lang_code), reply_markup=get_keyboard(lang_code), protect_content=True)
         return
 
-    if message.text or message.caption:
-        text_to_check = message.text or message.caption
+    for item in messages:
+        text_to_check = item.text or item.caption
+        if not text_to_check:
+            continue
 
         # هذا المنطق يمنع الروابط واليوزرات للمستخدمين العاديين (الدردشة المجهولة)
-        if URL_PATTERN.search(text_to_check):
-            await message.reply_text(_('link_blocked', lang_code), reply_markup=await get_keyboard(lang_code), protect_content=True)
-            return
-        
-        if '@' in text_to_check:
-            await message.reply_text(_('username_blocked', lang_code), reply_markup=await get_keyboard(lang_code), protect_content=True)
+        verdict = content_filter.check(text_to_check, lang_code)
+        if verdict.rule:
+            await item.reply_text(_(f'{verdict.rule}_blocked', lang_code), reply_markup=get_keyboard(lang_code), protect_content=True)
             return
             
     try:
@@ -1084,38 +3233,217 @@ async def relay_and_log_message(update: Update, context: ContextTypes.DEFAULT_TY
         partner_lang = await get_user_language(partner_id)
         prefix = _('partner_prefix', partner_lang)
         
-        # تمرير الرسالة للشريك (مع الحماية والتخصيص)
-        if message.photo: 
-            final_caption = prefix + (message.caption if message.caption else "")
-            await context.bot.send_photo(chat_id=partner_id, photo=message.photo[-1].file_id, caption=final_caption, protect_content=protect)
-        elif message.document: 
-            final_caption = prefix + (message.caption if message.caption else "")
-            await context.bot.send_document(chat_id=partner_id, document=message.document.file_id, caption=final_caption, protect_content=protect)
-        elif message.video: 
-            final_caption = prefix + (message.caption if message.caption else "")
-            await context.bot.send_video(chat_id=partner_id, video=message.video.file_id, caption=final_caption, protect_content=protect)
-        elif message.sticker: 
-            await context.bot.send_sticker(chat_id=partner_id, sticker=message.sticker.file_id, protect_content=protect)
-        elif message.voice: 
-            final_caption = prefix + (message.caption if message.caption else "")
-            await context.bot.send_voice(chat_id=partner_id, voice=message.voice.file_id, caption=final_caption, protect_content=protect)
-        elif message.text: 
-            prefixed_text = prefix + message.text
-            await context.bot.send_message(chat_id=partner_id, text=prefixed_text, protect_content=protect)
+        # تمرير الرسالة للشريك (مع الحماية والتخصيص) بطلب واحد لأي نوع، والألبوم بطلب واحد كذلك
+        if len(messages) > 1:
+            await relay_engine.relay_album(context.bot, messages, partner_id, prefix, protect)
+        elif not await relay_engine.relay(context.bot, message, partner_id, prefix, protect):
+            logger.debug(f"Not relaying non-content message {message.message_id} from {sender_id}")
         
     except (Forbidden, BadRequest) as e:
         if "bot was blocked" in str(e).lower() or "user is deactivated" in str(e).lower() or "chat not found" in str(e).lower():
             logger.warning(f"Partner {partner_id} is unreachable. Ending chat initiated by {sender_id}.")
-            await end_chat_in_db(sender_id)
-            await message.reply_text(_('unreachable_partner', lang_code), reply_markup=await get_keyboard(lang_code), protect_content=True)
+            # ألبوم متأخر قد يخص محادثة سابقة: لا ننهي محادثة المرسل الحالية بسببه
+            if await get_partner_from_db(sender_id) == partner_id:
+                await end_chat_in_db(sender_id)
+            await message.reply_text(_('unreachable_partner', lang_code), reply_markup=get_keyboard(lang_code), protect_content=True)
         else:
             logger.error(f"Failed to send to partner {partner_id}: {e}")
             await message.reply_text("Sorry, your message failed to send. (Your partner might be temporarily unreachable).", protect_content=True)
     except Exception as e:
         logger.error(f"An unexpected error occurred sending from {sender_id} to {partner_id}: {e}")
+
+album_buffer = AlbumBuffer(ALBUM_WAIT, ALBUM_MAX_WAIT, relay_messages)
 # --- [ [ [ [ نهاية القسم المعدل ] ] ] ] ---
 
-# --- (9) Main Run Function ---
+class ButtonRouter:
+    """موزع واحد لكل رسائل الخاص غير الأوامر: نص الزر (بكل اللغات) -> الإجراء عبر قاموس واحد،
+    وأي رسالة أخرى تذهب للتمرير. الجدول يُعاد بناؤه تلقائياً عند إعادة تحميل الترجمات."""
+
+    def __init__(self, actions, fallback):
+        self.actions = actions
+        self.fallback = fallback
+        self._button_keys = None
+        self._routes = {}
+
+    def resolve(self, text):
+        """الإجراء المرتبط بنص الزر، أو None إذا لم يكن النص زراً."""
+        button_keys = catalogs.button_keys
+        if button_keys is not self._button_keys:
+            self._routes = {text: self.actions[key] for text, key in button_keys.items()}
+            self._button_keys = button_keys
+        return self._routes.get(text)
+
+    async def __call__(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        text = update.message.text if update.message else None
+        action = self.resolve(text) if text else None
+        await (action or self.fallback)(update, context)
+
+button_router = ButtonRouter(
+    {'search_btn': search_command, 'next_btn': next_command, 'block_btn': block_user_command, 'stop_btn': end_command},
+    relay_and_log_message
+)
+
+# --- (10) Concurrent Update Processing ---
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """يعالج التحديثات بالتوازي بعدد عمال محدود، مع الحفاظ على ترتيب تحديثات نفس المستخدم
+    وترتيب تحديثات طرفي المحادثة النشطة (حتى لا يختل ترتيب الرسائل المُمررة)."""
+
+    def __init__(self, workers, max_pending):
+        super().__init__(max_pending)
+        self.workers = workers
+        self._worker_slots = None
+        self._locks = {}  # user_id -> [asyncio.Lock, عدد المنتظرين]
+        self.waiting = 0
+        self.processed = 0
+        self.max_latency = 0.0
+        self._latencies = deque(maxlen=1000)
+
+    async def initialize(self) -> None:
+        self._worker_slots = asyncio.Semaphore(self.workers)
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _ordering_keys(self, update):
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            return ()
+        keys = {user.id}
+        state = user_states.peek(user.id)
+        if state is not None and state.partner_id:
+            keys.add(state.partner_id)
+        # ترتيب ثابت للأقفال لتجنب الـ deadlock بين طرفي المحادثة
+        return sorted(keys)
+
+    async def _acquire(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        await entry[0].acquire()
+
+    def _release(self, key):
+        entry = self._locks[key]
+        entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+
+    async def do_process_update(self, update, coroutine) -> None:
+        started = time.perf_counter()
+        keys = self._ordering_keys(update)
+        acquired = []
+        self.waiting += 1
+        try:
+            for key in keys:
+                await self._acquire(key)
+                acquired.append(key)
+            async with self._worker_slots:
+                self.waiting -= 1
+                try:
+                    await coroutine
+                finally:
+                    self.waiting += 1
+        finally:
+            self.waiting -= 1
+            for key in reversed(acquired):
+                self._release(key)
+            latency = time.perf_counter() - started
+            self.processed += 1
+            self.max_latency = max(self.max_latency, latency)
+            self._latencies.append(latency)
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        p50 = latencies[len(latencies) // 2] if latencies else 0.0
+        p99 = latencies[max(int(len(latencies) * 0.99) - 1, 0)] if latencies else 0.0
+        return {
+            'workers': self.workers,
+            'waiting': self.waiting,
+            'processed': self.processed,
+            'p50_ms': round(p50 * 1000, 1),
+            'p99_ms': round(p99 * 1000, 1),
+            'max_ms': round(self.max_latency * 1000, 1),
+        }
+
+update_processor = OrderedUpdateProcessor(UPDATE_WORKERS, UPDATE_MAX_PENDING)
+
+# --- (11) Webhook Server ---
+
+def build_webhook_app(application: Application):
+    """ينشئ تطبيق tornado يستقبل التحديثات من تيليجرام مع نقطة فحص الصحة."""
+    import tornado.web
+
+    class TelegramWebhookHandler(tornado.web.RequestHandler):
+        async def post(self):
+            received_token = self.request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            # نقارن bytes: compare_digest يرمي TypeError على نص غير ASCII فيتحول الرفض إلى 500
+            if not hmac.compare_digest(received_token.encode(), WEBHOOK_SECRET_TOKEN.encode()):
+                logger.warning(f"Rejected webhook request with invalid secret token from {self.request.remote_ip}.")
+                self.set_status(403)
+                return
+            try:
+                update = Update.de_json(json.loads(self.request.body), application.bot)
+            except Exception as e:
+                logger.error(f"Invalid webhook payload: {e}")
+                self.set_status(400)
+                return
+            await application.update_queue.put(update)
+            self.set_status(200)
+
+    class HealthHandler(tornado.web.RequestHandler):
+        def get(self):
+            # 503 حتى تجهز قاعدة البيانات، كي لا يرسل موازن الحمل تحديثات لنسخة لا تستطيع معالجتها
+            if not db_pool:
+                self.set_status(503)
+            self.write({
+                'status': 'ok' if db_pool else 'starting',
+                'update_queue': application.update_queue.qsize(),
+                'updates': update_processor.stats(),
+                'waiting_users': sum(matchmaker.stats().values()),
+            })
+
+    return tornado.web.Application([
+        (rf"/{WEBHOOK_PATH}", TelegramWebhookHandler),
+        (r"/healthz", HealthHandler),
+    ])
+
+async def run_webhook_server(application: Application):
+    """يشغّل البوت في وضع webhook. يمكن تشغيل عدة نسخ خلف موازن حمل بنفس الإعدادات."""
+    import tornado.httpserver
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    await post_database_init(application)
+    if WEBHOOK_SET_ON_START:
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES
+        )
+    await application.start()
+
+    server = tornado.httpserver.HTTPServer(build_webhook_app(application), xheaders=True)
+    server.listen(WEBHOOK_PORT, address=WEBHOOK_LISTEN)
+    logger.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Shutting down webhook server...")
+        server.stop()
+        await application.stop()
+        await post_bot_stop(application)
+        await application.shutdown()
+        await post_bot_shutdown(application)
+
+# --- (12) Main Run Function ---
 
 def main():
     if not TELEGRAM_TOKEN:
@@ -1126,6 +3454,10 @@ def main():
         Application.builder()
         .token(TELEGRAM_TOKEN)
         .post_init(post_database_init)
+        .post_stop(post_bot_stop)
+        .post_shutdown(post_bot_shutdown)
+        .concurrent_updates(update_processor)
+        .rate_limiter(outbound_scheduler)
         .build()
     )
 
@@ -1163,6 +3495,14 @@ def main():
     # 5. بقية أوامر الأدمن
     application.add_handler(CommandHandler("sendid", sendid_command, filters=admin_filter), group=1) 
     application.add_handler(CommandHandler("banuser", banuser_command, filters=admin_filter), group=1)
+    # 6. الحظر بالجملة من ملف IDs مرفق مع /banuser في الكابشن
+    application.add_handler(MessageHandler(
+        admin_filter & filters.Document.ALL & filters.CaptionRegex(r'^/banuser'),
+        banuser_command
+    ), group=1)
+    application.add_handler(CommandHandler("stats", stats_command, filters=admin_filter), group=1)
+    application.add_handler(CommandHandler("broadcastjob", broadcastjob_command, filters=admin_filter), group=1)
+    application.add_handler(CommandHandler("reloadlang", reloadlang_command, filters=admin_filter), group=1)
     # -----------------------------------
     
     application.add_handler(CommandHandler("start", start_command), group=3)
@@ -1171,26 +3511,25 @@ def main():
     application.add_handler(CommandHandler("next", next_command), group=3)
     application.add_handler(CommandHandler("settings", settings_command), group=3)
     
-    search_texts = [lang['search_btn'] for lang in LANGUAGES.values()]
-    stop_texts = [lang['stop_btn'] for lang in LANGUAGES.values()]
-    next_texts = [lang['next_btn'] for lang in LANGUAGES.values()]
-    block_texts = [lang['block_btn'] for lang in LANGUAGES.values()]
-
-    application.add_handler(MessageHandler(filters.Text(search_texts), search_command), group=4) 
-    application.add_handler(MessageHandler(filters.Text(stop_texts), end_command), group=4)   
-    application.add_handler(MessageHandler(filters.Text(next_texts), next_command), group=4)   
-    application.add_handler(MessageHandler(filters.Text(block_texts), block_user_command), group=4) 
-    
-    all_button_texts = search_texts + stop_texts + next_texts + block_texts
-    
-    # المستجيب العام لأي رسالة ليست أمر وليست زر (يشمل كل أنواع الرسائل لغرض الأرشفة الشاملة)
-    application.add_handler(MessageHandler(
-        filters.ChatType.PRIVATE & ~filters.COMMAND & ~filters.Text(all_button_texts),
-        relay_and_log_message
-    ), group=5)
+    # مستجيب واحد لأزرار لوحة المفاتيح وبقية الرسائل (يشمل كل أنواع الرسائل لغرض الأرشفة الشاملة)
+    application.add_handler(MessageHandler(filters.ChatType.PRIVATE & ~filters.COMMAND, button_router), group=4)
 
-    logger.info("Bot setup complete. Starting polling...")
-    application.run_polling()
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_URL and WEBHOOK_SET_ON_START:
+            logger.critical("CRITICAL: WEBHOOK_URL is required in webhook mode.")
+            return
+        if not WEBHOOK_SECRET_TOKEN:
+            logger.critical("CRITICAL: WEBHOOK_SECRET_TOKEN is required in webhook mode.")
+            return
+        logger.info("Bot setup complete. Starting webhook server...")
+        asyncio.run(run_webhook_server(application))
+    else:
+        logger.info("Bot setup complete. Starting polling...")
+        application.run_polling()
 
 if __name__ == "__main__":
+    # البوت لا يأخذ أي وسائط؛ أدوات التطوير والإدارة (المقاييس، check-schema، export/import) في tools.py
+    if len(sys.argv) > 1:
+        print(f"Usage: python Rp.py (unexpected arguments: {' '.join(sys.argv[1:])}). Dev and admin tools: python tools.py", file=sys.stderr)
+        sys.exit(2)
     main()
@@ -0,0 +1,743 @@
+"""أدوات التطوير والإدارة الخاصة بـ Rp.py: المقاييس، اختبارات الحمل، فحص الـ schema، ونقل الجداول بالجملة.
+لا تشغّل البوت؛ كل أداة تستورد Rp وتستخدم نفس الإعدادات (متغيرات البيئة) ونفس الدوال.
+
+    python tools.py webhook-harness <url> [count] [concurrency]
+    python tools.py broadcast-bench [recipients] [latency_ms]
+    python tools.py check-schema
+    python tools.py match-loadtest [processes] [users] [rounds]
+    python tools.py dispatch-bench [iterations]
+    python tools.py outbound-bench [seconds] [latency_ms]
+    python tools.py db-bench [seconds] [concurrency] [users]
+    python tools.py filter-bench [iterations] [seed]
+    python tools.py export|import <all_users|user_blocks|global_bans|all> <path>
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import asyncpg
+from collections import deque
+from telegram import Update, constants
+from telegram.error import Forbidden, RetryAfter
+from telegram.ext import MessageHandler, filters
+
+import Rp
+from Rp import (
+    _, _load_user_state, ADMIN_ID, ARCHIVE_FLUSH_INTERVAL, BROADCAST_CONCURRENCY, BUTTON_KEYS, DATABASE_URL,
+    DB_POOL_MAX_SIZE, DB_POOL_MIN_SIZE, DB_STATEMENT_CACHE_SIZE, DEFAULT_LANG, OUTBOUND_CHAT_BURST, OUTBOUND_CHAT_RATE,
+    OUTBOUND_GROUP_RATE_PER_MINUTE, OUTBOUND_MAX_RETRIES, OUTBOUND_RATE, PRIORITY_ARCHIVE, PRIORITY_BROADCAST,
+    PRIORITY_NAMES, PRIORITY_USER, SUPPORTED_LANGUAGES, WEBHOOK_SECRET_TOKEN, BroadcastPayload, BroadcastStats,
+    OutboundScheduler, button_router, catalogs, content_filter, create_db_pool, end_chat_in_db, match_or_enqueue,
+    remove_from_wait_queue_db, run_broadcast, run_migrations,
+)
+
+# استعلام اختيار الشريك داخل الدالة match_or_enqueue (الترحيل 5)، بالمعاملين $1/$2 بدل p_user_id/p_language.
+# check_schema يتأكد أنه مطابق لنص الدالة المثبتة قبل فحص خطته، حتى لا يُفحص استعلام لم يعد يعمل.
+MATCH_CANDIDATE_QUERY = """
+    SELECT w.user_id
+    FROM waiting_queue w
+    WHERE w.language = $2
+      AND w.user_id != $1
+      AND NOT EXISTS (SELECT 1 FROM user_blocks b WHERE b.blocker_id = $1 AND b.blocked_id = w.user_id)
+      AND NOT EXISTS (SELECT 1 FROM user_blocks b WHERE b.blocker_id = w.user_id AND b.blocked_id = $1)
+      AND NOT EXISTS (SELECT 1 FROM global_bans g WHERE g.user_id = w.user_id)
+    ORDER BY w."timestamp" ASC
+    LIMIT 1
+    FOR UPDATE OF w SKIP LOCKED
+"""
+
+# استعلامات المسار الساخن كما يرسلها البوت، وقيم معاملاتها، والفهارس التي يجب أن تظهر في خطة كل منها
+# (يُفحص عبر: python tools.py check-schema)
+EXPLAIN_CHECKS = [
+    ('user state', Rp.USER_STATE_QUERY, "(42)",
+     {'all_users_pkey', 'global_bans_pkey', 'active_chats_pkey'}),
+    ('waiting check', Rp.IS_WAITING_QUERY, "(42)",
+     {'waiting_queue_pkey'}),
+    ('match candidate', MATCH_CANDIDATE_QUERY, "(42, 'en')",
+     {'waiting_queue_language_timestamp_idx', 'user_blocks_pkey', 'global_bans_pkey'}),
+    ('broadcast recipients page', Rp.ALL_USERS_PAGE_QUERY, "(42, 1000, 1)",
+     {'all_users_pkey', 'broadcast_deliveries_pkey'}),
+]
+
+def _plan_indexes(plan):
+    """يجمع أسماء الفهارس المستخدمة في خطة EXPLAIN (FORMAT JSON)."""
+    found = set()
+    if 'Index Name' in plan:
+        found.add(plan['Index Name'])
+    for child in plan.get('Plans', []):
+        found |= _plan_indexes(child)
+    return found
+
+def _normalize_sql(sql):
+    return ' '.join(sql.replace(';', ' ').split())
+
+async def check_schema():
+    """فحص انحدار على قاعدة محلية: يطبق الترحيلات في schema مؤقت ويملؤه ببيانات تجريبية،
+    ثم يتأكد عبر EXPLAIN أن الاستعلامات الساخنة الفعلية تستخدم فهارسها بإعدادات المخطط الافتراضية،
+    بخطة مخصصة (أول التنفيذات) وخطة عامة (ما تنتهي إليه الاستعلامات المحضرة ودوال plpgsql). لا يلمس الجداول الحقيقية."""
+    connection = await asyncpg.connect(DATABASE_URL)
+    failures = 0
+    try:
+        await connection.execute("DROP SCHEMA IF EXISTS explain_check CASCADE")
+        await connection.execute("CREATE SCHEMA explain_check")
+        await connection.execute("SET search_path TO explain_check")
+        await run_migrations(connection)
+        versions = [row['version'] for row in await connection.fetch("SELECT version FROM schema_migrations ORDER BY version")]
+        print(f"Applied migrations: {versions}")
+
+        await connection.execute('''
+            INSERT INTO all_users (user_id, language)
+            SELECT g, (ARRAY['en', 'ar', 'es'])[1 + g % 3] FROM generate_series(1, 50000) g;
+            INSERT INTO waiting_queue (user_id, language, "timestamp")
+            SELECT user_id, language, NOW() - user_id * INTERVAL '1 second' FROM all_users WHERE user_id % 10 = 0;
+            INSERT INTO active_chats (user_id, partner_id)
+            SELECT g, g # 1 FROM generate_series(2, 10001) g WHERE g % 10 != 0 AND (g # 1) % 10 != 0;
+            INSERT INTO user_blocks (blocker_id, blocked_id)
+            SELECT g, (g * 7919) % 50000 + 1 FROM generate_series(1, 50000) g;
+            INSERT INTO global_bans (user_id) SELECT g FROM generate_series(7, 50000, 97) g;
+            INSERT INTO broadcast_jobs (job_id, from_chat_id, message_id)
+            SELECT g, 1, 1 FROM generate_series(1, 3) g;
+            INSERT INTO broadcast_deliveries (job_id, user_id, status)
+            SELECT 1 + g % 3, g, 'sent' FROM generate_series(1, 50000) g;
+            ANALYZE;
+        ''')
+
+        # الاستعلام المنسوخ يجب أن يطابق ما تنفذه الدالة فعلاً
+        function_source = _normalize_sql(await connection.fetchval("SELECT prosrc FROM pg_proc WHERE proname = 'match_or_enqueue'"))
+        installed_query = _normalize_sql(
+            MATCH_CANDIDATE_QUERY.replace('$1', 'p_user_id').replace('$2', 'p_language')
+            .replace('SELECT w.user_id', 'SELECT w.user_id INTO v_partner', 1)
+        )
+        if installed_query in function_source:
+            print("OK   match candidate query matches match_or_enqueue()")
+        else:
+            failures += 1
+            print("FAIL match candidate query differs from match_or_enqueue(): update MATCH_CANDIDATE_QUERY")
+
+        for plan_cache_mode in ('force_custom_plan', 'force_generic_plan'):
+            await connection.execute(f"SET plan_cache_mode = {plan_cache_mode}")
+            for label, query, arguments, expected_indexes in EXPLAIN_CHECKS:
+                await connection.execute(f"PREPARE hot_query AS {query}")
+                try:
+                    plan = json.loads(await connection.fetchval(f"EXPLAIN (FORMAT JSON) EXECUTE hot_query {arguments}"))[0]['Plan']
+                finally:
+                    await connection.execute("DEALLOCATE hot_query")
+                used = _plan_indexes(plan)
+                missing = expected_indexes - used
+                mode = plan_cache_mode.split('_')[1]
+                if not missing:
+                    print(f"OK   {label} ({mode} plan): {', '.join(sorted(expected_indexes))}")
+                else:
+                    failures += 1
+                    print(f"FAIL {label} ({mode} plan): missing {sorted(missing)}, plan used {sorted(used) or plan['Node Type']}")
+        await connection.execute("RESET plan_cache_mode")
+
+        # دوال المحادثة المخزنة: مطابقة ثم "التالي" ثم حظر، كل منها في رحلة واحدة
+        first = await connection.fetchval("SELECT match_or_enqueue(1, 'ar')")
+        step = await connection.fetchrow("SELECT * FROM next_chat(1, 'ar')")
+        blocked = await connection.fetchval("SELECT block_and_end_chat(1, $1)", step['new_partner_id'])
+        remaining = await connection.fetchval("SELECT COUNT(*) FROM active_chats WHERE 1 IN (user_id, partner_id)")
+        if first and step['old_partner_id'] == first and step['new_partner_id'] and blocked == step['new_partner_id'] and remaining == 0:
+            print("OK   chat functions: match_or_enqueue, next_chat, block_and_end_chat")
+        else:
+            failures += 1
+            print(f"FAIL chat functions: match={first} next={dict(step)} block={blocked} remaining={remaining}")
+    finally:
+        await connection.execute("DROP SCHEMA IF EXISTS explain_check CASCADE")
+        await connection.close()
+    return failures
+
+def webhook_harness(target_url, count=1000, concurrency=50):
+    """أداة محلية ترسل تحديثات Update جاهزة (JSON) إلى الـ webhook لاختباره وقياس أدائه دون اتصال بتيليجرام."""
+    from tornado.httpclient import AsyncHTTPClient
+
+    async def run():
+        client = AsyncHTTPClient(max_clients=concurrency)
+        headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET_TOKEN or ''}
+        latencies = []
+        statuses = {}
+
+        async def post_update(i):
+            user_id = 10_000_000 + (i % 500)
+            payload = {
+                'update_id': i,
+                'message': {
+                    'message_id': i,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': user_id, 'is_bot': False, 'first_name': 'Harness'},
+                    'text': f"harness message {i}",
+                },
+            }
+            started = time.perf_counter()
+            response = await client.fetch(target_url, method='POST', headers=headers, body=json.dumps(payload), raise_error=False)
+            latencies.append(time.perf_counter() - started)
+            statuses[response.code] = statuses.get(response.code, 0) + 1
+
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(i):
+            async with semaphore:
+                await post_update(i)
+
+        await asyncio.gather(*(limited(i) for i in range(count)))
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        print(f"Sent {count} updates in {elapsed:.2f}s ({count / elapsed:.0f} updates/s). Status codes: {statuses}")
+        print(f"Latency p50={latencies[len(latencies) // 2] * 1000:.1f}ms p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f}ms")
+
+    asyncio.run(run())
+
+def broadcast_bench(recipients=10000, latency_ms=50):
+    """يقيس إنتاجية محرك البث باستخدام Bot وهمي يحاكي زمن الاستجابة وأخطاء RetryAfter/Forbidden."""
+
+    class FakeBot:
+        def __init__(self):
+            self.calls = 0
+
+        async def _request(self, chat_id):
+            self.calls += 1
+            await asyncio.sleep(latency_ms / 1000)
+            if chat_id % 997 == 0:
+                raise Forbidden("Forbidden: bot was blocked by the user")
+            if chat_id % 1009 == 0 and self.calls % 2:
+                raise RetryAfter(1)
+
+        async def send_message(self, chat_id, **kwargs):
+            await self._request(chat_id)
+
+        async def copy_message(self, chat_id, **kwargs):
+            await self._request(chat_id)
+
+    async def run():
+        bot = FakeBot()
+        payload = BroadcastPayload(ADMIN_ID, 1, "Benchmark announcement", is_media=False)
+        stats = BroadcastStats(total=recipients)
+
+        async def on_progress(current):
+            print(current.summary())
+
+        await run_broadcast(bot, range(1, recipients + 1), payload, stats, on_progress)
+        print(f"Done. {stats.summary()} | API calls: {bot.calls}")
+
+    asyncio.run(run())
+
+def db_bench(seconds=5, concurrency=50, users=10000):
+    """يقارن إنتاجية استعلام حالة المستخدم (المسار الساخن) بين مجمع بدون كاش استعلامات محضرة
+    والمجمع المضبوط بإعدادات DB_POOL_*، على schema مؤقت في قاعدة البيانات المحلية."""
+    import random
+
+    schema = 'db_bench'
+    configurations = [
+        ("asyncpg defaults, no statement cache", dict(min_size=10, max_size=10, statement_cache_size=0, init=None)),
+        (f"tuned (pool {DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE}, cache {DB_STATEMENT_CACHE_SIZE}, prepared hot queries)", {}),
+    ]
+
+    async def setup():
+        connection = await asyncpg.connect(DATABASE_URL)
+        try:
+            await connection.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+            await connection.execute(f"CREATE SCHEMA {schema}")
+            await connection.execute(f"SET search_path TO {schema}")
+            await run_migrations(connection)
+            await connection.execute(
+                "INSERT INTO all_users (user_id, language) SELECT g, (ARRAY['en','ar','es'])[1 + g % 3] FROM generate_series(1, $1) g", users
+            )
+            await connection.execute("INSERT INTO active_chats (user_id, partner_id) SELECT g, g + 1 FROM generate_series(1, $1, 2) g", users // 10)
+            await connection.execute("ANALYZE")
+        finally:
+            await connection.close()
+
+    async def measure(name, overrides):
+        Rp.db_pool = db_pool = await create_db_pool(server_settings={'search_path': schema}, **overrides)
+        rng = random.Random(1)
+        queries = 0
+        deadline = time.perf_counter() + seconds
+
+        async def worker():
+            nonlocal queries
+            while time.perf_counter() < deadline:
+                await _load_user_state(rng.randint(1, users))
+                queries += 1
+
+        try:
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+            stats = db_pool.stats()
+        finally:
+            await db_pool.close()
+            Rp.db_pool = None
+        print(f"{name}: {queries / elapsed:.0f} queries/s, acquire p50={stats['p50_ms']}ms p99={stats['p99_ms']}ms max={stats['max_ms']}ms")
+        return queries / elapsed
+
+    async def run():
+        await setup()
+        try:
+            results = [await measure(name, overrides) for name, overrides in configurations]
+        finally:
+            connection = await asyncpg.connect(DATABASE_URL)
+            await connection.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+            await connection.close()
+        print(f"Speedup: {results[1] / results[0]:.2f}x ({concurrency} concurrent callers, {users} users)")
+
+    asyncio.run(run())
+
+def outbound_bench(seconds=10, latency_ms=40):
+    """يحاكي ضغطاً مختلطاً (رسائل مستخدمين + أرشيف + بث كبير) عبر OutboundScheduler مع Bot API وهمي
+    يرمي RetryAfter عند تجاوز الحد العام أو حد المحادثة، ويقيس الانتظار لكل أولوية. يُرجع عدد مرات RetryAfter."""
+    import random
+
+    scheduler = OutboundScheduler(OUTBOUND_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_RATE_PER_MINUTE, OUTBOUND_MAX_RETRIES)
+    rng = random.Random(1)
+
+    class FakeApi:
+        """يطبق حدود تيليجرام تقريبياً: OUTBOUND_RATE طلب في أي ثانية، وحد الدفعة لكل محادثة."""
+        def __init__(self):
+            self.sent = deque()
+            self.per_chat = {}
+            self.flood = 0
+
+        async def call(self, chat_id):
+            now = time.monotonic()
+            while self.sent and now - self.sent[0] > 1:
+                self.sent.popleft()
+            chat_log = self.per_chat.setdefault(chat_id, deque())
+            while chat_log and now - chat_log[0] > 1:
+                chat_log.popleft()
+            limit = max(1, int(OUTBOUND_CHAT_BURST)) if not str(chat_id).startswith('-') else scheduler.group_burst
+            if len(self.sent) >= OUTBOUND_RATE * 1.1 or len(chat_log) >= limit + OUTBOUND_CHAT_RATE:
+                self.flood += 1
+                raise RetryAfter(1)
+            self.sent.append(now)
+            chat_log.append(now)
+            await asyncio.sleep(latency_ms / 1000)
+            return True
+
+    async def request(api, chat_id, priority):
+        try:
+            await scheduler.process_request(api.call, (chat_id,), {}, 'sendMessage', {'chat_id': chat_id}, priority)
+        except RetryAfter:
+            pass
+
+    async def users(api, deadline):
+        # محادثات نشطة: ~10 رسائل/ثانية موزعة على 40 محادثة مع دفعات أحياناً
+        tasks = []
+        while time.monotonic() < deadline:
+            chat_id = rng.randint(1, 40)
+            for _ in range(rng.choice((1, 1, 1, 3))):
+                tasks.append(asyncio.create_task(request(api, chat_id, PRIORITY_USER)))
+            await asyncio.sleep(0.1)
+        await asyncio.gather(*tasks)
+
+    async def archive(api, deadline):
+        tasks = []
+        while time.monotonic() < deadline:
+            tasks.append(asyncio.create_task(request(api, "-1001", PRIORITY_ARCHIVE)))
+            await asyncio.sleep(ARCHIVE_FLUSH_INTERVAL)
+        await asyncio.gather(*tasks)
+
+    async def broadcast(api, deadline):
+        queue = asyncio.Queue()
+        for chat_id in range(100000, 100000 + int(OUTBOUND_RATE * seconds * 2)):
+            queue.put_nowait(chat_id)
+
+        async def worker():
+            while time.monotonic() < deadline and not queue.empty():
+                await request(api, queue.get_nowait(), PRIORITY_BROADCAST)
+
+        await asyncio.gather(*(worker() for _ in range(BROADCAST_CONCURRENCY)))
+
+    async def run():
+        api = FakeApi()
+        started = time.monotonic()
+        deadline = started + seconds
+        await asyncio.gather(users(api, deadline), archive(api, deadline), broadcast(api, deadline))
+        elapsed = time.monotonic() - started
+        stats = scheduler.stats()
+        for name in PRIORITY_NAMES:
+            print(f"{name:>9}: sent={stats[name]['sent']}, wait avg={stats[name]['avg_wait_ms']}ms max={stats[name]['max_wait_ms']}ms")
+        print(f"Throughput: {sum(stats[name]['sent'] for name in PRIORITY_NAMES) / elapsed:.1f} req/s (limit {OUTBOUND_RATE:g}), "
+              f"RetryAfter from fake API: {api.flood}, chats tracked: {stats['chats']}")
+        return api.flood
+
+    return asyncio.run(run())
+
+def dispatch_bench(iterations=100000):
+    """يقيس تكلفة فحص وتوزيع تحديث نصي واحد: مجموعات filters.Text القديمة (4 أزرار في المجموعة 4 ومعالج التمرير
+    بفلتره المنفي في المجموعة 5) مقابل ButtonRouter، بنفس منطق PTB (أول تطابق في كل مجموعة، وكل مجموعة تُفحص)، لأزرار اللوحة وللرسائل العادية كل على حدة. بدون تنفيذ المعالجات."""
+    from datetime import datetime
+    from telegram import Chat, Message
+
+    chat = Chat(id=1, type=Chat.PRIVATE)
+    button_texts = {key: [_(key, code) for code in SUPPORTED_LANGUAGES] for key in BUTTON_KEYS}
+    all_button_texts = [text for texts_for_key in button_texts.values() for text in texts_for_key]
+    samples = {
+        'buttons': all_button_texts,
+        'messages': ["hello there", "how are you?", "what's up", "ok"],
+    }
+
+    old_groups = [
+        [MessageHandler(filters.Text(button_texts[key]), None) for key in BUTTON_KEYS],
+        [MessageHandler(filters.ChatType.PRIVATE & ~filters.COMMAND & ~filters.Text(all_button_texts), None)],
+    ]
+    new_groups = [[MessageHandler(filters.ChatType.PRIVATE & ~filters.COMMAND, button_router)]]
+
+    def dispatch(groups, update):
+        # مثل Application.process_update: في كل مجموعة يتوقف الفحص عند أول معالج مطابق، ثم تُفحص المجموعة التالية
+        matched = []
+        for group in groups:
+            for handler in group:
+                if handler.check_update(update):
+                    matched.append(handler)
+                    break
+        return matched
+
+    def routed_dispatch(update):
+        matched = dispatch(new_groups, update)
+        if matched:
+            button_router.resolve(update.message.text)
+        return matched
+
+    for kind, texts in samples.items():
+        updates = [Update(index, message=Message(index, datetime.now(), chat, text=text)) for index, text in enumerate(texts)]
+        results = {}
+        for name, run in (("filters.Text groups", lambda update: dispatch(old_groups, update)), ("ButtonRouter", routed_dispatch)):
+            # أفضل جولة من 5 حتى لا تطغى ضوضاء الجهاز على الفرق
+            rounds = []
+            for _round in range(5):
+                started = time.perf_counter()
+                for index in range(iterations):
+                    run(updates[index % len(updates)])
+                rounds.append(time.perf_counter() - started)
+            results[name] = min(rounds) / iterations * 1e6
+        old, new = results.values()
+        print(f"{kind:>8}: filters.Text groups {old:.2f}µs, ButtonRouter {new:.2f}µs per update "
+              f"({(old - new) / old * 100:+.0f}% saved; {len(SUPPORTED_LANGUAGES)} languages, {iterations} updates)")
+
+def filter_bench(iterations=20000, seed=1):
+    """اختبار عشوائي ومقياس لفلتر المحتوى: يتحقق من نتائج نصوص مولّدة (روابط، يوزرات، بريد، نص عادي)
+    ويقيس أسوأ زمن فحص على نصوص عدائية بالطول الأقصى لرسالة تيليجرام. يُرجع عدد الإخفاقات."""
+    import random
+    import string
+
+    rng = random.Random(seed)
+    rules = catalogs.get(DEFAULT_LANG).get('content_filter', {})
+    budget = 0.005  # أقصى زمن مقبول لفحص رسالة واحدة (5ms) حتى لا تتعطل حلقة الأحداث
+    failures = 0
+
+    def word(length):
+        return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+    generators = {
+        'link': [
+            lambda: f"{rng.choice(rules['link_schemes'])}://{word(6)}.com/{word(4)}",
+            lambda: f"www.{word(8)}.org",
+            lambda: f"{rng.choice(rules['link_hosts'])}/{word(7)}",
+            lambda: f"{word(6)}.t.me",
+        ],
+        'username': [lambda: f"@{word(1)}{word(rng.randint(4, 20))}"],
+        None: [
+            lambda: f"{word(5)}@{word(6)}.com",
+            lambda: f"{word(rng.randint(1, 12))}",
+            lambda: f"{word(4)}.{word(3)}",
+            lambda: "@",
+            lambda: "what.me",
+        ],
+    }
+    for _ in range(iterations):
+        expected = rng.choice(list(generators))
+        token = rng.choice(generators[expected])()
+        filler = [word(rng.randint(1, 8)) for _ in range(rng.randint(0, 6))]
+        text = ' '.join(filler[:len(filler) // 2] + [token] + filler[len(filler) // 2:])
+        verdict = content_filter.check(text, DEFAULT_LANG)
+        if verdict.rule != expected:
+            failures += 1
+            if failures <= 10:
+                print(f"Mismatch: {text!r} expected {expected} got {verdict.rule} ({verdict.match!r})")
+
+    limit = constants.MessageLimit.MAX_TEXT_LENGTH
+    adversarial = {
+        'at-signs': '@' * limit,
+        'dots': '.' * limit,
+        'word-at': 'a@' * (limit // 2),
+        'www-chain': 'www.' * (limit // 4),
+        'dotted-labels': 'a.' * (limit // 2),
+        'long-label': 'x' * (limit - 5) + '.t.m',
+        'scheme-fragments': 'http:/' * (limit // 6),
+        'username-ish': '@a' + '_' * (limit - 2),
+        'random-symbols': ''.join(rng.choice('@.-_/:wt.me') for _ in range(limit)),
+    }
+    for name, text in adversarial.items():
+        worst = max(content_filter.check(text, DEFAULT_LANG).elapsed for _ in range(20))
+        status = 'ok' if worst <= budget else 'OVER BUDGET'
+        if worst > budget:
+            failures += 1
+        print(f"{name:>16}: {len(text)} chars, worst {worst * 1e6:.0f}µs ({status})")
+
+    stats = content_filter.stats()
+    print(f"{stats['checks']} checks, p50={stats['p50_us']}µs p99={stats['p99_us']}µs max={stats['max_us']}µs, failures={failures}")
+    return failures
+
+def match_loadtest(processes=4, users=400, rounds=30):
+    """اختبار حمل متعدد العمليات لوضع العنقود: عدة عمليات تطابق وتنهي محادثات نفس المستخدمين بالتوازي
+    على schema مؤقت، مع فحص مستمر أنه لا يوجد مستخدم في محادثتين أو في محادثة وطابور معاً."""
+    import multiprocessing
+
+    schema = 'match_loadtest'
+    languages = ['en', 'ar']
+
+    async def setup():
+        connection = await asyncpg.connect(DATABASE_URL)
+        try:
+            await connection.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+            await connection.execute(f"CREATE SCHEMA {schema}")
+            await connection.execute(f"SET search_path TO {schema}")
+            await run_migrations(connection)
+            await connection.executemany(
+                "INSERT INTO all_users (user_id, language) VALUES ($1, $2)",
+                [(user_id, languages[user_id % len(languages)]) for user_id in range(1, users + 1)]
+            )
+            # بعض الحظر بين المستخدمين حتى تمر المطابقة بمسار التخطي
+            await connection.executemany(
+                "INSERT INTO user_blocks (blocker_id, blocked_id) VALUES ($1, $2)",
+                [(user_id, user_id + 2) for user_id in range(1, users - 1, 7)]
+            )
+        finally:
+            await connection.close()
+
+    async def check_invariants(connection):
+        asymmetric = await connection.fetchval(
+            """
+            SELECT COUNT(*) FROM active_chats a
+            LEFT JOIN active_chats b ON b.user_id = a.partner_id AND b.partner_id = a.user_id
+            WHERE b.user_id IS NULL
+            """
+        )
+        chatting_and_waiting = await connection.fetchval("SELECT COUNT(*) FROM active_chats a JOIN waiting_queue w ON w.user_id = a.user_id")
+        return asymmetric + chatting_and_waiting
+
+    async def monitor(stop_event, result):
+        connection = await asyncpg.connect(DATABASE_URL, server_settings={'search_path': schema})
+        try:
+            while not stop_event.is_set():
+                result['checks'] += 1
+                result['violations'] += await check_invariants(connection)
+                await asyncio.sleep(0.05)
+        finally:
+            await connection.close()
+
+    async def run_setup_and_monitor(pool_processes):
+        await setup()
+        result = {'checks': 0, 'violations': 0}
+        stop_event = asyncio.Event()
+        monitor_task = asyncio.create_task(monitor(stop_event, result))
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        outcomes = await asyncio.gather(*(loop.run_in_executor(None, pool_processes.apply, _match_loadtest_worker, (index, processes, users, rounds, schema)) for index in range(processes)))
+        stop_event.set()
+        await monitor_task
+        connection = await asyncpg.connect(DATABASE_URL, server_settings={'search_path': schema})
+        try:
+            result['violations'] += await check_invariants(connection)
+            await connection.execute(f"DROP SCHEMA {schema} CASCADE")
+        finally:
+            await connection.close()
+        matches = sum(outcome['matches'] for outcome in outcomes)
+        conflicts = sum(outcome['conflicts'] for outcome in outcomes)
+        elapsed = time.perf_counter() - started
+        print(f"{processes} processes, {users} users, {rounds} rounds: {matches} matches in {elapsed:.1f}s ({matches / elapsed:.0f}/s)")
+        print(f"Constraint conflicts (double-match attempts): {conflicts}. Invariant violations: {result['violations']} over {result['checks']} checks.")
+        return conflicts + result['violations']
+
+    with multiprocessing.Pool(processes) as pool_processes:
+        return asyncio.run(run_setup_and_monitor(pool_processes))
+
+def _match_loadtest_worker(index, processes, users, rounds, schema):
+    """عملية واحدة في match_loadtest: كل مستخدم يبحث ثم ينهي المحادثة عدة مرات."""
+    import random
+
+    Rp.CLUSTER_MODE = True
+    outcome = {'matches': 0, 'conflicts': 0}
+
+    async def user_loop(user_id, lang_code):
+        for _ in range(rounds):
+            try:
+                if await match_or_enqueue(user_id, lang_code):
+                    outcome['matches'] += 1
+            except asyncpg.UniqueViolationError:
+                outcome['conflicts'] += 1
+            await asyncio.sleep(random.random() * 0.02)
+            await end_chat_in_db(user_id)
+            await remove_from_wait_queue_db(user_id)
+
+    async def run():
+        Rp.db_pool = await create_db_pool(server_settings={'search_path': schema})
+        try:
+            own_users = [user_id for user_id in range(1, users + 1) if user_id % processes == index]
+            await asyncio.gather(*(user_loop(user_id, ['en', 'ar'][user_id % 2]) for user_id in own_users))
+        finally:
+            await Rp.db_pool.close()
+
+    asyncio.run(run())
+    return outcome
+
+# --- Bulk Import / Export (python tools.py export|import) ---
+
+# الجداول التي تدعمها أداة النقل بالجملة: (الأعمدة، المفتاح، ما يحدث إذا كان الصف موجوداً)
+COPY_TABLES = {
+    'all_users': (('user_id', 'language'), 'user_id', 'DO UPDATE SET language = EXCLUDED.language'),
+    'user_blocks': (('blocker_id', 'blocked_id'), 'blocker_id, blocked_id', 'DO NOTHING'),
+    'global_bans': (('user_id',), 'user_id', 'DO NOTHING'),
+}
+COPY_CHUNK_SIZE = 1024 * 1024
+
+class CopyProgress:
+    """يطبع تقدم COPY (الحجم، السرعة، والنسبة إذا عُرف الحجم الكلي) مرة كل ثانية على الأكثر."""
+
+    def __init__(self, label, total=None):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self._started = self._last = time.perf_counter()
+
+    def advance(self, size):
+        self.done += size
+        now = time.perf_counter()
+        if now - self._last >= 1:
+            self._last = now
+            self.report()
+
+    def report(self, rows=None):
+        elapsed = time.perf_counter() - self._started
+        mib = self.done / (1024 * 1024)
+        percent = f" ({self.done * 100 / self.total:.0f}%)" if self.total else ""
+        rows_part = f", {rows} rows" if rows is not None else ""
+        print(f"{self.label}: {mib:.1f} MiB{percent}{rows_part} in {elapsed:.1f}s ({mib / max(elapsed, 1e-6):.1f} MiB/s)", flush=True)
+
+async def export_table(connection, table, path):
+    """يكتب الجدول كاملاً إلى ملف بصيغة COPY الثنائية. يُرجع عدد الصفوف."""
+    columns = COPY_TABLES[table][0]
+    progress = CopyProgress(f"export {table}")
+    with open(path, 'wb') as output:
+        async def write(chunk):
+            output.write(chunk)
+            progress.advance(len(chunk))
+        status = await connection.copy_from_table(table, output=write, columns=list(columns), format='binary')
+    rows = int(status.split()[-1])
+    progress.report(rows)
+    return rows
+
+async def import_table(connection, table, path):
+    """يحمّل ملف COPY ثنائياً في معاملة واحدة ويُبلغ البوت العامل ليعيد تحميل حالته. يُرجع عدد الصفوف المكتوبة.
+    الجدول الفارغ (استعادة نسخة احتياطية) يُحمّل مباشرة؛ غير ذلك يمر عبر جدول مؤقت ثم يُدمج بأمر واحد
+    (الصفوف الموجودة تُحدّث أو تُتخطى)."""
+    columns, key, on_conflict = COPY_TABLES[table]
+    column_list = ', '.join(columns)
+    progress = None
+
+    async def chunks():
+        nonlocal progress
+        progress = CopyProgress(f"import {table}", os.path.getsize(path))
+        with open(path, 'rb') as source:
+            while chunk := source.read(COPY_CHUNK_SIZE):
+                progress.advance(len(chunk))
+                yield chunk
+
+    async with connection.transaction():
+        written = None
+        if not await connection.fetchval(f"SELECT EXISTS (SELECT 1 FROM {table})"):
+            try:
+                async with connection.transaction():
+                    status = await connection.copy_to_table(table, source=chunks(), columns=list(columns), format='binary')
+                written = int(status.split()[-1])
+            except asyncpg.UniqueViolationError:
+                print(f"import {table}: file has duplicate keys, merging through a staging table instead", flush=True)
+        if written is None:
+            await connection.execute(f"CREATE TEMP TABLE copy_stage (LIKE {table}) ON COMMIT DROP")
+            await connection.copy_to_table('copy_stage', source=chunks(), columns=list(columns), format='binary')
+            progress.report()
+            written = await connection.fetchval(f"""
+                WITH written AS (
+                    INSERT INTO {table} ({column_list})
+                    SELECT DISTINCT ON ({key}) {column_list} FROM copy_stage
+                    ON CONFLICT ({key}) {on_conflict}
+                    RETURNING 1
+                )
+                SELECT COUNT(*) FROM written
+            """)
+        await connection.execute("SELECT pg_notify('bulk_import', $1)", table)
+    progress.report(written)
+    return written
+
+def copy_tool(action, target, path):
+    """أداة الأدمن لنقل all_users وuser_blocks وglobal_bans بالجملة عبر COPY الثنائي.
+    target اسم جدول (path ملف) أو all (path مجلد فيه <table>.copy لكل جدول). يُرجع 0 عند النجاح."""
+    tables = list(COPY_TABLES) if target == 'all' else [target]
+    if action not in ('export', 'import') or any(table not in COPY_TABLES for table in tables):
+        print(f"Usage: python tools.py export|import <{'|'.join(COPY_TABLES)}|all> <path>")
+        return 1
+
+    async def run():
+        if target == 'all' and action == 'export':
+            os.makedirs(path, exist_ok=True)
+        connection = await asyncpg.connect(DATABASE_URL)
+        try:
+            await run_migrations(connection)
+            for table in tables:
+                table_path = os.path.join(path, f"{table}.copy") if target == 'all' else path
+                if action == 'export':
+                    await export_table(connection, table, table_path)
+                else:
+                    await import_table(connection, table, table_path)
+        finally:
+            await connection.close()
+
+    asyncio.run(run())
+    return 0
+
+
+def usage():
+    print(__doc__.strip().split('\n\n', 1)[1], file=sys.stderr)
+    return 2
+
+# الأدوات التي تأخذ وسائط رقمية اختيارية فقط: الأمر -> (الدالة، أقصى عدد للوسائط، هل تُرجع عدد الإخفاقات)
+NUMERIC_TOOLS = {
+    'broadcast-bench': (broadcast_bench, 2, False),
+    'match-loadtest': (match_loadtest, 3, True),
+    'db-bench': (db_bench, 3, False),
+    'outbound-bench': (outbound_bench, 2, True),
+    'dispatch-bench': (dispatch_bench, 1, False),
+    'filter-bench': (filter_bench, 2, True),
+}
+
+def run_tool(argv):
+    """يوزع سطر الأوامر على الأداة المطلوبة. أي أمر غير معروف أو وسائط ناقصة أو زائدة أو غير رقمية
+    تطبع طريقة الاستخدام وتُرجع 2؛ أخطاء الأداة نفسها تظهر كما هي."""
+    command, args = (argv[0], argv[1:]) if argv else (None, [])
+    if command == 'check-schema' and not args:
+        return 1 if asyncio.run(check_schema()) else 0
+    if command in ('export', 'import') and len(args) == 2:
+        return copy_tool(command, *args)
+    if command == 'webhook-harness' and 1 <= len(args) <= 3:
+        target_url, numbers = args[0], args[1:]
+    elif command in NUMERIC_TOOLS and len(args) <= NUMERIC_TOOLS[command][1]:
+        numbers = args
+    else:
+        return usage()
+    try:
+        numbers = [int(arg) for arg in numbers]
+    except ValueError:
+        return usage()
+
+    if command == 'webhook-harness':
+        webhook_harness(target_url, *numbers)
+        return 0
+    tool, _max_args, returns_failures = NUMERIC_TOOLS[command]
+    failures = tool(*numbers)
+    return 1 if returns_failures and failures else 0
+
+if __name__ == "__main__":
+    sys.exit(run_tool(sys.argv[1:]))